@@ -7,22 +7,40 @@ import os
 import json
 import asyncio
 import re
-import sqlite3
-from datetime import datetime, timedelta
-from typing import Dict, Any, List, Optional, Tuple
+import time
+from datetime import datetime
+from typing import Dict, Any, List, Optional, Tuple, Callable, Awaitable, Deque
 from enum import Enum
+from dataclasses import dataclass, asdict
+from collections import deque
 from pathlib import Path
 
 from fastapi import FastAPI, Request, Header, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, Field
+from starlette.background import BackgroundTask
 
-import httpx
-import pandas as pd
 from dotenv import load_dotenv
 import google.generativeai as genai
 
+import fernanda_db
+from fernanda_db import Database, WriteBehindQueue
+from fernanda_dispatch import MessageDispatcher, QueueFullError
+from fernanda_evolution import EvolutionClient
+from fernanda_prompt import PromptBuilder, TokenStats, estimate_tokens
+from fernanda_matcher import MessageMatcher
+from fernanda_knowledge import KnowledgeBase
+from fernanda_cache import ResponseCache, SourceVersions
+from fernanda_conversations import ConversationStore
+from fernanda_state import SharedConversations, create_state_backend
+from fernanda_templates import TemplateEngine, CONFIRM_WORDS
+from fernanda_metrics import RouteStats, LatencyWindow, LoopLagMonitor, MetricsRegistry, TurnTrace
+from fernanda_llm import LLMGovernor, CircuitOpenError, SentenceSplitter
+from fernanda_export import Exporter, ExportBusyError, EXPORT_FORMATS, decode_cursor, next_cursor
+from fernanda_dedup import WebhookDeduplicator, message_key
+from fernanda_schedule import (ScheduleIndex, Slot, resolve_date, describe_day, clinic_today,
+                               SCHEDULE_DEFAULT_DURATION, SCHEDULE_REFRESH_INTERVAL)
+
 # === Configuração ===
 load_dotenv()
 
@@ -33,6 +51,9 @@ EVOLUTION_API_KEY = os.getenv("EVOLUTION_API_KEY", "")
 EVOLUTION_BASE_URL = os.getenv("EVOLUTION_BASE_URL", "http://localhost:8080")
 EVOLUTION_INSTANCE = os.getenv("EVOLUTION_INSTANCE", "instance")
 RUN_MODE = os.getenv("RUN_MODE", "dev").lower()
+LLM_STREAMING = os.getenv("LLM_STREAMING", "1") == "1"
+CONFIG_RELOAD_INTERVAL = float(os.getenv("CONFIG_RELOAD_INTERVAL", "30"))
+ANALYTICS_RECONCILE_INTERVAL = float(os.getenv("ANALYTICS_RECONCILE_INTERVAL", "3600"))
 ADMIN_WHATSAPP = os.getenv("ADMIN_WHATSAPP", "")
 
 # Verificar API Key do Gemini
@@ -58,60 +79,14 @@ app.add_middleware(
 )
 
 # === Banco de Dados ===
-def init_database():
-    """Inicializa o banco de dados SQLite"""
-    conn = sqlite3.connect('data/fernanda.db')
-    cursor = conn.cursor()
-    
-    # Tabela de pacientes
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS patients (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            phone TEXT UNIQUE NOT NULL,
-            name TEXT NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    
-    # Tabela de agendamentos
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS appointments (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            patient_id INTEGER NOT NULL,
-            service TEXT NOT NULL,
-            specialty TEXT,
-            urgency_level INTEGER DEFAULT 0,
-            scheduled_date TEXT,
-            scheduled_time TEXT,
-            status TEXT DEFAULT 'pending',
-            notes TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            confirmed_at TIMESTAMP,
-            FOREIGN KEY (patient_id) REFERENCES patients (id)
-        )
-    ''')
-    
-    # Tabela de conversas (histórico)
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS conversations (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            patient_id INTEGER,
-            user_message TEXT NOT NULL,
-            bot_response TEXT NOT NULL,
-            intent TEXT,
-            state TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (patient_id) REFERENCES patients (id)
-        )
-    ''')
-    
-    conn.commit()
-    conn.close()
+db = Database()
+write_queue = WriteBehindQueue(db)
+
+def init_database() -> int:
+    """Inicializa o banco de dados SQLite (aplica as migrações pendentes)"""
+    return db.write_sync(fernanda_db.migrate)
 
-# Criar diretório de dados se não existir
-Path("data").mkdir(exist_ok=True)
-init_database()
+SCHEMA_VERSION = init_database()
 
 # === Classes de Dados ===
 class ConversationState(Enum):
@@ -122,7 +97,8 @@ class ConversationState(Enum):
     CONFIRMING = "confirming"
     COMPLETED = "completed"
 
-class PatientInfo(BaseModel):
+@dataclass(slots=True)
+class PatientInfo:
     phone: str
     name: Optional[str] = None
     current_issue: Optional[str] = None
@@ -130,8 +106,17 @@ class PatientInfo(BaseModel):
     service_needed: Optional[str] = None
     preferred_date: Optional[str] = None
     preferred_time: Optional[str] = None
+    
+    def to_dict(self) -> Dict[str, Any]:
+        return asdict(self)
+
+# Interações recentes mantidas na conversa (o prompt usa as últimas 3)
+HISTORY_TURNS = int(os.getenv("HISTORY_TURNS", "10"))
 
 class ConversationMemory:
+    __slots__ = ("phone", "patient_id", "state", "patient_info", "context_data",
+                 "message_count", "last_activity", "version", "history")
+    
     def __init__(self, phone: str):
         self.phone = phone
         self.patient_id: Optional[int] = None
@@ -140,116 +125,139 @@ class ConversationMemory:
         self.context_data: Dict[str, Any] = {}
         self.message_count = 0
         self.last_activity = datetime.now()
+        self.version = 0  # versão gravada no armazenamento compartilhado
+        # Últimas interações; None até ser carregado do banco uma vez
+        self.history: Optional[Deque[Dict[str, Any]]] = None
+    
+    def remember_turn(self, turn: Dict[str, Any]):
+        """Acrescenta a interação recém-enfileirada (se o histórico já foi carregado)"""
+        if self.history is not None:
+            self.history.append(turn)
     
     def to_dict(self) -> Dict[str, Any]:
         return {
             "phone": self.phone,
             "patient_id": self.patient_id,
             "state": self.state.value,
-            "patient_info": self.patient_info.dict(),
+            "patient_info": self.patient_info.to_dict(),
             "context_data": self.context_data,
-            "message_count": self.message_count
+            "message_count": self.message_count,
+            "last_activity": self.last_activity.isoformat(),
+            "history": list(self.history) if self.history is not None else None
         }
+    
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "ConversationMemory":
+        memory = cls(data["phone"])
+        memory.patient_id = data.get("patient_id")
+        memory.state = ConversationState(data["state"])
+        memory.patient_info = PatientInfo(**data["patient_info"])
+        memory.context_data = data.get("context_data") or {}
+        memory.message_count = data.get("message_count", 0)
+        if data.get("last_activity"):
+            memory.last_activity = datetime.fromisoformat(data["last_activity"])
+        if data.get("history") is not None:
+            memory.history = deque(data["history"], maxlen=HISTORY_TURNS)
+        return memory
 
 # === Memória em RAM (cache) ===
-active_conversations: Dict[str, ConversationMemory] = {}
+# Limitada: descarta as conversas inativas e, se lotar, as menos recentes
+active_conversations: ConversationStore[ConversationMemory] = ConversationStore(ConversationMemory)
+
+# Estado das conversas (CONVERSATION_BACKEND: memória com um worker, SQLite com vários);
+# active_conversations vira o cache local dos objetos já carregados. A ordem por
+# telefone e a junção de rajadas continuam por processo (ver Dockerfile)
+conversations = SharedConversations(create_state_backend(db), active_conversations,
+                                    ConversationMemory.from_dict)
+
+async def forget_history(phones: List[str]):
+    """Turnos que não chegaram ao banco: o histórico (local e compartilhado) volta a ser lido de lá"""
+    for phone in phones:
+        try:
+            await conversations.reset_field(phone, "history")
+        except Exception as e:
+            # Sem o banco, ao menos este processo deixa de usar o histórico
+            print(f"⚠️ Erro ao descartar histórico de {phone}: {e}")
+
+write_queue.on_turns_failed = forget_history
 
 # === Funções de Banco de Dados ===
-def get_or_create_patient(phone: str, name: Optional[str] = None) -> int:
+async def get_or_create_patient(phone: str, name: Optional[str] = None) -> int:
     """Obtém ou cria um paciente no banco"""
-    conn = sqlite3.connect('data/fernanda.db')
-    cursor = conn.cursor()
-    
-    # Verificar se existe
-    cursor.execute("SELECT id, name FROM patients WHERE phone = ?", (phone,))
-    result = cursor.fetchone()
-    
-    if result:
-        patient_id = result[0]
-        # Atualizar nome se fornecido e diferente
-        if name and name != result[1]:
-            cursor.execute(
-                "UPDATE patients SET name = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?",
-                (name, patient_id)
-            )
-            conn.commit()
-    else:
-        # Criar novo paciente
-        cursor.execute(
-            "INSERT INTO patients (phone, name) VALUES (?, ?)",
-            (phone, name or "Não informado")
-        )
-        conn.commit()
-        patient_id = cursor.lastrowid
-    
-    conn.close()
-    return patient_id
-
-def save_appointment(memory: ConversationMemory) -> int:
-    """Salva um agendamento no banco"""
-    conn = sqlite3.connect('data/fernanda.db')
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        INSERT INTO appointments (
-            patient_id, service, specialty, urgency_level,
-            scheduled_date, scheduled_time, status, notes
-        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-    ''', (
+    return await db.write(fernanda_db.upsert_patient, phone, name)
+
+def appointment_row(memory: ConversationMemory, day: Optional[str], time_: Optional[str],
+                    status: str = "confirmed") -> Tuple:
+    return (
         memory.patient_id,
         memory.patient_info.service_needed or "Consulta",
         memory.context_data.get("specialty", "Clínica Geral"),
         memory.patient_info.urgency_level,
-        memory.patient_info.preferred_date,
-        memory.patient_info.preferred_time,
-        "confirmed",
+        day,
+        time_,
+        status,
         memory.patient_info.current_issue
-    ))
-    
-    appointment_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
-    
-    return appointment_id
-
-def save_conversation_turn(patient_id: int, user_msg: str, bot_msg: str, state: str):
-    """Salva uma interação no histórico"""
-    conn = sqlite3.connect('data/fernanda.db')
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        INSERT INTO conversations (patient_id, user_message, bot_response, state)
-        VALUES (?, ?, ?, ?)
-    ''', (patient_id, user_msg[:500], bot_msg[:500], state))
-    
-    conn.commit()
-    conn.close()
-
-def get_patient_history(phone: str) -> List[Dict[str, Any]]:
-    """Obtém histórico do paciente"""
-    conn = sqlite3.connect('data/fernanda.db')
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        SELECT c.user_message, c.bot_response, c.created_at, c.state
-        FROM conversations c
-        JOIN patients p ON c.patient_id = p.id
-        WHERE p.phone = ?
-        ORDER BY c.created_at DESC
-        LIMIT 10
-    ''', (phone,))
-    
-    history = []
-    for row in cursor.fetchall():
-        history.append({
-            "user": row[0],
-            "bot": row[1],
-            "timestamp": row[2],
-            "state": row[3]
-        })
-    
-    conn.close()
-    return history[::-1]  # Reverter para ordem cronológica
+    )
+
+async def save_appointment(memory: ConversationMemory) -> Tuple[int, bool]:
+    """
+    Reserva um horário livre e salva o agendamento: (id, reservou?).
+    
+    A reserva é atômica no banco (appointment_slots): se outro worker levou
+    o horário, recarrega aquele dia e tenta o próximo candidato. Sem nenhum
+    horário livre (ou após BOOKING_MAX_ATTEMPTS conflitos), o pedido fica
+    'pending', sem data nem hora, para a equipe retornar com opções.
+    """
+    specialty = memory.context_data.get("specialty", "Clínica Geral")
+    duration = service_duration(memory.patient_info.service_needed)
+    attempts = 0
+    for day, time_ in booking_candidates(memory, specialty, duration):
+        if not SCHEDULE.is_free(specialty, day, time_, duration):
+            continue
+        attempts += 1
+        try:
+            appointment_id = await db.write(fernanda_db.reserve_appointment, appointment_row(memory, day, time_),
+                                            SCHEDULE.reservation_minutes(time_, duration))
+        except fernanda_db.SlotTakenError:
+            SCHEDULE.counters["conflicts"] += 1
+            await refresh_schedule(specialty, day)
+            if attempts >= BOOKING_MAX_ATTEMPTS:
+                break
+            continue
+        SCHEDULE.occupy(specialty, day, time_, duration)
+        memory.patient_info.preferred_date = day
+        memory.patient_info.preferred_time = time_
+        return appointment_id, True
+    
+    SCHEDULE.counters["unavailable"] += 1
+    memory.context_data['awaiting_slot'] = True
+    appointment_id = await write_queue.submit_appointment(appointment_row(memory, None, None, "pending"))
+    return appointment_id, False
+
+def save_conversation_turn(phone: str, patient_id: int, user_msg: str, bot_msg: str, state: str) -> Dict[str, Any]:
+    """Enfileira uma interação no histórico (gravada em lote)"""
+    return write_queue.submit_turn(phone, patient_id, user_msg, bot_msg, state)
+
+async def get_patient_history(phone: str) -> List[Dict[str, Any]]:
+    """Obtém histórico do paciente, incluindo turnos ainda não gravados"""
+    pending = write_queue.pending_turns(phone)
+    history = await db.read(fernanda_db.fetch_patient_history, phone, HISTORY_TURNS)
+    return fernanda_db.merge_pending_history(history, pending, HISTORY_TURNS)
+
+async def conversation_history(memory: ConversationMemory) -> List[Dict[str, Any]]:
+    """
+    Histórico recente da conversa.
+    
+    Lido do banco só na primeira vez (ou depois de um reset/expiração);
+    depois cada turno é acrescentado ao enfileirar a gravação, e o buffer
+    viaja com o estado da conversa entre os workers.
+    """
+    if memory.history is None:
+        memory.history = deque(await get_patient_history(memory.phone), maxlen=HISTORY_TURNS)
+        METRICS.inc("history_lookups_total", source="db")
+    else:
+        METRICS.inc("history_lookups_total", source="memory")
+    return list(memory.history)
 
 # === Carregar Arquivos de Configuração ===
 def load_prompt() -> str:
@@ -266,13 +274,13 @@ def load_clinic_config() -> Dict[str, Any]:
         return json.loads(path.read_text(encoding="utf-8"))
     return {"clinic_name": "Clínica Sorriso & Saúde"}
 
-def load_knowledge_base() -> pd.DataFrame:
+def load_knowledge_base() -> KnowledgeBase:
     """Carrega base de conhecimento"""
     path = Path("knowledge_base.csv")
     if path.exists():
-        return pd.read_csv(path)
+        return KnowledgeBase.from_csv(path)
     # Base padrão
-    return pd.DataFrame([
+    return KnowledgeBase([
         {"servico": "Triagem de dor", "especialidade": "Endodontia", 
          "palavras_chave": "dor,urgente,emergência", "urgencia": "Alto", "duracao_min": 40},
         {"servico": "Limpeza", "especialidade": "Clínica Geral",
@@ -284,85 +292,116 @@ FERNANDA_PROMPT = load_prompt()
 CLINIC_CONFIG = load_clinic_config()
 KNOWLEDGE_BASE = load_knowledge_base()
 
+# === Agenda ===
+# Horários livres em memória (bitmaps por especialidade e dia); a reserva vale no banco
+SCHEDULE = ScheduleIndex(CLINIC_CONFIG.get("business_hours", {}))
+BOOKING_MAX_ATTEMPTS = 3
+OFFERED_SLOTS = 2
+
+def service_duration(service: Optional[str]) -> int:
+    """Duração do serviço na base de conhecimento (ou a padrão)"""
+    found = KNOWLEDGE_BASE.by_name.get(service or "")
+    return found.duration_min if found and found.duration_min else SCHEDULE_DEFAULT_DURATION
+
+def offer_slots(memory: "ConversationMemory") -> List[Slot]:
+    """Próximos horários livres para o serviço da conversa (lembrados para a confirmação)"""
+    info = memory.patient_info
+    slots = SCHEDULE.free_slots(memory.context_data.get("specialty", "Clínica Geral"),
+                                service_duration(info.service_needed), OFFERED_SLOTS,
+                                from_day=info.preferred_date, from_time=info.preferred_time)
+    memory.context_data["offered_slots"] = [list(slot) for slot in slots]
+    return slots
+
+def booking_candidates(memory: "ConversationMemory", specialty: str, duration: int) -> List[Slot]:
+    """Horários a tentar na confirmação: o pedido exato, os oferecidos que batem com ele, os demais oferecidos"""
+    info = memory.patient_info
+    offered = [tuple(slot) for slot in memory.context_data.get("offered_slots", [])]
+    candidates: List[Slot] = []
+    if info.preferred_date and info.preferred_time:
+        candidates.append((info.preferred_date, info.preferred_time))
+    candidates += [slot for slot in offered if info.preferred_time == slot[1] or info.preferred_date == slot[0]]
+    candidates += offered
+    candidates += SCHEDULE.free_slots(specialty, duration, BOOKING_MAX_ATTEMPTS,
+                                      from_day=info.preferred_date, from_time=info.preferred_time)
+    return list(dict.fromkeys(candidates))
+
+async def refresh_schedule(specialty: Optional[str] = None, day: Optional[str] = None):
+    """Recarrega as reservas do banco (todas, ou só de um dia de uma especialidade)"""
+    if specialty and day:
+        rows = await db.read(fernanda_db.fetch_reserved_slots, day, specialty, day)
+        SCHEDULE.load(rows, days=[(specialty, day)])
+    else:
+        SCHEDULE.load(await db.read(fernanda_db.fetch_reserved_slots, clinic_today().isoformat()))
+
 # === Extração de Informações ===
+# Regex compiladas uma vez
+NAME_PATTERNS = [
+    re.compile(r'(?:meu nome é|me chamo|sou o?a?)\s+([A-Z][a-zà-ú]+(?:\s+[A-Z][a-zà-ú]+)*)', re.IGNORECASE),
+    re.compile(r'^([A-Z][a-zà-ú]+(?:\s+[A-Z][a-zà-ú]+)*)[,.\s]', re.IGNORECASE),
+]
+PHONE_PATTERN = re.compile(r'(?:\+?55\s?)?(?:\(?\d{2}\)?\s?)?\d{4,5}[-\s]?\d{4}')
+TIME_PATTERN = re.compile(r'(\d{1,2})[h:](\d{2})?')
+
+def build_message_matcher() -> MessageMatcher:
+    """Monta o autômato de palavras-chave a partir da base de conhecimento"""
+    return MessageMatcher([(s.name, s.specialty, s.keywords) for s in KNOWLEDGE_BASE])
+
+MESSAGE_MATCHER = build_message_matcher()
+
 def extract_info_from_message(message: str, memory: ConversationMemory) -> Dict[str, Any]:
     """Extrai informações relevantes da mensagem"""
     extracted = {}
-    msg_lower = message.lower()
     
     # Extrair nome
     if not memory.patient_info.name:
         # Padrões comuns
-        patterns = [
-            r'(?:meu nome é|me chamo|sou o?a?)\s+([A-Z][a-zà-ú]+(?:\s+[A-Z][a-zà-ú]+)*)',
-            r'^([A-Z][a-zà-ú]+(?:\s+[A-Z][a-zà-ú]+)*)[,.\s]',
-        ]
-        for pattern in patterns:
-            match = re.search(pattern, message, re.IGNORECASE)
+        for pattern in NAME_PATTERNS:
+            match = pattern.search(message)
             if match:
                 extracted['name'] = match.group(1).strip()
                 break
     
     # Extrair telefone
-    phone_pattern = r'(?:\+?55\s?)?(?:\(?\d{2}\)?\s?)?\d{4,5}[-\s]?\d{4}'
-    phone_match = re.search(phone_pattern, message)
+    phone_match = PHONE_PATTERN.search(message)
     if phone_match:
         extracted['phone'] = re.sub(r'[^\d]', '', phone_match.group())
     
-    # Detectar urgência
-    urgency_keywords = {
-        10: ['insuportável', 'não aguento', 'emergência'],
-        8: ['muita dor', 'bastante dor', 'doendo muito'],
-        6: ['dor', 'doendo', 'incômodo'],
-        3: ['desconforto', 'sensível']
-    }
-    
-    for level, keywords in urgency_keywords.items():
-        if any(kw in msg_lower for kw in keywords):
-            extracted['urgency'] = level
-            break
-    
-    # Detectar serviço baseado na knowledge base
-    for _, row in KNOWLEDGE_BASE.iterrows():
-        keywords = row['palavras_chave'].split(',')
-        if any(kw.strip() in msg_lower for kw in keywords):
-            extracted['service'] = row['servico']
-            extracted['specialty'] = row['especialidade']
-            break
-    
-    # Detectar datas/horários
-    if 'hoje' in msg_lower:
-        extracted['date_preference'] = 'hoje'
-    elif 'amanhã' in msg_lower:
-        extracted['date_preference'] = 'amanhã'
-    elif 'semana' in msg_lower:
-        extracted['date_preference'] = 'esta semana'
+    # Urgência, serviço, datas e intenção em uma passada (sem acentos)
+    hits = MESSAGE_MATCHER.scan(message)
+    for key in ('urgency', 'service', 'specialty', 'date_preference'):
+        if key in hits:
+            extracted[key] = hits[key]
     
     # Horários
-    time_match = re.search(r'(\d{1,2})[h:](\d{2})?', message)
+    time_match = TIME_PATTERN.search(message)
     if time_match:
-        hour = time_match.group(1)
-        minute = time_match.group(2) or "00"
-        extracted['time_preference'] = f"{hour}:{minute}"
+        hour = int(time_match.group(1))
+        minute = int(time_match.group(2) or 0)
+        if hour < 24 and minute < 60:
+            extracted['time_preference'] = f"{hour:02d}:{minute:02d}"
     
-        # Intenção explícita de consulta/agendamento
-    if any(k in msg_lower for k in ['agendar', 'marcar', 'consulta', 'avaliacao', 'avaliação', 'operar', 'cirurgia']):
+    # Intenção explícita de consulta/agendamento
+    if hits['booking']:
         extracted.setdefault('service', 'Consulta')
         memory.context_data['specialty'] = memory.context_data.get('specialty', 'Clínica Geral')
 
     return extracted
 
 # === Geração de Prompt Contextual ===
-def build_intelligent_prompt(memory: ConversationMemory, user_message: str) -> str:
-    """Constrói um prompt completo e contextual para o Gemini"""
-    
-    # Histórico do banco de dados
-    db_history = get_patient_history(memory.phone)
-    
-    # Informações extraídas
+def build_prompt_builder() -> PromptBuilder:
+    """Prepara o montador de prompt com as partes fixas (persona, clínica, serviços)"""
+    table = KNOWLEDGE_BASE.table_lines()
+    return PromptBuilder(FERNANDA_PROMPT, CLINIC_CONFIG, table[0], table[1:],
+                         row_matcher=MESSAGE_MATCHER.service_rows)
+
+# Montado uma vez: só o contexto dinâmico é gerado a cada mensagem
+PROMPT_BUILDER = build_prompt_builder()
+TOKEN_STATS = TokenStats()
+
+def apply_extracted_info(memory: ConversationMemory, user_message: str):
+    """Atualiza a memória com as informações extraídas da mensagem"""
     extracted = extract_info_from_message(user_message, memory)
     
-    # Atualizar memória com informações extraídas
     if 'name' in extracted:
         memory.patient_info.name = extracted['name']
     if 'urgency' in extracted:
@@ -370,6 +409,24 @@ def build_intelligent_prompt(memory: ConversationMemory, user_message: str) -> s
     if 'service' in extracted:
         memory.patient_info.service_needed = extracted['service']
         memory.context_data['specialty'] = extracted.get('specialty', 'Clínica Geral')
+    preferred_date = resolve_date(user_message, extracted.get('date_preference'), clinic_today())
+    if preferred_date:
+        memory.patient_info.preferred_date = preferred_date
+    if 'time_preference' in extracted:
+        memory.patient_info.preferred_time = extracted['time_preference']
+
+async def build_intelligent_prompt(memory: ConversationMemory, user_message: str,
+                                   trace: Optional[TurnTrace] = None) -> str:
+    """Constrói um prompt completo e contextual para o Gemini"""
+    trace = trace or TurnTrace()
+    
+    # Histórico do banco de dados
+    with trace.span("history"):
+        db_history = await conversation_history(memory)
+    
+    # Informações extraídas
+    with trace.span("extract"):
+        apply_extracted_info(memory, user_message)
     
     # Contexto completo
     context = {
@@ -389,12 +446,11 @@ def build_intelligent_prompt(memory: ConversationMemory, user_message: str) -> s
         "ultima_visita": db_history[-1]['timestamp'] if db_history else None
     }
     
-    # Montar histórico recente
-    recent_history = ""
-    if db_history:
-        # Pegar últimas 3 interações
-        for h in db_history[-3:]:
-            recent_history += f"Paciente: {h['user']}\nFernanda: {h['bot']}\n"
+    # Horários livres de verdade para o serviço (só quando já se fala em agendar)
+    if memory.state in (ConversationState.SCHEDULING, ConversationState.CONFIRMING) or \
+            memory.patient_info.service_needed:
+        with trace.span("slots"):
+            context["horarios_livres"] = [f"{describe_day(day)} às {time_}" for day, time_ in offer_slots(memory)]
     
     # Informações que faltam
     missing = []
@@ -408,169 +464,344 @@ def build_intelligent_prompt(memory: ConversationMemory, user_message: str) -> s
         if not memory.patient_info.preferred_time:
             missing.append("horário preferido")
     
-    # Prompt estruturado
-    prompt = f"""
-{FERNANDA_PROMPT}
-
-=== DADOS DA CLÍNICA ===
-{json.dumps(CLINIC_CONFIG, ensure_ascii=False, indent=2)}
-
-=== BASE DE CONHECIMENTO ===
-Serviços disponíveis:
-{KNOWLEDGE_BASE.to_string(index=False)}
-
-=== CONTEXTO DA CONVERSA ===
-Estado: {context['estado_atual']}
-Mensagem número: {context['mensagem_numero']}
-Paciente já conhecido: {'Sim' if context['paciente_conhecido'] else 'Não'}
-
-=== INFORMAÇÕES JÁ COLETADAS ===
-{json.dumps(context['informacoes_coletadas'], ensure_ascii=False, indent=2)}
-
-=== HISTÓRICO RECENTE ===
-{recent_history if recent_history else "Primeira interação com este paciente"}
-
-=== MENSAGEM ATUAL ===
-Paciente: {user_message}
-
-=== INSTRUÇÕES CRÍTICAS ===
-1. NUNCA se apresente novamente após a primeira mensagem
-2. Se é urgência (dor), seja empática mas RÁPIDA - sugira horário HOJE
-3. Use o nome do paciente quando souber
-4. Colete apenas UMA informação faltante por vez
-5. Seja natural e humana, não robótica
-6. Responda em no máximo 2-3 frases
-Se o paciente demonstrou intenção de AGENDAR (ex.: "marcar", "agendar", "consulta", "operar", "cirurgia"), vá DIRETO ao agendamento: sugira 2 opções de horário disponíveis (ex.: hoje 14:30 ou 16:00) e peça só a confirmação.
-8. Não pergunte sobre tipo de dor (ex.: latejante, pontada, constante) nem peça para “classificar a dor”. Isso NÃO é necessário para agendar.
-9. Evite repetir a mesma pergunta em mensagens consecutivas. Se já pediu uma informação nas últimas 2 mensagens, avance com uma sugestão de horário.
-10. Informações faltantes: {', '.join(missing) if missing else 'Todas coletadas - pode confirmar agendamento'}
-IMPORTANTE: Responda EXATAMENTE como a Fernanda responderia - humana, calorosa, eficiente.
-Resposta (máximo 3 frases):"""
+    # Prompt estruturado (dentro do orçamento de tokens)
+    with trace.span("prompt"):
+        prompt, sections = PROMPT_BUILDER.render(context, db_history, user_message, missing)
+    TOKEN_STATS.record_sections(sections)
     
     return prompt
 
+# === Cache de Perguntas Frequentes ===
+CONFIG_VERSIONS = SourceVersions({
+    "config": Path("clinica_config.json"),
+    "kb": Path("knowledge_base.csv"),
+    "persona": Path("prompt_fernanda.md"),
+})
+RESPONSE_CACHE = ResponseCache(CONFIG_VERSIONS)
+FAQ_MAX_LENGTH = 160
+
+def faq_cache_key(memory: ConversationMemory, message: str) -> Optional[Tuple]:
+    """Chave do cache se a mensagem é uma pergunta frequente independente da conversa"""
+    if len(message) > FAQ_MAX_LENGTH:
+        return None
+    if memory.state in (ConversationState.SCHEDULING, ConversationState.CONFIRMING):
+        return None
+    
+    hits = MESSAGE_MATCHER.scan(message)
+    if 'faq' not in hits or hits['booking'] or 'urgency' in hits or 'date_preference' in hits:
+        return None
+    if TIME_PATTERN.search(message):
+        return None
+    
+    return RESPONSE_CACHE.key(hits['faq'], message, memory.message_count == 1)
+
+def is_cacheable_response(memory: ConversationMemory, response: str) -> bool:
+    """Não guarda fallback de erro nem respostas com o nome do paciente"""
+    if response == FALLBACK_RESPONSE:
+        return False
+    name = memory.patient_info.name
+    return not (name and re.search(rf"\b{re.escape(name)}\b", response, re.IGNORECASE))
+
+def reload_configuration() -> List[str]:
+    """Recarrega os arquivos alterados e invalida as respostas em cache afetadas"""
+    global FERNANDA_PROMPT, CLINIC_CONFIG, KNOWLEDGE_BASE, MESSAGE_MATCHER, PROMPT_BUILDER
+    
+    changed = CONFIG_VERSIONS.refresh()
+    if not changed:
+        return []
+    
+    if "persona" in changed:
+        FERNANDA_PROMPT = load_prompt()
+    if "config" in changed:
+        CLINIC_CONFIG = load_clinic_config()
+        SCHEDULE.set_business_hours(CLINIC_CONFIG.get("business_hours", {}))
+    if "kb" in changed:
+        KNOWLEDGE_BASE = load_knowledge_base()
+        MESSAGE_MATCHER = build_message_matcher()
+    PROMPT_BUILDER = build_prompt_builder()
+    
+    for source in changed:
+        RESPONSE_CACHE.invalidate(source)
+    print(f"🔄 Configuração recarregada: {', '.join(changed)}")
+    return changed
+
+# === Respostas por template ===
+TEMPLATE_ENGINE = TemplateEngine()
+ROUTE_STATS = RouteStats()
+
+# === Métricas (Prometheus em /metrics) ===
+METRICS = MetricsRegistry()
+METRICS.histogram("stage_seconds", "Tempo de cada etapa do turno")
+METRICS.histogram("turn_seconds", "Tempo do turno inteiro, por estado da conversa e caminho da resposta")
+METRICS.counter("llm_fallbacks_total", "Respostas de emergência no lugar do Gemini, por motivo")
+METRICS.counter("send_failures_total", "Mensagens que não foram entregues à Evolution API")
+METRICS.counter("cache_lookups_total", "Consultas ao cache de perguntas frequentes, por resultado")
+METRICS.counter("history_lookups_total", "Histórico do prompt lido da memória da conversa ou do banco")
+
+def template_slots(memory: ConversationMemory) -> Dict[str, Any]:
+    """Informações coletadas usadas para preencher os templates"""
+    day = memory.patient_info.preferred_date
+    try:
+        day = describe_day(day) if day else None
+    except ValueError:
+        pass
+    return {
+        "name": memory.patient_info.name,
+        "service": memory.patient_info.service_needed,
+        "date": day,
+        "time": memory.patient_info.preferred_time,
+    }
+
 # === Integração com Gemini ===
-async def get_ai_response(prompt: str, temperature: float = 0.7) -> str:
-    """Obtém resposta do Gemini com configurações otimizadas"""
+FALLBACK_RESPONSE = "Entendi! Me conta um pouco mais para eu poder ajudar você da melhor forma."
+
+# Configuração para respostas naturais e concisas
+GENERATION_CONFIG = {
+    "temperature": 0.7,
+    "top_p": 0.85,
+    "top_k": 40,
+    "max_output_tokens": 200,
+}
+
+# Modelo do Gemini (criado uma vez e reutilizado em todas as chamadas)
+GEMINI_MODEL = genai.GenerativeModel(
+    model_name="gemini-1.5-flash",
+    generation_config=GENERATION_CONFIG,
+    safety_settings={
+        "HARM_CATEGORY_HARASSMENT": "BLOCK_NONE",
+        "HARM_CATEGORY_HATE_SPEECH": "BLOCK_NONE",
+        "HARM_CATEGORY_SEXUALLY_EXPLICIT": "BLOCK_NONE",
+        "HARM_CATEGORY_DANGEROUS_CONTENT": "BLOCK_NONE",
+    }
+)
+
+# Prazo, limite de concorrência e circuit breaker em volta do modelo
+LLM_GOVERNOR = LLMGovernor(GEMINI_MODEL)
+RESPONSE_MAX_SENTENCES = 3
+
+async def stream_ai_response(prompt: str, generation_config: Dict[str, Any],
+                             on_first_sentence: Callable[[str], Awaitable]) -> str:
+    """Gera em streaming: a primeira frase sai assim que termina e a geração para na última"""
+    splitter = SentenceSplitter()
+    sentences: List[str] = []
+    first_delivery: Optional[asyncio.Task] = None
+    
+    async def on_text(text: str) -> bool:
+        nonlocal first_delivery
+        sentences.extend(splitter.feed(text))
+        if sentences and first_delivery is None:
+            first_delivery = asyncio.create_task(on_first_sentence(sentences[0]))
+        return len(sentences) < RESPONSE_MAX_SENTENCES
+    
+    try:
+        await LLM_GOVERNOR.stream(prompt, on_text, generation_config=generation_config)
+        rest = splitter.flush()
+        if rest:
+            sentences.append(rest)
+    except Exception as e:
+        # A primeira frase já foi enviada: fica com o que chegou
+        if not sentences:
+            raise
+        print(f"Stream do Gemini interrompido após {len(sentences)} frase(s): {e!r}")
+    finally:
+        if first_delivery:
+            await first_delivery
+    
+    return " ".join(sentences[:RESPONSE_MAX_SENTENCES])
+
+async def get_ai_response(prompt: str, temperature: float = 0.7,
+                          on_first_sentence: Optional[Callable[[str], Awaitable]] = None,
+                          trace: Optional[TurnTrace] = None) -> str:
+    """
+    Obtém resposta do Gemini com configurações otimizadas.
+    
+    Com `on_first_sentence` (e LLM_STREAMING), a resposta vem em streaming e
+    a primeira frase é entregue ao callback antes de a geração terminar.
+    A estimativa de tokens vai para o `trace` do turno.
+    """
+    trace = trace or TurnTrace()
     try:
-        # Configuração para respostas naturais e concisas
-        generation_config = {
-            "temperature": temperature,
-            "top_p": 0.85,
-            "top_k": 40,
-            "max_output_tokens": 200,
-        }
-        
-        # Modelo do Gemini
-        model = genai.GenerativeModel(
-            model_name="gemini-1.5-flash",
-            generation_config=generation_config,
-            safety_settings={
-                "HARM_CATEGORY_HARASSMENT": "BLOCK_NONE",
-                "HARM_CATEGORY_HATE_SPEECH": "BLOCK_NONE",
-                "HARM_CATEGORY_SEXUALLY_EXPLICIT": "BLOCK_NONE",
-                "HARM_CATEGORY_DANGEROUS_CONTENT": "BLOCK_NONE",
-            }
-        )
-        
         # Gerar resposta
-        response = await asyncio.to_thread(
-            model.generate_content,
-            prompt
-        )
+        started = time.monotonic()
+        generation_config = {**GENERATION_CONFIG, "temperature": temperature}
+        if on_first_sentence and LLM_STREAMING:
+            text = await stream_ai_response(prompt, generation_config, on_first_sentence)
+        else:
+            response = await LLM_GOVERNOR.generate(prompt, generation_config=generation_config)
+            
+            # Extrair texto
+            text = response.text.strip()
+            
+            # Garantir que não seja muito longo
+            sentences = text.split('. ')
+            if len(sentences) > RESPONSE_MAX_SENTENCES:
+                text = '. '.join(sentences[:RESPONSE_MAX_SENTENCES]) + '.'
         
-        # Extrair texto
-        text = response.text.strip()
+        RESPONSE_CACHE.record_llm_latency(time.monotonic() - started)
         
-        # Garantir que não seja muito longo
-        sentences = text.split('. ')
-        if len(sentences) > 3:
-            text = '. '.join(sentences[:3]) + '.'
+        # Contabilidade de tokens (estimativa)
+        input_tokens, output_tokens = estimate_tokens(prompt), estimate_tokens(text)
+        TOKEN_STATS.record_call(input_tokens, output_tokens)
+        trace.tag(input_tokens=input_tokens, output_tokens=output_tokens)
         
-        return text
+        if not text:
+            METRICS.inc("llm_fallbacks_total", reason="empty")
+        return text or FALLBACK_RESPONSE
         
+    except CircuitOpenError:
+        # Gemini fora do ar: responde na hora em vez de esperar o prazo
+        METRICS.inc("llm_fallbacks_total", reason="circuit_open")
+        return FALLBACK_RESPONSE
+    except asyncio.TimeoutError:
+        print(f"Gemini excedeu {LLM_GOVERNOR.timeout:.0f}s")
+        METRICS.inc("llm_fallbacks_total", reason="timeout")
+        return FALLBACK_RESPONSE
     except Exception as e:
         print(f"Erro no Gemini: {e}")
+        METRICS.inc("llm_fallbacks_total", reason="error")
         # Fallback emergencial
-        return "Entendi! Me conta um pouco mais para eu poder ajudar você da melhor forma."
+        return FALLBACK_RESPONSE
 
 # === Evolution API (WhatsApp) ===
-async def send_whatsapp_message(phone: str, text: str):
-    """Envia mensagem via Evolution API"""
+evolution = EvolutionClient(EVOLUTION_BASE_URL, EVOLUTION_API_KEY, EVOLUTION_INSTANCE)
+
+async def send_whatsapp_message(phone: str, text: str) -> bool:
+    """Envia mensagem via Evolution API (fila com rate limit e retries)"""
     if RUN_MODE != "prod":
         print(f"[DEV MODE] WhatsApp para {phone}: {text}")
-        return
+        return True
     
     if not all([EVOLUTION_API_KEY, EVOLUTION_BASE_URL, EVOLUTION_INSTANCE]):
-        return
+        METRICS.inc("send_failures_total", reason="not_configured")
+        return False
     
-    url = f"{EVOLUTION_BASE_URL}/message/sendText/{EVOLUTION_INSTANCE}"
-    headers = {
-        "apikey": EVOLUTION_API_KEY,
-        "Content-Type": "application/json"
-    }
-    payload = {
-        "number": phone,
-        "text": text
-    }
-    
-    async with httpx.AsyncClient(timeout=15) as client:
-        try:
-            response = await client.post(url, headers=headers, json=payload)
-            print(f"WhatsApp enviado: {response.status_code}")
-        except Exception as e:
-            print(f"Erro ao enviar WhatsApp: {e}")
+    sent = await evolution.send_text(phone, text)
+    if not sent:
+        METRICS.inc("send_failures_total", reason="evolution")
+    return sent
 
 # === Processamento Principal ===
-async def process_message(phone: str, message: str) -> Dict[str, Any]:
+async def process_message(phone: str, message: str,
+                          on_first_sentence: Optional[Callable[[str], Awaitable]] = None,
+                          trace: Optional[TurnTrace] = None) -> Dict[str, Any]:
     """Processa uma mensagem e retorna a resposta"""
+    trace = trace or TurnTrace()
     
-    # Obter ou criar memória da conversa
-    if phone not in active_conversations:
-        active_conversations[phone] = ConversationMemory(phone)
-    
-    memory = active_conversations[phone]
+    # Trava o telefone entre os workers, carrega o estado e grava ao final
+    started = time.perf_counter()
+    async with conversations.session(phone) as memory:
+        trace.add("session", time.perf_counter() - started)
+        return await process_turn(memory, message, on_first_sentence, trace)
+
+async def process_turn(memory: ConversationMemory, message: str,
+                       on_first_sentence: Optional[Callable[[str], Awaitable]] = None,
+                       trace: Optional[TurnTrace] = None) -> Dict[str, Any]:
+    """Responde uma mensagem com a conversa já carregada (e travada)"""
+    trace = trace or TurnTrace()
+    phone = memory.phone
     memory.message_count += 1
     memory.last_activity = datetime.now()
+    # O histograma do turno é por estado em que a mensagem chegou
+    trace.tag(state=memory.state.value)
     
     # Obter ou criar paciente no banco
     if not memory.patient_id:
-        memory.patient_id = get_or_create_patient(phone, memory.patient_info.name)
+        with trace.span("patient"):
+            memory.patient_id = await get_or_create_patient(phone, memory.patient_info.name)
     
     # Atualizar issue atual
     if not memory.patient_info.current_issue:
         memory.patient_info.current_issue = message[:200]
     
-    # Construir prompt inteligente
-    prompt = build_intelligent_prompt(memory, message)
+    started = time.monotonic()
+    
+    with trace.span("route"):
+        # Turno previsível (confirmação, agradecimento): resposta por template
+        template_state = "awaiting_slot" if memory.context_data.get('awaiting_slot') else memory.state.value
+        templated = TEMPLATE_ENGINE.render(template_state, message, template_slots(memory))
+        
+        # Pergunta frequente já respondida: sem chamar o Gemini
+        cache_key = faq_cache_key(memory, message) if not templated else None
+        ai_response = RESPONSE_CACHE.get(cache_key) if cache_key else None
+    if cache_key:
+        METRICS.inc("cache_lookups_total", result="miss" if ai_response is None else "hit")
+    
+    if templated:
+        route = f"template:{templated[0]}"
+        ai_response = templated[1]
+        with trace.span("extract"):
+            apply_extracted_info(memory, message)
+    elif ai_response is not None:
+        route = "cache"
+        with trace.span("extract"):
+            apply_extracted_info(memory, message)
+    else:
+        route = "llm"
+        # Construir prompt inteligente
+        prompt = await build_intelligent_prompt(memory, message, trace)
+        
+        # Turno que pode terminar em reserva (CONFIRMING -> COMPLETED): nada sai
+        # antes de saber se ela deu certo, senão o paciente lê uma confirmação e
+        # logo depois o aviso de que não havia horário
+        may_book = (memory.state in (ConversationState.CONFIRMING, ConversationState.COMPLETED)
+                    and not memory.context_data.get('appointment_id'))
+        
+        # Obter resposta da IA
+        with trace.span("llm"):
+            ai_response = await get_ai_response(prompt, on_first_sentence=None if may_book else on_first_sentence,
+                                                trace=trace)
+        if ai_response == FALLBACK_RESPONSE:
+            route = "fallback"
+        
+        if cache_key and is_cacheable_response(memory, ai_response):
+            RESPONSE_CACHE.put(cache_key, ai_response)
     
-    # Obter resposta da IA
-    ai_response = await get_ai_response(prompt)
+    ROUTE_STATS.record(route, time.monotonic() - started)
+    trace.tag(route=route)
     
     # Atualizar estado baseado no contexto
-    update_conversation_state(memory, message, ai_response)
+    with trace.span("state"):
+        update_conversation_state(memory, message, ai_response)
+    trace.tag(new_state=memory.state.value)
+    
+    # Se confirmou agendamento, reservar o horário e salvar (uma vez só por conversa)
+    booked = memory.state == ConversationState.COMPLETED and not memory.context_data.get('appointment_id')
+    if booked:
+        with trace.span("booking"):
+            appointment_id, reserved = await save_appointment(memory)
+        memory.context_data['appointment_id'] = appointment_id
+        if not reserved:
+            # Nada a confirmar: a equipe retorna com opções
+            ai_response = TEMPLATE_ENGINE.fill("no_slot", template_slots(memory))
+        elif templated:
+            # A confirmação cita o horário reservado de fato
+            ai_response = TEMPLATE_ENGINE.fill(templated[0], template_slots(memory))
     
     # Salvar no banco de dados
-    save_conversation_turn(
-        memory.patient_id,
-        message,
-        ai_response,
-        memory.state.value
-    )
+    with trace.span("db_write"):
+        turn = save_conversation_turn(
+            phone,
+            memory.patient_id,
+            message,
+            ai_response,
+            memory.state.value
+        )
+    memory.remember_turn(turn)
     
-    # Se confirmou agendamento, salvar
-    if memory.state == ConversationState.COMPLETED:
-        appointment_id = save_appointment(memory)
-        memory.context_data['appointment_id'] = appointment_id
-        
-        # Notificar admin se configurado
-        if ADMIN_WHATSAPP:
-            admin_msg = f"🎯 Novo agendamento confirmado!\n\n"
-            admin_msg += f"Paciente: {memory.patient_info.name}\n"
-            admin_msg += f"Telefone: {phone}\n"
-            admin_msg += f"Serviço: {memory.patient_info.service_needed}\n"
-            admin_msg += f"Urgência: {memory.patient_info.urgency_level}/10\n"
-            admin_msg += f"ID: #{appointment_id}"
+    # Notificar admin se configurado
+    if booked and ADMIN_WHATSAPP:
+        if reserved:
+            admin_msg = "🎯 Novo agendamento confirmado!\n\n"
+        else:
+            admin_msg = "⏳ Pedido de agendamento sem horário livre - retornar com opções\n\n"
+        admin_msg += f"Paciente: {memory.patient_info.name}\n"
+        admin_msg += f"Telefone: {phone}\n"
+        admin_msg += f"Serviço: {memory.patient_info.service_needed}\n"
+        if reserved:
+            admin_msg += f"Horário: {memory.patient_info.preferred_date} {memory.patient_info.preferred_time}\n"
+        admin_msg += f"Urgência: {memory.patient_info.urgency_level}/10\n"
+        admin_msg += f"ID: #{appointment_id}"
+        with trace.span("notify"):
             await send_whatsapp_message(ADMIN_WHATSAPP, admin_msg)
     
     return {
@@ -580,9 +811,54 @@ async def process_message(phone: str, message: str) -> Dict[str, Any]:
         "state": memory.state.value,
         "patient_id": memory.patient_id,
         "appointment_id": memory.context_data.get('appointment_id'),
-        "collected_info": memory.patient_info.dict()
+        "collected_info": memory.patient_info.to_dict()
     }
 
+FIRST_MESSAGE_LATENCY = LatencyWindow()
+LOOP_LAG = LoopLagMonitor()
+
+def mask_phone(phone: str) -> str:
+    """Telefone para logs: só os 4 últimos dígitos"""
+    return "*" * max(0, len(phone) - 4) + phone[-4:]
+
+async def handle_incoming_message(phone: str, message: str) -> Dict[str, Any]:
+    """Processa uma mensagem da fila e envia a resposta pelo WhatsApp"""
+    started = time.monotonic()
+    delivered: List[str] = []
+    trace = TurnTrace()
+    
+    async def send_first_sentence(sentence: str):
+        # Sai antes de o Gemini terminar o resto da resposta
+        delivered.append(sentence)
+        FIRST_MESSAGE_LATENCY.add(time.monotonic() - started)
+        trace.tag(first_message_ms=round((time.monotonic() - started) * 1000, 2))
+        await send_whatsapp_message(phone, sentence)
+    
+    try:
+        result = await process_message(phone, message, on_first_sentence=send_first_sentence, trace=trace)
+        
+        response = result["response"]
+        if delivered and response.startswith(delivered[0]):
+            response = response[len(delivered[0]):].strip()
+        else:
+            FIRST_MESSAGE_LATENCY.add(time.monotonic() - started)
+        if response:
+            with trace.span("send"):
+                await send_whatsapp_message(phone, response)
+        return result
+    except Exception as e:
+        # Turnos que falharam também aparecem no /metrics e no log
+        trace.tag(error=type(e).__name__)
+        if "route" not in trace.fields:
+            trace.tag(route="error")
+        raise
+    finally:
+        trace.tag(phone=mask_phone(phone))
+        trace.finish(METRICS)
+
+dispatcher = MessageDispatcher(handle_incoming_message)
+webhook_dedup = WebhookDeduplicator(db)
+
 def update_conversation_state(memory: ConversationMemory, user_msg: str, bot_response: str):
     """Atualiza o estado da conversa baseado no contexto"""
     msg_lower = user_msg.lower()
@@ -627,8 +903,7 @@ def update_conversation_state(memory: ConversationMemory, user_msg: str, bot_res
     
     elif memory.state == ConversationState.CONFIRMING:
         # Palavras de confirmação
-        confirm_words = ['sim', 'confirmo', 'pode ser', 'perfeito', 'ok', 'beleza', 'fechado']
-        if any(word in msg_lower for word in confirm_words):
+        if any(word in msg_lower for word in CONFIRM_WORDS):
             memory.state = ConversationState.COMPLETED
 
 # === Endpoints da API ===
@@ -647,36 +922,70 @@ async def health_check():
 @app.get("/api/status")
 async def system_status():
     """Status detalhado do sistema"""
-    conn = sqlite3.connect('data/fernanda.db')
-    cursor = conn.cursor()
-    
-    cursor.execute("SELECT COUNT(*) FROM patients")
-    total_patients = cursor.fetchone()[0]
-    
-    cursor.execute("SELECT COUNT(*) FROM appointments WHERE status = 'confirmed'")
-    total_appointments = cursor.fetchone()[0]
-    
-    cursor.execute("SELECT COUNT(*) FROM conversations")
-    total_messages = cursor.fetchone()[0]
-    
-    conn.close()
+    counts = await db.read(fernanda_db.fetch_system_counts)
     
     return {
         "status": "operational",
         "stats": {
-            "total_patients": total_patients,
-            "confirmed_appointments": total_appointments,
-            "total_messages": total_messages,
-            "active_conversations": len(active_conversations),
+            "total_patients": counts["total_patients"],
+            "confirmed_appointments": counts["confirmed_appointments"],
+            "total_messages": counts["total_messages"],
+            "active_conversations": await conversations.count(),
             "knowledge_base_services": len(KNOWLEDGE_BASE)
         },
+        "database": {"schema_version": SCHEMA_VERSION, **db.stats(), **write_queue.stats},
+        "event_loop": LOOP_LAG.stats(),
+        "queue": dispatcher.stats(),
+        "whatsapp": evolution.stats(),
+        "conversations": conversations.stats(),
+        "response_cache": RESPONSE_CACHE.stats(),
+        "routes": ROUTE_STATS.report(),
+        "llm": LLM_GOVERNOR.stats(),
+        "first_message": FIRST_MESSAGE_LATENCY.summary_ms("latency_ms"),
+        "analytics_reconcile": ANALYTICS_RECONCILE,
+        "exports": exporter.stats(),
+        "webhook_dedup": webhook_dedup.stats(),
+        "schedule": SCHEDULE.stats(),
         "ai_status": "active" if GOOGLE_API_KEY else "missing_api_key",
         "whatsapp_status": "configured" if EVOLUTION_API_KEY else "not_configured"
     }
 
+@app.get("/api/tokens")
+async def token_usage():
+    """Tamanho dos prompts e tokens estimados por chamada ao Gemini"""
+    return {
+        "budgets": PROMPT_BUILDER.budgets,
+        "knowledge_in_prefix": PROMPT_BUILDER.kb_fits,
+        **TOKEN_STATS.report()
+    }
+
+# Contadores que os componentes já mantêm, lidos só quando /metrics é consultado
+METRICS.collect("database", "Banco (tempo por thread e fila de escrita)",
+                lambda: {**db.stats(), **write_queue.stats})
+METRICS.collect("event_loop", "Atraso do event loop", LOOP_LAG.stats)
+METRICS.collect("queue", "Fila de mensagens (dispatcher)", lambda: dispatcher.stats())
+METRICS.collect("whatsapp", "Envios pela Evolution API", evolution.stats)
+METRICS.collect("llm", "Chamadas ao Gemini", LLM_GOVERNOR.stats)
+METRICS.collect("response_cache", "Cache de perguntas frequentes", RESPONSE_CACHE.stats)
+METRICS.collect("exports", "Exportações", lambda: exporter.stats())
+METRICS.collect("webhook_dedup", "Deduplicação do webhook", lambda: webhook_dedup.stats())
+METRICS.collect("schedule", "Agenda (consultas, reservas e conflitos)", SCHEDULE.stats)
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def prometheus_metrics():
+    """Métricas no formato texto do Prometheus"""
+    return PlainTextResponse(METRICS.render(), media_type="text/plain; version=0.0.4")
+
 @app.post("/webhook")
-async def webhook_handler(request: Request, x_webhook_token: Optional[str] = Header(None)):
-    """Webhook principal para receber mensagens"""
+async def webhook_handler(request: Request, x_webhook_token: Optional[str] = Header(None),
+                          wait: bool = False):
+    """
+    Webhook principal para receber mensagens.
+    
+    Valida o payload, enfileira e responde na hora; o processamento (IA +
+    envio) roda nos workers do dispatcher. Com ?wait=true a requisição espera
+    o resultado (usado pelo chat de demonstração).
+    """
     
     # Validação de token
     if WEBHOOK_TOKEN and x_webhook_token != WEBHOOK_TOKEN:
@@ -715,12 +1024,25 @@ async def webhook_handler(request: Request, x_webhook_token: Optional[str] = Hea
     if not phone or not message:
         return {"status": "ignored", "reason": "no_valid_message"}
     
-    # Processar mensagem
-    result = await process_message(phone, message)
-    
-    # Enviar resposta via WhatsApp
-    await send_whatsapp_message(phone, result["response"])
+    # Reentrega de uma mensagem já recebida: confirma sem processar de novo
+    key, ttl = message_key(data, phone, message)
+    if key and not await webhook_dedup.claim(key, ttl):
+        return {"status": "duplicate"}
     
+    # Enfileirar para os workers
+    try:
+        # Quem espera a resposta (?wait=true) não passa pela janela de rajada
+        future = dispatcher.submit(phone, message, immediate=wait)
+    except QueueFullError:
+        # A Evolution vai reenviar: a reentrega precisa passar
+        if key:
+            await webhook_dedup.release(key)
+        return JSONResponse({"status": "busy"}, status_code=503)
+    
+    if not wait:
+        return {"status": "queued"}
+    
+    result = await asyncio.shield(future)
     return {
         "status": "processed",
         "result": result
@@ -729,142 +1051,200 @@ async def webhook_handler(request: Request, x_webhook_token: Optional[str] = Hea
 @app.get("/api/patient/{phone}")
 async def get_patient_info(phone: str):
     """Obtém informações de um paciente"""
-    conn = sqlite3.connect('data/fernanda.db')
-    cursor = conn.cursor()
-    
-    cursor.execute("""
-        SELECT p.id, p.name, p.created_at,
-               COUNT(DISTINCT a.id) as total_appointments,
-               COUNT(DISTINCT c.id) as total_messages
-        FROM patients p
-        LEFT JOIN appointments a ON p.id = a.patient_id
-        LEFT JOIN conversations c ON p.id = c.patient_id
-        WHERE p.phone = ?
-        GROUP BY p.id
-    """, (phone,))
-    
-    result = cursor.fetchone()
-    conn.close()
-    
-    if not result:
+    pending = write_queue.pending_turns(phone)
+    profile = await db.read(fernanda_db.fetch_patient_profile, phone)
+    
+    if not profile:
         raise HTTPException(status_code=404, detail="Patient not found")
     
+    # Turnos ainda na fila de gravação entram no histórico e no total
+    stored = {(h["timestamp"], h["user"], h["bot"]) for h in profile["history"]}
+    unflushed = sum(1 for t in pending if (t["timestamp"], t["user"], t["bot"]) not in stored)
     return {
-        "id": result[0],
-        "name": result[1],
+        **profile,
         "phone": phone,
-        "created_at": result[2],
-        "total_appointments": result[3],
-        "total_messages": result[4],
-        "history": get_patient_history(phone)
+        "total_messages": profile["total_messages"] + unflushed,
+        "history": fernanda_db.merge_pending_history(profile["history"], pending)
     }
 
+@app.get("/api/slots")
+async def list_free_slots(service: Optional[str] = None, specialty: Optional[str] = None,
+                          count: int = 5, date_from: Optional[str] = None):
+    """Próximos horários livres para um serviço (duração da base de conhecimento)"""
+    found = KNOWLEDGE_BASE.by_name.get(service or "")
+    if service and not found:
+        raise HTTPException(status_code=404, detail=f"Serviço desconhecido: {service}")
+    if date_from:
+        listing_filters(date_from, None)
+    specialty = specialty or (found.specialty if found else "Clínica Geral")
+    duration = service_duration(service)
+    slots = SCHEDULE.free_slots(specialty, duration, max(1, min(count, 50)), from_day=date_from)
+    return {
+        "service": service,
+        "specialty": specialty,
+        "duration_min": duration,
+        "slots": [{"date": day, "time": time_, "label": f"{describe_day(day)} às {time_}"} for day, time_ in slots],
+    }
+
+# === Listagens e exportações ===
+exporter = Exporter(db)
+PAGE_MAX_LIMIT = 500
+
+def listing_filters(date_from: Optional[str], date_to: Optional[str], **equals: Optional[str]) -> Dict[str, Any]:
+    """Filtros das listagens/exportações (datas AAAA-MM-DD); 400 se inválidos"""
+    for value in (date_from, date_to):
+        if value:
+            try:
+                datetime.strptime(value, "%Y-%m-%d")
+            except ValueError:
+                raise HTTPException(status_code=400, detail=f"Data inválida: {value} (use AAAA-MM-DD)")
+    return {"date_from": date_from, "date_to": date_to, **equals}
+
+async def list_page(fetch_page: Callable, limit: int, cursor: Optional[str], filters: Dict[str, Any]):
+    """Uma página (mais recentes primeiro); o cursor da próxima vai no cabeçalho X-Next-Cursor"""
+    limit = max(1, min(limit, PAGE_MAX_LIMIT))
+    try:
+        after = decode_cursor(cursor) if cursor else None
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    rows = await db.read(fetch_page, limit, after, filters)
+    following = next_cursor(rows, limit)
+    return JSONResponse(rows, headers={"X-Next-Cursor": following} if following else None)
+
+def export_response(fetch_page: Callable, fields: List[str], filters: Dict[str, Any], fmt: str, name: str):
+    try:
+        stream = exporter.open(fetch_page, fields, filters, fmt)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except ExportBusyError:
+        return JSONResponse({"status": "busy"}, status_code=429)
+    # aclose devolve a vaga mesmo se o cliente desconectar antes do primeiro lote
+    return StreamingResponse(stream, media_type=EXPORT_FORMATS[fmt], headers={
+        "Content-Disposition": f'attachment; filename="{name}.{fmt}"'
+    }, background=BackgroundTask(stream.aclose))
+
 @app.get("/api/appointments")
-async def list_appointments(limit: int = 50):
-    """Lista agendamentos recentes"""
-    conn = sqlite3.connect('data/fernanda.db')
-    cursor = conn.cursor()
-    
-    cursor.execute("""
-        SELECT a.id, p.name, p.phone, a.service, a.specialty,
-               a.scheduled_date, a.scheduled_time, a.status, a.created_at
-        FROM appointments a
-        JOIN patients p ON a.patient_id = p.id
-        ORDER BY a.created_at DESC
-        LIMIT ?
-    """, (limit,))
-    
-    appointments = []
-    for row in cursor.fetchall():
-        appointments.append({
-            "id": row[0],
-            "patient_name": row[1],
-            "patient_phone": row[2],
-            "service": row[3],
-            "specialty": row[4],
-            "scheduled_date": row[5],
-            "scheduled_time": row[6],
-            "status": row[7],
-            "created_at": row[8]
-        })
-    
-    conn.close()
-    return appointments
+async def list_appointments(limit: int = 50, cursor: Optional[str] = None, date_from: Optional[str] = None,
+                            date_to: Optional[str] = None, status: Optional[str] = None,
+                            specialty: Optional[str] = None):
+    """Lista agendamentos recentes, paginados por cursor"""
+    filters = listing_filters(date_from, date_to, status=status, specialty=specialty)
+    return await list_page(fernanda_db.fetch_appointments, limit, cursor, filters)
+
+@app.get("/api/conversations")
+async def list_conversations(limit: int = 50, cursor: Optional[str] = None, date_from: Optional[str] = None,
+                             date_to: Optional[str] = None, state: Optional[str] = None,
+                             phone: Optional[str] = None):
+    """Lista interações recentes, paginadas por cursor"""
+    filters = listing_filters(date_from, date_to, state=state, phone=phone)
+    return await list_page(fernanda_db.fetch_conversations, limit, cursor, filters)
+
+@app.get("/api/export/appointments")
+async def export_appointments(format: str = "ndjson", date_from: Optional[str] = None,
+                              date_to: Optional[str] = None, status: Optional[str] = None,
+                              specialty: Optional[str] = None):
+    """Exporta agendamentos (NDJSON ou CSV) em ordem cronológica"""
+    filters = listing_filters(date_from, date_to, status=status, specialty=specialty)
+    return export_response(fernanda_db.fetch_appointments, fernanda_db.APPOINTMENT_FIELDS,
+                           filters, format, "agendamentos")
+
+@app.get("/api/export/conversations")
+async def export_conversations(format: str = "ndjson", date_from: Optional[str] = None,
+                               date_to: Optional[str] = None, state: Optional[str] = None,
+                               phone: Optional[str] = None):
+    """Exporta interações (NDJSON ou CSV) em ordem cronológica"""
+    filters = listing_filters(date_from, date_to, state=state, phone=phone)
+    return export_response(fernanda_db.fetch_conversations, fernanda_db.CONVERSATION_FIELDS,
+                           filters, format, "conversas")
 
 @app.get("/api/analytics")
-async def get_analytics():
-    """Analytics do sistema"""
-    conn = sqlite3.connect('data/fernanda.db')
-    cursor = conn.cursor()
-    
-    # Estatísticas gerais
-    cursor.execute("SELECT COUNT(*) FROM patients")
-    total_patients = cursor.fetchone()[0]
-    
-    cursor.execute("SELECT COUNT(*) FROM appointments")
-    total_appointments = cursor.fetchone()[0]
-    
-    cursor.execute("SELECT COUNT(*) FROM appointments WHERE status = 'confirmed'")
-    confirmed = cursor.fetchone()[0]
+async def get_analytics(days: int = 30):
+    """Analytics do sistema (agregados mantidos por trigger, sem varrer as tabelas)"""
+    stats = await db.read(fernanda_db.fetch_analytics)
+    daily = await db.read(fernanda_db.fetch_daily_rollups, max(1, min(days, 366)))
+    total_appointments = stats["total_appointments"]
+    confirmed = stats["confirmed"]
     
     # Taxa de conversão
     conversion_rate = (confirmed / total_appointments * 100) if total_appointments > 0 else 0
     
-    # Distribuição por especialidade
-    cursor.execute("""
-        SELECT specialty, COUNT(*) as count
-        FROM appointments
-        GROUP BY specialty
-        ORDER BY count DESC
-    """)
-    specialties = {row[0]: row[1] for row in cursor.fetchall()}
-    
-    # Distribuição por urgência
-    cursor.execute("""
-        SELECT urgency_level, COUNT(*) as count
-        FROM appointments
-        GROUP BY urgency_level
-        ORDER BY urgency_level DESC
-    """)
-    urgency_dist = {f"level_{row[0]}": row[1] for row in cursor.fetchall()}
-    
-    conn.close()
-    
     return {
         "overview": {
-            "total_patients": total_patients,
+            "total_patients": stats["total_patients"],
             "total_appointments": total_appointments,
             "confirmed_appointments": confirmed,
             "conversion_rate": f"{conversion_rate:.1f}%",
-            "active_conversations": len(active_conversations)
+            "active_conversations": await conversations.count()
         },
         "distributions": {
-            "by_specialty": specialties,
-            "by_urgency": urgency_dist
-        }
+            "by_specialty": stats["by_specialty"],
+            "by_urgency": stats["by_urgency"]
+        },
+        "daily": daily
     }
 
 @app.post("/api/reset/{phone}")
 async def reset_conversation(phone: str):
     """Reseta a conversa de um usuário"""
-    if phone in active_conversations:
-        del active_conversations[phone]
+    await conversations.reset(phone)
     return {"status": "reset", "phone": phone}
 
+# === Recarga de configuração ===
+async def watch_configuration():
+    """Verifica periodicamente se clinica_config.json, a base ou o prompt mudaram"""
+    while True:
+        await asyncio.sleep(CONFIG_RELOAD_INTERVAL)
+        try:
+            reload_configuration()
+        except Exception as e:
+            print(f"Erro ao recarregar configuração: {e}")
+
 # === Limpeza periódica ===
 async def cleanup_inactive_conversations():
-    """Remove conversas inativas da memória"""
+    """Remove conversas inativas da memória e do armazenamento compartilhado"""
     while True:
-        await asyncio.sleep(3600)  # A cada hora
-        cutoff = datetime.now() - timedelta(hours=6)
-        
-        to_remove = []
-        for phone, memory in active_conversations.items():
-            if memory.last_activity < cutoff:
-                to_remove.append(phone)
-        
-        for phone in to_remove:
-            del active_conversations[phone]
+        await asyncio.sleep(300)  # A cada 5 minutos
+        try:
+            await conversations.expire()
+        except Exception as e:
+            print(f"Erro ao expirar conversas: {e}")
+        try:
+            await webhook_dedup.expire()
+        except Exception as e:
+            print(f"Erro ao expirar mensagens vistas: {e}")
+
+async def refresh_schedule_periodically():
+    """Recarrega as reservas (feitas também por outros workers) no índice da agenda"""
+    while True:
+        await asyncio.sleep(SCHEDULE_REFRESH_INTERVAL)
+        try:
+            await refresh_schedule()
+        except Exception as e:
+            print(f"Erro ao recarregar a agenda: {e}")
+
+# === Conferência dos agregados ===
+ANALYTICS_RECONCILE: Dict[str, Any] = {"runs": 0, "last_drift": None, "last_run": None, "last_ms": None}
+
+async def reconcile_analytics() -> int:
+    """Recalcula os agregados a partir das tabelas e corrige as divergências"""
+    started = time.monotonic()
+    # A varredura pesada roda numa conexão de leitura; a escritora só aplica a diferença
+    snapshot, max_ids = await db.read(fernanda_db.fetch_rollup_snapshot)
+    drift = await db.write(fernanda_db.reconcile_rollups, snapshot, max_ids)
+    ANALYTICS_RECONCILE.update(runs=ANALYTICS_RECONCILE["runs"] + 1, last_drift=drift,
+                               last_run=datetime.now().isoformat(),
+                               last_ms=round((time.monotonic() - started) * 1000, 1))
+    if drift:
+        print(f"📊 Agregados corrigidos: {drift} divergência(s)")
+    return drift
+
+async def reconcile_analytics_periodically():
+    while True:
+        await asyncio.sleep(ANALYTICS_RECONCILE_INTERVAL)
+        try:
+            await reconcile_analytics()
+        except Exception as e:
+            print(f"Erro ao conferir agregados: {e}")
 
 @app.on_event("startup")
 async def startup_event():
@@ -874,10 +1254,27 @@ async def startup_event():
     print(f"✅ WhatsApp: {'Configurado' if EVOLUTION_API_KEY else '⚠️ Não configurado'}")
     print(f"✅ Modo: {RUN_MODE}")
     
-    # Iniciar tarefa de limpeza
+    # Iniciar gravação em lote e workers de mensagens
+    write_queue.start()
+    evolution.start()
+    dispatcher.start()
+    
+    # Agenda: reservas já feitas
+    await refresh_schedule()
+    
+    # Iniciar tarefas de limpeza e recarga de configuração
     asyncio.create_task(cleanup_inactive_conversations())
+    asyncio.create_task(watch_configuration())
+    asyncio.create_task(LOOP_LAG.run())
+    asyncio.create_task(reconcile_analytics_periodically())
+    asyncio.create_task(refresh_schedule_periodically())
 
 @app.on_event("shutdown")
 async def shutdown_event():
     """Desligamento do sistema"""
     print("👋 Fernanda IA desligando...")
+    await dispatcher.close()
+    await evolution.close()
+    await write_queue.close()
+    LLM_GOVERNOR.close()
+    db.close()
@@ -0,0 +1,134 @@
+"""
+Fernanda IA - Cache de Respostas
+Respostas de perguntas frequentes com TTL/LRU, versionadas pelos arquivos de configuração
+"""
+
+import os
+import time
+import hashlib
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Any, List, Optional, Tuple
+
+from fernanda_matcher import normalize_question
+
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "500"))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "21600"))  # 6 horas
+
+# Arquivo de origem de cada intenção: mudou o arquivo, a resposta é outra
+FAQ_SOURCES = {
+    "endereco": "config",
+    "horario": "config",
+    "servicos": "kb",
+}
+
+class SourceVersions:
+    """
+    Versão (hash do conteúdo) de cada arquivo de configuração.
+
+    refresh() só relê um arquivo quando mtime ou tamanho mudaram, então
+    pode ser chamado com frequência.
+    """
+
+    def __init__(self, paths: Dict[str, Path]):
+        self.paths = paths
+        self._stat: Dict[str, Optional[Tuple[int, int]]] = {}
+        self.versions: Dict[str, str] = {}
+        self.refresh()
+
+    @staticmethod
+    def _stat_of(path: Path) -> Optional[Tuple[int, int]]:
+        try:
+            st = path.stat()
+        except FileNotFoundError:
+            return None
+        return (st.st_mtime_ns, st.st_size)
+
+    def refresh(self) -> List[str]:
+        """Recalcula as versões e retorna as fontes que mudaram"""
+        changed = []
+        for source, path in self.paths.items():
+            stat = self._stat_of(path)
+            if source in self._stat and stat == self._stat[source]:
+                continue
+            self._stat[source] = stat
+            version = hashlib.sha1(path.read_bytes()).hexdigest()[:12] if stat else "default"
+            if self.versions.get(source) != version:
+                if source in self.versions:
+                    changed.append(source)
+                self.versions[source] = version
+        return changed
+
+
+class ResponseCache:
+    """
+    Cache LRU com TTL de respostas geradas para perguntas frequentes.
+
+    A chave é (intenção, pergunta normalizada, primeira mensagem?, versão
+    da fonte + versão da persona); invalidate() descarta as entradas de uma
+    fonte quando o arquivo correspondente muda.
+    """
+
+    def __init__(self, versions: SourceVersions, max_entries: int = RESPONSE_CACHE_SIZE,
+                 ttl: float = RESPONSE_CACHE_TTL):
+        self.versions = versions
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[Tuple, Tuple[float, str]]" = OrderedDict()
+        self._llm_seconds = 0.0
+        self._llm_calls = 0
+        self.counters = {"hits": 0, "misses": 0, "evictions": 0, "expired": 0, "invalidated": 0}
+        self.saved_seconds = 0.0
+
+    def key(self, intent: str, message: str, first_message: bool) -> Tuple:
+        source = FAQ_SOURCES.get(intent, "config")
+        version = f"{self.versions.versions.get(source)}:{self.versions.versions.get('persona')}"
+        return (intent, normalize_question(message), first_message, source, version)
+
+    def get(self, key: Tuple) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.counters["misses"] += 1
+            return None
+        stored_at, response = entry
+        if time.monotonic() - stored_at > self.ttl:
+            del self._entries[key]
+            self.counters["expired"] += 1
+            self.counters["misses"] += 1
+            return None
+        self._entries.move_to_end(key)
+        self.counters["hits"] += 1
+        self.saved_seconds += self.mean_llm_seconds()
+        return response
+
+    def put(self, key: Tuple, response: str):
+        self._entries[key] = (time.monotonic(), response)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.counters["evictions"] += 1
+
+    def invalidate(self, source: str):
+        """Remove as entradas que dependem da fonte (ou todas, se for a persona)"""
+        stale = [k for k in self._entries if source == "persona" or k[3] == source]
+        for k in stale:
+            del self._entries[k]
+        self.counters["invalidated"] += len(stale)
+
+    def record_llm_latency(self, seconds: float):
+        """Latência de uma chamada real ao modelo (base do tempo economizado)"""
+        self._llm_seconds += seconds
+        self._llm_calls += 1
+
+    def mean_llm_seconds(self) -> float:
+        return self._llm_seconds / self._llm_calls if self._llm_calls else 0.0
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.counters["hits"] + self.counters["misses"]
+        return {
+            "entries": len(self._entries),
+            "hit_ratio": round(self.counters["hits"] / lookups, 3) if lookups else 0.0,
+            "latency_saved_s": round(self.saved_seconds, 2),
+            "versions": dict(self.versions.versions),
+            **self.counters,
+        }
@@ -0,0 +1,99 @@
+"""
+Fernanda IA - Conversas Ativas
+Memória das conversas em RAM com limite de tamanho (LRU) e expiração por inatividade
+"""
+
+import os
+import time
+from collections import OrderedDict
+from typing import Dict, Any, Callable, Generic, Optional, Tuple, TypeVar
+
+CONVERSATION_MAX = int(os.getenv("CONVERSATION_MAX", "10000"))
+CONVERSATION_TTL = float(os.getenv("CONVERSATION_TTL", "21600"))  # 6 horas sem mensagens
+
+M = TypeVar("M")
+
+
+class ConversationStore(Generic[M]):
+    """
+    Conversas ativas por telefone, da menos para a mais recentemente usada.
+
+    Como a ordem de uso é também a ordem de inatividade, as conversas
+    expiradas estão sempre no início: cada acesso descarta as expiradas e,
+    acima de `max_entries`, as menos usadas, em O(1) amortizado, sem
+    varrer o dicionário.
+    """
+
+    def __init__(self, factory: Callable[[str], M], max_entries: int = CONVERSATION_MAX,
+                 ttl: float = CONVERSATION_TTL):
+        self.factory = factory
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, Tuple[float, M]]" = OrderedDict()
+        self.counters = {"created": 0, "hits": 0, "expired": 0, "evicted": 0, "removed": 0}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, phone: str) -> bool:
+        return phone in self._entries
+
+    def evict_expired(self) -> int:
+        """Descarta as conversas inativas há mais de `ttl` segundos"""
+        cutoff = time.monotonic() - self.ttl
+        evicted = 0
+        while self._entries:
+            touched, _ = next(iter(self._entries.values()))
+            if touched > cutoff:
+                break
+            self._entries.popitem(last=False)
+            evicted += 1
+        self.counters["expired"] += evicted
+        return evicted
+
+    def get(self, phone: str) -> Optional[M]:
+        """Conversa ativa (marcada como usada agora), ou None"""
+        self.evict_expired()
+        entry = self._entries.get(phone)
+        if entry is None:
+            return None
+        self._entries[phone] = (time.monotonic(), entry[1])
+        self._entries.move_to_end(phone)
+        self.counters["hits"] += 1
+        return entry[1]
+
+    def peek(self, phone: str) -> Optional[M]:
+        """Conversa em memória, sem marcar como usada nem contar acerto"""
+        entry = self._entries.get(phone)
+        return entry[1] if entry else None
+
+    def put(self, phone: str, memory: M):
+        """Guarda (ou substitui) a conversa como a mais recente"""
+        self._entries[phone] = (time.monotonic(), memory)
+        self._entries.move_to_end(phone)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.counters["evicted"] += 1
+
+    def get_or_create(self, phone: str) -> M:
+        memory = self.get(phone)
+        if memory is None:
+            memory = self.factory(phone)
+            self.put(phone, memory)
+            self.counters["created"] += 1
+        return memory
+
+    def pop(self, phone: str) -> Optional[M]:
+        entry = self._entries.pop(phone, None)
+        if entry is None:
+            return None
+        self.counters["removed"] += 1
+        return entry[1]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "size": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl_s": self.ttl,
+            **self.counters,
+        }
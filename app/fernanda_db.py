@@ -0,0 +1,1071 @@
+"""
+Fernanda IA - Camada de Dados
+Conexões SQLite persistentes (WAL), leituras em pool e um escritor dedicado
+"""
+
+import os
+import json
+import asyncio
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Dict, Any, List, Optional, Callable, Awaitable, Tuple
+
+from fernanda_metrics import LatencyWindow
+
+DB_PATH = os.getenv("DATABASE_PATH", "data/fernanda.db")
+DB_READERS = int(os.getenv("DB_READERS", "4"))
+DB_BATCH_SIZE = int(os.getenv("DB_BATCH_SIZE", "100"))
+DB_FLUSH_INTERVAL = float(os.getenv("DB_FLUSH_INTERVAL", "0.25"))
+# Novas tentativas de um lote após erro transitório (banco travado, E/S), com espera dobrando
+DB_BATCH_RETRIES = int(os.getenv("DB_BATCH_RETRIES", "3"))
+DB_RETRY_BACKOFF = float(os.getenv("DB_RETRY_BACKOFF", "0.1"))  # s
+
+
+def _connect(path: str) -> sqlite3.Connection:
+    """Abre uma conexão longa configurada para WAL"""
+    conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+class Database:
+    """
+    Acesso ao SQLite fora do event loop.
+
+    Leituras rodam em um pool de threads, cada uma com sua própria conexão;
+    escritas passam todas por uma única thread/conexão, o que serializa os
+    commits sem disputar o lock de escrita do arquivo.
+    """
+
+    def __init__(self, path: str = DB_PATH, readers: int = DB_READERS):
+        self.path = path
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._readers = ThreadPoolExecutor(max_workers=readers, thread_name_prefix="db-read")
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-write")
+        self._local = threading.local()
+        self._write_conn: Optional[sqlite3.Connection] = None
+        self._connections: List[sqlite3.Connection] = []
+        self._lock = threading.Lock()
+        # Tempo de execução no SQLite (na thread, sem a espera por uma conexão livre)
+        self._timings = {"read": LatencyWindow(), "write": LatencyWindow()}
+        self.counters = {"reads": 0, "writes": 0, "read_busy_s": 0.0, "write_busy_s": 0.0}
+
+    # --- Conexões ---
+    def _reader_connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = _connect(self.path)
+            conn.execute("PRAGMA query_only=ON")
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    def _writer_connection(self) -> sqlite3.Connection:
+        if self._write_conn is None:
+            self._write_conn = _connect(self.path)
+            with self._lock:
+                self._connections.append(self._write_conn)
+        return self._write_conn
+
+    # --- Execução ---
+    def _record(self, kind: str, started: float):
+        elapsed = time.perf_counter() - started
+        self._timings[kind].add(elapsed)
+        with self._lock:
+            self.counters[f"{kind}s"] += 1
+            self.counters[f"{kind}_busy_s"] += elapsed
+
+    def _run_read(self, fn: Callable, args: Tuple) -> Any:
+        started = time.perf_counter()
+        try:
+            return fn(self._reader_connection(), *args)
+        finally:
+            self._record("read", started)
+
+    def _run_write(self, fn: Callable, args: Tuple) -> Any:
+        conn = self._writer_connection()
+        started = time.perf_counter()
+        try:
+            result = fn(conn, *args)
+            conn.commit()
+            return result
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            self._record("write", started)
+
+    async def read(self, fn: Callable, *args) -> Any:
+        """Executa fn(conn, *args) em uma conexão de leitura do pool"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._readers, self._run_read, fn, args)
+
+    async def write(self, fn: Callable, *args) -> Any:
+        """Executa fn(conn, *args) na thread escritora e faz commit"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._writer, self._run_write, fn, args)
+
+    def write_sync(self, fn: Callable, *args) -> Any:
+        """Versão bloqueante de write (inicialização, fora do event loop)"""
+        return self._writer.submit(self._run_write, fn, args).result()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **self._timings["read"].summary_ms("read_ms"),
+            **self._timings["write"].summary_ms("write_ms"),
+            **{name: round(value, 3) if isinstance(value, float) else value
+               for name, value in self.counters.items()},
+        }
+
+    def close(self):
+        """Aguarda operações pendentes e fecha todas as conexões"""
+        self._readers.shutdown(wait=True)
+        self._writer.shutdown(wait=True)
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+        self._write_conn = None
+
+
+class WriteBehindQueue:
+    """
+    Buffer assíncrono de inserts (group commit).
+
+    Turnos de conversa e agendamentos entram em uma fila em memória e são
+    gravados em uma única transação quando o lote enche (DB_BATCH_SIZE) ou
+    quando a janela de DB_FLUSH_INTERVAL segundos expira. Turnos ainda não
+    gravados continuam visíveis via pending_turns() para leitura do histórico.
+
+    Um lote que falha por erro transitório (sqlite3.OperationalError) é
+    repetido até `retries` vezes com espera crescente; se ainda falhar, ou se
+    o erro for de outro tipo (ex.: integridade), as linhas são gravadas uma a
+    uma, e só as que falharem sozinhas são perdidas: o future delas recebe o
+    erro e on_turns_failed recebe os telefones dos turnos perdidos.
+    """
+
+    def __init__(self, db: Database, max_batch: int = DB_BATCH_SIZE,
+                 max_delay: float = DB_FLUSH_INTERVAL, retries: int = DB_BATCH_RETRIES,
+                 backoff: float = DB_RETRY_BACKOFF):
+        self.db = db
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.retries = retries
+        self.backoff = backoff
+        self._pending: List[Tuple[str, Tuple, Optional[asyncio.Future]]] = []
+        # Turnos enfileirados ou em gravação, por telefone
+        self._unflushed: Dict[str, List[Dict[str, Any]]] = {}
+        self._has_pending = asyncio.Event()
+        self._batch_full = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._closing = False
+        self.on_turns_failed: Optional[Callable[[List[str]], Awaitable[None]]] = None
+        self.stats = {"rows_written": 0, "commits": 0, "retries": 0, "failed_batches": 0, "failed_rows": 0}
+
+    def start(self):
+        """Inicia a tarefa de gravação em segundo plano"""
+        if self._task is None:
+            self._closing = False
+            self._task = asyncio.create_task(self._run())
+
+    def _enqueue(self, kind: str, params: Tuple, future: Optional[asyncio.Future] = None):
+        self._pending.append((kind, params, future))
+        self._has_pending.set()
+        if len(self._pending) >= self.max_batch:
+            self._batch_full.set()
+
+    def submit_turn(self, phone: str, patient_id: int, user_msg: str, bot_msg: str, state: str) -> Dict[str, Any]:
+        """Enfileira uma interação do histórico (não espera gravação) e a devolve como no histórico"""
+        timestamp = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+        turn = {"user": user_msg[:500], "bot": bot_msg[:500], "timestamp": timestamp, "state": state}
+        self._unflushed.setdefault(phone, []).append(turn)
+        self._enqueue("turn", (phone, patient_id, turn["user"], turn["bot"], state, timestamp))
+        return turn
+
+    def submit_appointment(self, appointment: Tuple) -> "asyncio.Future[int]":
+        """Enfileira um agendamento; o future resolve com o id após o commit"""
+        future = asyncio.get_running_loop().create_future()
+        self._enqueue("appointment", appointment, future)
+        return future
+
+    def pending_turns(self, phone: str) -> List[Dict[str, Any]]:
+        """Turnos do telefone que ainda não foram confirmados no banco"""
+        return list(self._unflushed.get(phone, ()))
+
+    async def _run(self):
+        while True:
+            await self._has_pending.wait()
+            if not self._closing:
+                try:
+                    await asyncio.wait_for(self._batch_full.wait(), self.max_delay)
+                except asyncio.TimeoutError:
+                    pass
+            await self.flush()
+            if self._closing and not self._pending:
+                return
+
+    async def flush(self):
+        """Grava tudo que está pendente em uma única transação"""
+        batch, self._pending = self._pending, []
+        self._has_pending.clear()
+        self._batch_full.clear()
+        if not batch:
+            return
+
+        try:
+            row_ids = await self._write_batch(batch)
+        except Exception as e:
+            print(f"Erro ao gravar lote no banco ({len(batch)} linhas), gravando linha a linha: {e}")
+            self.stats["failed_batches"] += 1
+            await self._write_rows(batch)
+        else:
+            self.stats["rows_written"] += len(batch)
+            self.stats["commits"] += 1
+            for (_, _, future), row_id in zip(batch, row_ids):
+                if future is not None and not future.done():
+                    future.set_result(row_id)
+
+        # Liberar os turnos gravados (ou descartados) da visão pendente
+        for kind, params, _ in batch:
+            if kind != "turn":
+                continue
+            phone = params[0]
+            turns = self._unflushed.get(phone)
+            if turns:
+                turns.pop(0)
+                if not turns:
+                    del self._unflushed[phone]
+
+    async def _write_batch(self, batch: List[Tuple[str, Tuple, Optional[asyncio.Future]]]) -> List[int]:
+        """Uma transação para o lote todo, repetida se o erro for transitório"""
+        ops = [(kind, params) for kind, params, _ in batch]
+        delay = self.backoff
+        for attempt in range(self.retries + 1):
+            try:
+                return await self.db.write(_apply_batch, ops)
+            except sqlite3.OperationalError:
+                if attempt == self.retries:
+                    raise
+                self.stats["retries"] += 1
+                await asyncio.sleep(delay)
+                delay *= 2
+
+    async def _write_rows(self, batch: List[Tuple[str, Tuple, Optional[asyncio.Future]]]):
+        """Grava cada linha na sua própria transação; só as que falham são perdidas"""
+        lost = set()
+        for kind, params, future in batch:
+            try:
+                row_id = (await self._write_batch([(kind, params, future)]))[0]
+            except Exception as e:
+                print(f"Erro ao gravar {kind} no banco: {e}")
+                self.stats["failed_rows"] += 1
+                if future is not None and not future.done():
+                    future.set_exception(e)
+                if kind == "turn":
+                    lost.add(params[0])
+            else:
+                self.stats["rows_written"] += 1
+                self.stats["commits"] += 1
+                if future is not None and not future.done():
+                    future.set_result(row_id)
+        if lost and self.on_turns_failed is not None:
+            await self.on_turns_failed(sorted(lost))
+
+    async def close(self):
+        """Drena a fila e encerra a tarefa de gravação"""
+        self._closing = True
+        self._has_pending.set()
+        if self._task is not None:
+            await self._task
+            self._task = None
+        await self.flush()
+
+
+def _apply_batch(conn: sqlite3.Connection, ops: List[Tuple[str, Tuple]]) -> List[int]:
+    """Aplica um lote de inserts (roda na thread escritora, um commit só)"""
+    row_ids = []
+    for kind, params in ops:
+        if kind == "turn":
+            row_ids.append(insert_conversation_turn(conn, *params[1:]))
+        else:
+            row_ids.append(insert_appointment(conn, params))
+    return row_ids
+
+
+def merge_pending_history(history: List[Dict[str, Any]], pending: List[Dict[str, Any]],
+                          limit: int = 10) -> List[Dict[str, Any]]:
+    """Junta o histórico lido do banco com turnos ainda não gravados"""
+    if not pending:
+        return history
+    seen = {(h["timestamp"], h["user"], h["bot"]) for h in history}
+    merged = history + [t for t in pending if (t["timestamp"], t["user"], t["bot"]) not in seen]
+    merged.sort(key=lambda h: h["timestamp"] or "")
+    return merged[-limit:]
+
+
+# === Esquema ===
+def init_schema(conn: sqlite3.Connection):
+    """Cria as tabelas do sistema"""
+    cursor = conn.cursor()
+
+    # Tabela de pacientes
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS patients (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            phone TEXT UNIQUE NOT NULL,
+            name TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # Tabela de agendamentos
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS appointments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            patient_id INTEGER NOT NULL,
+            service TEXT NOT NULL,
+            specialty TEXT,
+            urgency_level INTEGER DEFAULT 0,
+            scheduled_date TEXT,
+            scheduled_time TEXT,
+            status TEXT DEFAULT 'pending',
+            notes TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            confirmed_at TIMESTAMP,
+            FOREIGN KEY (patient_id) REFERENCES patients (id)
+        )
+    ''')
+
+    # Tabela de conversas (histórico)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS conversations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            patient_id INTEGER,
+            user_message TEXT NOT NULL,
+            bot_response TEXT NOT NULL,
+            intent TEXT,
+            state TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (patient_id) REFERENCES patients (id)
+        )
+    ''')
+
+    # Estado das conversas em andamento, compartilhado entre os workers
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS conversation_state (
+            phone TEXT PRIMARY KEY,
+            version INTEGER NOT NULL,
+            data TEXT NOT NULL,
+            updated_at REAL NOT NULL
+        )
+    ''')
+
+    # Trava por telefone (com prazo, para não ficar presa se o worker morrer)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS conversation_locks (
+            phone TEXT PRIMARY KEY,
+            owner TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        )
+    ''')
+
+
+def create_hot_path_indexes(conn: sqlite3.Connection):
+    """Índices das consultas frequentes (histórico, listagens, contagens)"""
+    # Histórico do paciente já sai ordenado (o rowid desempata created_at)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_conversations_patient_created "
+                 "ON conversations (patient_id, created_at)")
+    # /api/appointments e contagens por status / por paciente
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_appointments_created ON appointments (created_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_appointments_status ON appointments (status)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_appointments_patient ON appointments (patient_id)")
+    # Expiração e contagem de conversas ativas
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_conversation_state_updated "
+                 "ON conversation_state (updated_at)")
+
+
+# Agregados mantidos por triggers: um bucket por dia e o total ('*').
+# Especialidade e urgência só têm o total.
+_ROLLUP_ADD = "ON CONFLICT (day, metric, dimension) DO UPDATE SET value = value + excluded.value"
+ROLLUP_TRIGGERS = [
+    f"""
+    CREATE TRIGGER IF NOT EXISTS rollup_patients_insert AFTER INSERT ON patients
+    BEGIN
+        INSERT INTO stats_rollup (day, metric, dimension, value)
+        VALUES ('*', 'patients', '', 1), (date(NEW.created_at), 'patients', '', 1)
+        {_ROLLUP_ADD};
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS rollup_conversations_insert AFTER INSERT ON conversations
+    BEGIN
+        INSERT INTO stats_rollup (day, metric, dimension, value)
+        VALUES ('*', 'messages', '', 1), (date(NEW.created_at), 'messages', '', 1)
+        {_ROLLUP_ADD};
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS rollup_appointments_insert AFTER INSERT ON appointments
+    BEGIN
+        INSERT INTO stats_rollup (day, metric, dimension, value)
+        VALUES ('*', 'appointments', '', 1), (date(NEW.created_at), 'appointments', '', 1),
+               ('*', 'specialty', COALESCE(NEW.specialty, ''), 1),
+               ('*', 'urgency', CAST(COALESCE(NEW.urgency_level, 0) AS TEXT), 1)
+        {_ROLLUP_ADD};
+        INSERT INTO stats_rollup (day, metric, dimension, value)
+        SELECT d, 'confirmed', '', 1 FROM (SELECT '*' AS d UNION ALL SELECT date(NEW.created_at))
+        WHERE NEW.status = 'confirmed'
+        {_ROLLUP_ADD};
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS rollup_appointments_status AFTER UPDATE OF status ON appointments
+    WHEN (COALESCE(OLD.status, '') = 'confirmed') != (COALESCE(NEW.status, '') = 'confirmed')
+    BEGIN
+        INSERT INTO stats_rollup (day, metric, dimension, value)
+        SELECT d, 'confirmed', '', CASE WHEN NEW.status = 'confirmed' THEN 1 ELSE -1 END
+        FROM (SELECT '*' AS d UNION ALL SELECT date(NEW.created_at))
+        WHERE 1
+        {_ROLLUP_ADD};
+    END
+    """,
+]
+
+# Mesmos agregados calculados das tabelas (linhas com id > ?), para a reconciliação
+ROLLUP_QUERIES = [
+    ("patients", "SELECT date(created_at), 'patients', '', COUNT(*) FROM patients WHERE id > ? GROUP BY 1"),
+    ("conversations", "SELECT date(created_at), 'messages', '', COUNT(*) FROM conversations WHERE id > ? GROUP BY 1"),
+    ("appointments", "SELECT date(created_at), 'appointments', '', COUNT(*) FROM appointments WHERE id > ? GROUP BY 1"),
+    ("appointments", "SELECT date(created_at), 'confirmed', '', COUNT(*) FROM appointments "
+                     "WHERE id > ? AND status = 'confirmed' GROUP BY 1"),
+    ("appointments", "SELECT '*', 'specialty', COALESCE(specialty, ''), COUNT(*) FROM appointments "
+                     "WHERE id > ? GROUP BY 3"),
+    ("appointments", "SELECT '*', 'urgency', CAST(COALESCE(urgency_level, 0) AS TEXT), COUNT(*) FROM appointments "
+                     "WHERE id > ? GROUP BY 3"),
+]
+ROLLUP_TABLES = ("patients", "conversations", "appointments")
+RollupKey = Tuple[str, str, str]
+
+
+def compute_rollups(conn: sqlite3.Connection, after: Optional[Dict[str, int]] = None) -> Dict[RollupKey, int]:
+    """Agregados das linhas com id maior que `after[tabela]` (todas, por padrão)"""
+    after = after or {}
+    rollups: Dict[RollupKey, int] = {}
+    for table, sql in ROLLUP_QUERIES:
+        for day, metric, dimension, value in conn.execute(sql, (after.get(table, 0),)):
+            rollups[(day, metric, dimension)] = value
+            if day != "*":
+                total = ("*", metric, dimension)
+                rollups[total] = rollups.get(total, 0) + value
+    return rollups
+
+
+def _max_ids(conn: sqlite3.Connection) -> Dict[str, int]:
+    return {table: conn.execute(f"SELECT COALESCE(MAX(id), 0) FROM {table}").fetchone()[0]
+            for table in ROLLUP_TABLES}
+
+
+def fetch_rollup_snapshot(conn: sqlite3.Connection) -> Tuple[Dict[RollupKey, int], Dict[str, int]]:
+    """Agregados recalculados e o maior id de cada tabela, no mesmo snapshot (conexão de leitura)"""
+    conn.execute("BEGIN")
+    try:
+        return compute_rollups(conn), _max_ids(conn)
+    finally:
+        conn.commit()
+
+
+def reconcile_rollups(conn: sqlite3.Connection, snapshot: Dict[RollupKey, int],
+                      max_ids: Dict[str, int]) -> int:
+    """
+    Corrige stats_rollup (thread escritora): soma ao snapshot o que entrou
+    depois dele, grava só as chaves divergentes e retorna quantas eram.
+    """
+    expected = dict(snapshot)
+    for key, value in compute_rollups(conn, max_ids).items():
+        expected[key] = expected.get(key, 0) + value
+    current = {(day, metric, dimension): value for day, metric, dimension, value
+               in conn.execute("SELECT day, metric, dimension, value FROM stats_rollup")}
+    drift = [key for key in expected.keys() | current.keys() if expected.get(key, 0) != current.get(key, 0)]
+    conn.executemany(
+        "INSERT INTO stats_rollup (day, metric, dimension, value) VALUES (?, ?, ?, ?) "
+        "ON CONFLICT (day, metric, dimension) DO UPDATE SET value = excluded.value",
+        [(*key, expected.get(key, 0)) for key in drift]
+    )
+    return len(drift)
+
+
+def create_rollups(conn: sqlite3.Connection):
+    """Tabela de agregados, triggers que a mantêm e a carga inicial"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS stats_rollup (
+            day TEXT NOT NULL,
+            metric TEXT NOT NULL,
+            dimension TEXT NOT NULL DEFAULT '',
+            value INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, metric, dimension)
+        ) WITHOUT ROWID
+    ''')
+    for trigger in ROLLUP_TRIGGERS:
+        conn.execute(trigger)
+    reconcile_rollups(conn, compute_rollups(conn), _max_ids(conn))
+
+
+# Perfil por paciente mantido por triggers, com as últimas interações em JSON
+PATIENT_HISTORY_WINDOW = 10
+_HISTORY_ENTRY = ("json_object('user', {0}.user_message, 'bot', {0}.bot_response, "
+                  "'timestamp', {0}.created_at, 'state', {0}.state)")
+PROFILE_TRIGGERS = [
+    """
+    CREATE TRIGGER IF NOT EXISTS profile_patients_insert AFTER INSERT ON patients
+    BEGIN
+        INSERT OR IGNORE INTO patient_profiles (patient_id) VALUES (NEW.id);
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS profile_conversations_insert AFTER INSERT ON conversations
+    BEGIN
+        UPDATE patient_profiles SET
+            total_messages = total_messages + 1,
+            last_message_at = NEW.created_at,
+            last_state = NEW.state,
+            recent_history = (
+                SELECT CASE WHEN json_array_length(h) > {PATIENT_HISTORY_WINDOW} THEN json_remove(h, '$[0]') ELSE h END
+                FROM (SELECT json_insert(recent_history, '$[#]', {_HISTORY_ENTRY.format("NEW")}) AS h)
+            )
+        WHERE patient_id = NEW.patient_id;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS profile_appointments_insert AFTER INSERT ON appointments
+    BEGIN
+        UPDATE patient_profiles SET
+            total_appointments = total_appointments + 1,
+            last_appointment_at = NEW.created_at,
+            last_service = NEW.service,
+            last_visit_date = NEW.scheduled_date,
+            last_visit_time = NEW.scheduled_time
+        WHERE patient_id = NEW.patient_id;
+    END
+    """,
+]
+
+
+def rebuild_patient_profiles(conn: sqlite3.Connection):
+    """Recalcula todos os perfis a partir das tabelas (índices por patient_id)"""
+    conn.execute(f'''
+        INSERT OR REPLACE INTO patient_profiles (
+            patient_id, total_messages, total_appointments, last_message_at, last_state,
+            last_appointment_at, last_service, last_visit_date, last_visit_time, recent_history
+        )
+        SELECT p.id,
+               (SELECT COUNT(*) FROM conversations WHERE patient_id = p.id),
+               (SELECT COUNT(*) FROM appointments WHERE patient_id = p.id),
+               last_c.created_at, last_c.state,
+               last_a.created_at, last_a.service, last_a.scheduled_date, last_a.scheduled_time,
+               (SELECT json_group_array(json(entry)) FROM (
+                    SELECT entry FROM (
+                        SELECT {_HISTORY_ENTRY.format("c")} AS entry, c.created_at, c.id
+                        FROM conversations c WHERE c.patient_id = p.id
+                        ORDER BY c.created_at DESC, c.id DESC LIMIT {PATIENT_HISTORY_WINDOW}
+                    ) ORDER BY created_at, id
+               ))
+        FROM patients p
+        LEFT JOIN conversations last_c ON last_c.id = (
+            SELECT id FROM conversations WHERE patient_id = p.id ORDER BY created_at DESC, id DESC LIMIT 1)
+        LEFT JOIN appointments last_a ON last_a.id = (
+            SELECT id FROM appointments WHERE patient_id = p.id ORDER BY created_at DESC, id DESC LIMIT 1)
+    ''')
+
+
+def create_patient_profiles(conn: sqlite3.Connection):
+    """Tabela de perfis, triggers que a mantêm e a carga inicial"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS patient_profiles (
+            patient_id INTEGER PRIMARY KEY,
+            total_messages INTEGER NOT NULL DEFAULT 0,
+            total_appointments INTEGER NOT NULL DEFAULT 0,
+            last_message_at TIMESTAMP,
+            last_state TEXT,
+            last_appointment_at TIMESTAMP,
+            last_service TEXT,
+            last_visit_date TEXT,
+            last_visit_time TEXT,
+            recent_history TEXT NOT NULL DEFAULT '[]',
+            FOREIGN KEY (patient_id) REFERENCES patients (id)
+        )
+    ''')
+    for trigger in PROFILE_TRIGGERS:
+        conn.execute(trigger)
+    rebuild_patient_profiles(conn)
+
+
+def create_export_indexes(conn: sqlite3.Connection):
+    """Paginação e exportação de conversas por período"""
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_conversations_created ON conversations (created_at)")
+
+
+def create_webhook_dedup(conn: sqlite3.Connection):
+    """Mensagens recebidas recentemente (reentregas do webhook são descartadas)"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS webhook_seen (
+            key TEXT PRIMARY KEY,
+            expires_at REAL NOT NULL
+        ) WITHOUT ROWID
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_webhook_seen_expires ON webhook_seen (expires_at)")
+
+
+def create_appointment_slots(conn: sqlite3.Connection):
+    """Horários ocupados da agenda: uma linha por unidade de tempo, única por especialidade"""
+    # A chave primária é a garantia contra reserva dupla (vale entre workers);
+    # agendamentos antigos não têm data/horário gravados, então não há o que copiar
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS appointment_slots (
+            specialty TEXT NOT NULL,
+            day TEXT NOT NULL,
+            minute INTEGER NOT NULL,
+            appointment_id INTEGER NOT NULL,
+            PRIMARY KEY (specialty, day, minute)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_appointment_slots_appointment ON appointment_slots (appointment_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_appointment_slots_day ON appointment_slots (day)")
+    # Cancelar libera o horário
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_appointment_slots_cancel
+        AFTER UPDATE OF status ON appointments
+        WHEN NEW.status = 'cancelled' AND OLD.status != 'cancelled'
+        BEGIN
+            DELETE FROM appointment_slots WHERE appointment_id = NEW.id;
+        END
+    ''')
+
+
+# Migrações em ordem; a versão aplicada fica em schema_migrations.
+# Nunca altere uma migração já publicada: acrescente uma nova.
+MIGRATIONS: List[Tuple[int, str, Callable[[sqlite3.Connection], None]]] = [
+    (1, "tabelas iniciais", init_schema),
+    (2, "índices de histórico e agendamentos", create_hot_path_indexes),
+    (3, "agregados de analytics", create_rollups),
+    (4, "perfil por paciente", create_patient_profiles),
+    (5, "índice de conversas por data", create_export_indexes),
+    (6, "deduplicação do webhook", create_webhook_dedup),
+    (7, "reservas de horário", create_appointment_slots),
+]
+
+
+def fetch_schema_version(conn: sqlite3.Connection) -> int:
+    try:
+        return conn.execute("SELECT COALESCE(MAX(version), 0) FROM schema_migrations").fetchone()[0]
+    except sqlite3.OperationalError:
+        return 0
+
+
+def migrate(conn: sqlite3.Connection, target: Optional[int] = None) -> int:
+    """Aplica as migrações pendentes (até `target`) e retorna a versão do esquema"""
+    # Trava de escrita antes de ler a versão: vários workers sobem juntos
+    conn.execute("BEGIN IMMEDIATE")
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    version = fetch_schema_version(conn)
+    for number, name, apply in MIGRATIONS:
+        if number <= version or (target is not None and number > target):
+            continue
+        apply(conn)
+        conn.execute("INSERT INTO schema_migrations (version, name) VALUES (?, ?)", (number, name))
+        version = number
+        print(f"🗄️ Migração {number} aplicada: {name}")
+    return version
+
+
+# === Escritas ===
+def upsert_patient(conn: sqlite3.Connection, phone: str, name: Optional[str] = None) -> int:
+    """Obtém ou cria um paciente, atualizando o nome se mudou"""
+    cursor = conn.cursor()
+
+    cursor.execute("SELECT id, name FROM patients WHERE phone = ?", (phone,))
+    result = cursor.fetchone()
+
+    if result:
+        patient_id = result[0]
+        if name and name != result[1]:
+            cursor.execute(
+                "UPDATE patients SET name = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?",
+                (name, patient_id)
+            )
+        return patient_id
+
+    cursor.execute(
+        "INSERT INTO patients (phone, name) VALUES (?, ?)",
+        (phone, name or "Não informado")
+    )
+    return cursor.lastrowid
+
+
+def insert_appointment(conn: sqlite3.Connection, appointment: Tuple) -> int:
+    """Insere um agendamento e retorna o id"""
+    cursor = conn.execute('''
+        INSERT INTO appointments (
+            patient_id, service, specialty, urgency_level,
+            scheduled_date, scheduled_time, status, notes
+        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ''', appointment)
+    return cursor.lastrowid
+
+
+class SlotTakenError(Exception):
+    """O horário foi reservado por outra conversa (ou outro worker) antes"""
+
+
+def reserve_appointment(conn: sqlite3.Connection, appointment: Tuple, minutes: List[int]) -> int:
+    """
+    Insere o agendamento e ocupa os `minutes` do dia na agenda da especialidade.
+
+    Tudo na mesma transação: se algum minuto já estiver ocupado, SlotTakenError
+    e o rollback desfaz o agendamento também.
+    """
+    appointment_id = insert_appointment(conn, appointment)
+    specialty, day = appointment[2], appointment[4]
+    try:
+        conn.executemany(
+            "INSERT INTO appointment_slots (specialty, day, minute, appointment_id) VALUES (?, ?, ?, ?)",
+            [(specialty, day, minute, appointment_id) for minute in minutes]
+        )
+    except sqlite3.IntegrityError as e:
+        raise SlotTakenError(f"{specialty} {day} ocupado") from e
+    return appointment_id
+
+
+def insert_conversation_turn(conn: sqlite3.Connection, patient_id: int, user_msg: str,
+                             bot_msg: str, state: str, created_at: Optional[str] = None) -> int:
+    """Insere uma interação no histórico"""
+    cursor = conn.execute('''
+        INSERT INTO conversations (patient_id, user_message, bot_response, state, created_at)
+        VALUES (?, ?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP))
+    ''', (patient_id, user_msg[:500], bot_msg[:500], state, created_at))
+    return cursor.lastrowid
+
+
+def acquire_conversation_lock(conn: sqlite3.Connection, phone: str, owner: str,
+                              now: float, lease: float) -> bool:
+    """Pega a trava do telefone se estiver livre ou vencida"""
+    cursor = conn.execute('''
+        INSERT INTO conversation_locks (phone, owner, expires_at) VALUES (?, ?, ?)
+        ON CONFLICT(phone) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+        WHERE conversation_locks.expires_at < ?
+    ''', (phone, owner, now + lease, now))
+    return cursor.rowcount == 1
+
+
+def renew_conversation_lock(conn: sqlite3.Connection, phone: str, owner: str,
+                            now: float, lease: float) -> bool:
+    """Estende o prazo da trava; False se ela já não é deste dono"""
+    cursor = conn.execute("UPDATE conversation_locks SET expires_at = ? WHERE phone = ? AND owner = ?",
+                          (now + lease, phone, owner))
+    return cursor.rowcount == 1
+
+
+class ConversationLockLostError(Exception):
+    """A trava da conversa venceu e foi pega por outro processo antes da gravação"""
+
+
+def release_conversation_lock(conn: sqlite3.Connection, phone: str, owner: str):
+    """Solta a trava (só se ainda for do mesmo dono)"""
+    conn.execute("DELETE FROM conversation_locks WHERE phone = ? AND owner = ?", (phone, owner))
+
+
+def save_conversation_state(conn: sqlite3.Connection, phone: str, data: str, now: float,
+                            owner: Optional[str] = None) -> int:
+    """
+    Grava o estado da conversa, solta a trava na mesma transação e retorna a nova versão.
+
+    Com `owner`, a trava ainda precisa ser dele: se venceu e outro processo a
+    pegou, ConversationLockLostError e nada é gravado.
+    """
+    if owner is not None and conn.execute(
+            "SELECT 1 FROM conversation_locks WHERE phone = ? AND owner = ?", (phone, owner)).fetchone() is None:
+        raise ConversationLockLostError(f"Trava da conversa {phone} perdida")
+    conn.execute('''
+        INSERT INTO conversation_state (phone, version, data, updated_at) VALUES (?, 1, ?, ?)
+        ON CONFLICT(phone) DO UPDATE SET version = version + 1, data = excluded.data,
+                                         updated_at = excluded.updated_at
+    ''', (phone, data, now))
+    if owner is not None:
+        release_conversation_lock(conn, phone, owner)
+    return conn.execute("SELECT version FROM conversation_state WHERE phone = ?", (phone,)).fetchone()[0]
+
+
+def reset_conversation_state_field(conn: sqlite3.Connection, phone: str, key: str) -> bool:
+    """Zera `key` no estado gravado e sobe a versão (os caches dos workers recarregam)"""
+    cursor = conn.execute('''
+        UPDATE conversation_state SET data = json_set(data, '$.' || ?, json('null')), version = version + 1
+        WHERE phone = ?
+    ''', (key, phone))
+    return cursor.rowcount == 1
+
+
+def delete_conversation_state(conn: sqlite3.Connection, phone: str):
+    conn.execute("DELETE FROM conversation_state WHERE phone = ?", (phone,))
+
+
+def delete_idle_conversation_states(conn: sqlite3.Connection, cutoff: float) -> int:
+    """Remove conversas paradas desde antes de `cutoff` e travas vencidas"""
+    cursor = conn.execute("DELETE FROM conversation_state WHERE updated_at < ?", (cutoff,))
+    conn.execute("DELETE FROM conversation_locks WHERE expires_at < ?", (cutoff,))
+    return cursor.rowcount
+
+
+def claim_webhook_key(conn: sqlite3.Connection, key: str, now: float, ttl: float) -> bool:
+    """Registra a mensagem; False se ela já foi vista e o registro ainda vale"""
+    cursor = conn.execute('''
+        INSERT INTO webhook_seen (key, expires_at) VALUES (?, ?)
+        ON CONFLICT(key) DO UPDATE SET expires_at = excluded.expires_at
+        WHERE webhook_seen.expires_at < ?
+    ''', (key, now + ttl, now))
+    return cursor.rowcount == 1
+
+
+def release_webhook_key(conn: sqlite3.Connection, key: str):
+    """Esquece a mensagem (não foi aceita; a reentrega deve ser processada)"""
+    conn.execute("DELETE FROM webhook_seen WHERE key = ?", (key,))
+
+
+def delete_expired_webhook_keys(conn: sqlite3.Connection, now: float) -> int:
+    cursor = conn.execute("DELETE FROM webhook_seen WHERE expires_at < ?", (now,))
+    return cursor.rowcount
+
+
+# === Leituras ===
+def fetch_patient_history(conn: sqlite3.Connection, phone: str, limit: int = 10) -> List[Dict[str, Any]]:
+    """Últimas interações do paciente em ordem cronológica"""
+    cursor = conn.execute('''
+        SELECT c.user_message, c.bot_response, c.created_at, c.state
+        FROM conversations c
+        JOIN patients p ON c.patient_id = p.id
+        WHERE p.phone = ?
+        ORDER BY c.created_at DESC, c.id DESC
+        LIMIT ?
+    ''', (phone, limit))
+
+    history = [
+        {"user": row[0], "bot": row[1], "timestamp": row[2], "state": row[3]}
+        for row in cursor.fetchall()
+    ]
+    return history[::-1]  # Reverter para ordem cronológica
+
+
+def fetch_conversation_state(conn: sqlite3.Connection, phone: str,
+                             known_version: Optional[int] = None) -> Optional[Tuple[int, Optional[str]]]:
+    """(versão, dados) do estado salvo; dados None se a versão é a já conhecida"""
+    return conn.execute('''
+        SELECT version, CASE WHEN version = ? THEN NULL ELSE data END
+        FROM conversation_state WHERE phone = ?
+    ''', (known_version, phone)).fetchone()
+
+
+def count_active_conversations(conn: sqlite3.Connection, cutoff: float) -> int:
+    return conn.execute(
+        "SELECT COUNT(*) FROM conversation_state WHERE updated_at >= ?", (cutoff,)
+    ).fetchone()[0]
+
+
+def fetch_reserved_slots(conn: sqlite3.Connection, first_day: str,
+                         specialty: Optional[str] = None, last_day: Optional[str] = None) -> List[Tuple[str, str, int]]:
+    """Minutos ocupados (especialidade, dia, minuto) a partir de `first_day`"""
+    conditions, params = ["day >= ?"], [first_day]
+    if last_day:
+        conditions.append("day <= ?")
+        params.append(last_day)
+    if specialty:
+        conditions.append("specialty = ?")
+        params.append(specialty)
+    return conn.execute(
+        f"SELECT specialty, day, minute FROM appointment_slots WHERE {' AND '.join(conditions)}", params
+    ).fetchall()
+
+
+def fetch_rollup_totals(conn: sqlite3.Connection) -> Dict[str, int]:
+    """Totais gerais mantidos em stats_rollup"""
+    totals = dict.fromkeys(("patients", "messages", "appointments", "confirmed"), 0)
+    totals.update(conn.execute(
+        "SELECT metric, value FROM stats_rollup WHERE day = '*' AND dimension = ''"
+    ).fetchall())
+    return totals
+
+
+def fetch_system_counts(conn: sqlite3.Connection) -> Dict[str, int]:
+    """Totais usados em /api/status"""
+    totals = fetch_rollup_totals(conn)
+    return {
+        "total_patients": totals["patients"],
+        "confirmed_appointments": totals["confirmed"],
+        "total_messages": totals["messages"],
+    }
+
+
+def fetch_patient_profile(conn: sqlite3.Connection, phone: str) -> Optional[Dict[str, Any]]:
+    """Dados do paciente, totais e últimas interações (uma leitura pelo telefone)"""
+    row = conn.execute("""
+        SELECT p.id, p.name, p.created_at, f.total_appointments, f.total_messages,
+               f.last_message_at, f.last_state, f.last_appointment_at, f.last_service,
+               f.last_visit_date, f.last_visit_time, f.recent_history
+        FROM patients p
+        JOIN patient_profiles f ON f.patient_id = p.id
+        WHERE p.phone = ?
+    """, (phone,)).fetchone()
+    if row is None:
+        return None
+    return {
+        "id": row[0],
+        "name": row[1],
+        "created_at": row[2],
+        "total_appointments": row[3],
+        "total_messages": row[4],
+        "last_message_at": row[5],
+        "last_state": row[6],
+        "last_appointment": {
+            "created_at": row[7],
+            "service": row[8],
+            "scheduled_date": row[9],
+            "scheduled_time": row[10],
+        } if row[7] else None,
+        "history": json.loads(row[11]),
+    }
+
+
+# Colunas das listagens e exportações (mesma ordem nas linhas de CSV)
+APPOINTMENT_FIELDS = ["id", "patient_name", "patient_phone", "service", "specialty", "urgency_level",
+                      "scheduled_date", "scheduled_time", "status", "created_at"]
+CONVERSATION_FIELDS = ["id", "patient_name", "patient_phone", "user_message", "bot_response",
+                       "state", "created_at"]
+Cursor = Tuple[str, int]
+
+
+def _keyset_page(conn: sqlite3.Connection, select: str, alias: str, conditions: List[str], params: List[Any],
+                 fields: List[str], limit: int, after: Optional[Cursor], ascending: bool,
+                 filters: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """
+    Página ordenada por (created_at, id) continuando depois de `after`: o
+    índice em created_at vai direto ao ponto, sem OFFSET.
+
+    O período (date_from/date_to, AAAA-MM-DD inclusivos) e o cursor viram
+    um único limite de cada lado em created_at; com dois, o SQLite pode
+    escolher o do período e reler tudo o que já foi paginado.
+    """
+    conditions, params = list(conditions), list(params)
+    lower = filters.get("date_from") or ""
+    upper, upper_op = None, "<"
+    if filters.get("date_to"):
+        upper = (datetime.strptime(filters["date_to"], "%Y-%m-%d") + timedelta(days=1)).strftime("%Y-%m-%d")
+    if after is not None:
+        if ascending:
+            lower = max(lower, after[0])
+        elif upper is None or after[0] < upper:
+            upper, upper_op = after[0], "<="
+        conditions.append(f"({alias}.created_at, {alias}.id) {'>' if ascending else '<'} (?, ?)")
+        params.extend(after)
+    if lower:
+        conditions.append(f"{alias}.created_at >= ?")
+        params.append(lower)
+    if upper is not None:
+        conditions.append(f"{alias}.created_at {upper_op} ?")
+        params.append(upper)
+
+    order = "ASC" if ascending else "DESC"
+    sql = select
+    if conditions:
+        sql += " WHERE " + " AND ".join(conditions)
+    sql += f" ORDER BY {alias}.created_at {order}, {alias}.id {order} LIMIT ?"
+    cursor = conn.execute(sql, (*params, limit))
+    return [dict(zip(fields, row)) for row in cursor.fetchall()]
+
+
+def fetch_appointments(conn: sqlite3.Connection, limit: int = 50, after: Optional[Cursor] = None,
+                       filters: Optional[Dict[str, Any]] = None, ascending: bool = False) -> List[Dict[str, Any]]:
+    """Agendamentos (mais recentes primeiro), filtrados por data, status e especialidade"""
+    filters = filters or {}
+    conditions, params = [], []
+    for column in ("status", "specialty"):
+        if filters.get(column):
+            # "+" tira a coluna da escolha de índice: o percurso segue created_at, sem ordenar a cada página
+            conditions.append(f"+a.{column} = ?")
+            params.append(filters[column])
+    return _keyset_page(conn, """
+        SELECT a.id, p.name, p.phone, a.service, a.specialty, a.urgency_level,
+               a.scheduled_date, a.scheduled_time, a.status, a.created_at
+        FROM appointments a
+        JOIN patients p ON a.patient_id = p.id
+    """, "a", conditions, params, APPOINTMENT_FIELDS, limit, after, ascending, filters)
+
+
+def fetch_conversations(conn: sqlite3.Connection, limit: int = 50, after: Optional[Cursor] = None,
+                        filters: Optional[Dict[str, Any]] = None, ascending: bool = False) -> List[Dict[str, Any]]:
+    """Interações (mais recentes primeiro), filtradas por data, estado e telefone"""
+    filters = filters or {}
+    conditions, params = [], []
+    if filters.get("state"):
+        conditions.append("+c.state = ?")
+        params.append(filters["state"])
+    if filters.get("phone"):
+        # Por telefone, o índice (patient_id, created_at) já entrega a ordem
+        conditions.append("p.phone = ?")
+        params.append(filters["phone"])
+    return _keyset_page(conn, """
+        SELECT c.id, p.name, p.phone, c.user_message, c.bot_response, c.state, c.created_at
+        FROM conversations c
+        LEFT JOIN patients p ON c.patient_id = p.id
+    """, "c", conditions, params, CONVERSATION_FIELDS, limit, after, ascending, filters)
+
+
+def fetch_analytics(conn: sqlite3.Connection) -> Dict[str, Any]:
+    """Totais e distribuições de agendamentos (de stats_rollup)"""
+    totals = fetch_rollup_totals(conn)
+
+    # Distribuição por especialidade
+    cursor = conn.execute("""
+        SELECT dimension, value FROM stats_rollup
+        WHERE day = '*' AND metric = 'specialty' AND value > 0
+        ORDER BY value DESC
+    """)
+    specialties = {row[0] or None: row[1] for row in cursor.fetchall()}
+
+    # Distribuição por urgência
+    cursor = conn.execute("""
+        SELECT dimension, value FROM stats_rollup
+        WHERE day = '*' AND metric = 'urgency' AND value > 0
+        ORDER BY CAST(dimension AS INTEGER) DESC
+    """)
+    urgency_dist = {f"level_{row[0]}": row[1] for row in cursor.fetchall()}
+
+    return {
+        "total_patients": totals["patients"],
+        "total_appointments": totals["appointments"],
+        "confirmed": totals["confirmed"],
+        "by_specialty": specialties,
+        "by_urgency": urgency_dist,
+    }
+
+
+def fetch_daily_rollups(conn: sqlite3.Connection, days: int = 30) -> Dict[str, Dict[str, int]]:
+    """Série diária (pacientes novos, mensagens, agendamentos, confirmados) dos últimos `days` dias"""
+    cursor = conn.execute("""
+        SELECT day, metric, value FROM stats_rollup
+        WHERE day >= date('now', ?) AND day != '*' AND dimension = ''
+        ORDER BY day
+    """, (f"-{days - 1} days",))
+    series: Dict[str, Dict[str, int]] = {}
+    for day, metric, value in cursor.fetchall():
+        series.setdefault(day, {})[metric] = value
+    return series
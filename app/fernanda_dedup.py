@@ -0,0 +1,108 @@
+"""
+Fernanda IA - Deduplicação do Webhook
+Reentregas da Evolution API (timeout, erro de rede) são descartadas antes de chegar à fila
+"""
+
+import os
+import time
+import hashlib
+from collections import OrderedDict
+from typing import Dict, Any, Optional, Tuple
+
+import fernanda_db
+from fernanda_db import Database
+
+WEBHOOK_DEDUP_TTL = float(os.getenv("WEBHOOK_DEDUP_TTL", "86400"))              # s, por key.id
+WEBHOOK_DEDUP_CONTENT_TTL = float(os.getenv("WEBHOOK_DEDUP_CONTENT_TTL", "30"))  # s, por conteúdo
+WEBHOOK_DEDUP_LOCAL_MAX = int(os.getenv("WEBHOOK_DEDUP_LOCAL_MAX", "10000"))
+# Sem id, textos mais curtos que isso ("sim", "ok", "pode ser") nunca são deduplicados
+WEBHOOK_DEDUP_CONTENT_MIN_CHARS = int(os.getenv("WEBHOOK_DEDUP_CONTENT_MIN_CHARS", "20"))
+
+
+def message_key(data: Dict[str, Any], phone: str, message: str) -> Tuple[Optional[str], float]:
+    """
+    Identidade da mensagem e por quanto tempo lembrar dela.
+
+    Na Evolution é o key.id (único por mensagem); no formato simples, um
+    "id" se vier, senão o hash de telefone + texto com janela curta. Respostas
+    curtas sem id ficam de fora (None): um segundo "sim" para uma pergunta
+    nova é legítimo e não pode ser confundido com reentrega.
+    """
+    message_id = None
+    if "data" in data:
+        message_id = (data["data"].get("message") or {}).get("key", {}).get("id")
+    elif data.get("id"):
+        message_id = data["id"]
+    if message_id:
+        return f"id:{phone}:{message_id}", WEBHOOK_DEDUP_TTL
+    if len(message.strip()) < WEBHOOK_DEDUP_CONTENT_MIN_CHARS:
+        return None, 0.0
+    digest = hashlib.sha1(f"{phone}\0{message}".encode("utf-8")).hexdigest()
+    return f"sha1:{digest}", WEBHOOK_DEDUP_CONTENT_TTL
+
+
+class WebhookDeduplicator:
+    """
+    Mensagens já recebidas, com prazo.
+
+    O registro vale no banco (webhook_seen), então sobrevive a reinícios e
+    é o mesmo para todos os workers: o INSERT ... ON CONFLICT na thread
+    escritora decide sozinho quem viu a mensagem primeiro. Um LRU local
+    responde às reentregas que caem neste processo sem ir ao banco. Se o
+    banco falhar, a mensagem passa (melhor repetir do que perder).
+    """
+
+    def __init__(self, db: Database, local_max: int = WEBHOOK_DEDUP_LOCAL_MAX):
+        self.db = db
+        self.local_max = local_max
+        self._local: "OrderedDict[str, float]" = OrderedDict()
+        self.counters = {"checked": 0, "duplicates": 0, "local_hits": 0, "released": 0,
+                         "expired": 0, "errors": 0}
+
+    def _remember(self, key: str, expires_at: float):
+        self._local[key] = expires_at
+        self._local.move_to_end(key)
+        while len(self._local) > self.local_max:
+            self._local.popitem(last=False)
+
+    async def claim(self, key: str, ttl: float) -> bool:
+        """True se a mensagem é nova (e fica registrada); False se é reentrega"""
+        self.counters["checked"] += 1
+        now = time.time()
+        expires_at = self._local.get(key)
+        if expires_at is not None and expires_at >= now:
+            self.counters["duplicates"] += 1
+            self.counters["local_hits"] += 1
+            return False
+        try:
+            fresh = await self.db.write(fernanda_db.claim_webhook_key, key, now, ttl)
+        except Exception as e:
+            print(f"Erro na deduplicação do webhook: {e}")
+            self.counters["errors"] += 1
+            return True
+        if not fresh:
+            self.counters["duplicates"] += 1
+            return False
+        self._remember(key, now + ttl)
+        return True
+
+    async def release(self, key: str):
+        """Desfaz o registro de uma mensagem que não foi aceita (fila cheia)"""
+        self._local.pop(key, None)
+        self.counters["released"] += 1
+        try:
+            await self.db.write(fernanda_db.release_webhook_key, key)
+        except Exception as e:
+            print(f"Erro na deduplicação do webhook: {e}")
+            self.counters["errors"] += 1
+
+    async def expire(self) -> int:
+        now = time.time()
+        for key in [key for key, expires_at in self._local.items() if expires_at < now]:
+            del self._local[key]
+        removed = await self.db.write(fernanda_db.delete_expired_webhook_keys, now)
+        self.counters["expired"] += removed
+        return removed
+
+    def stats(self) -> Dict[str, Any]:
+        return {"local": len(self._local), "local_max": self.local_max, **self.counters}
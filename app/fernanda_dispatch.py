@@ -0,0 +1,187 @@
+"""
+Fernanda IA - Fila de Mensagens
+Workers assíncronos com ordem estrita por telefone e paralelismo entre telefones,
+agrupando rajadas de mensagens curtas em um único turno
+"""
+
+import os
+import time
+import asyncio
+from collections import deque
+from typing import Dict, Any, Deque, List, Set, Callable, Awaitable
+
+from fernanda_metrics import LatencyWindow
+
+DISPATCH_WORKERS = int(os.getenv("DISPATCH_WORKERS", "8"))
+DISPATCH_MAX_QUEUED = int(os.getenv("DISPATCH_MAX_QUEUED", "1000"))
+# Janela de silêncio (s) antes de processar uma rajada, e espera máxima. Vale para
+# toda mensagem (inclusive a primeira), exceto quando alguém espera a resposta (?wait=true)
+BURST_DEBOUNCE = float(os.getenv("BURST_DEBOUNCE", "0.8"))
+BURST_MAX_WAIT = float(os.getenv("BURST_MAX_WAIT", "5"))
+BURST_MAX_MESSAGES = int(os.getenv("BURST_MAX_MESSAGES", "10"))
+
+
+class QueueFullError(Exception):
+    """A fila atingiu DISPATCH_MAX_QUEUED mensagens"""
+
+
+class Job:
+    __slots__ = ("phone", "message", "enqueued_at", "future", "immediate")
+
+    def __init__(self, phone: str, message: str, future: asyncio.Future, immediate: bool = False):
+        self.phone = phone
+        self.message = message
+        self.enqueued_at = time.monotonic()
+        self.future = future
+        self.immediate = immediate
+
+
+class MessageDispatcher:
+    """
+    Distribui mensagens recebidas entre um número fixo de workers.
+
+    Cada telefone tem sua própria fila e só pode estar em um worker por vez,
+    então as mensagens de uma conversa são processadas na ordem de chegada.
+    Telefones diferentes rodam em paralelo, em rodízio justo: depois de cada
+    turno o telefone volta para o fim da fila de prontos.
+
+    Um telefone só fica pronto depois de `debounce` segundos sem mensagem
+    nova (limitado a `max_wait` desde a primeira da rajada); tudo que chegou
+    nesse intervalo vira um único turno, com as mensagens unidas por quebra
+    de linha, e todos os futures da rajada recebem o mesmo resultado. Uma
+    mensagem com `immediate` (alguém esperando a resposta) libera o telefone
+    na hora, levando junto o que já estava na janela.
+    """
+
+    def __init__(self, handler: Callable[[str, str], Awaitable[Any]],
+                 workers: int = DISPATCH_WORKERS, max_queued: int = DISPATCH_MAX_QUEUED,
+                 debounce: float = BURST_DEBOUNCE, max_wait: float = BURST_MAX_WAIT,
+                 max_burst: int = BURST_MAX_MESSAGES):
+        self.handler = handler
+        self.workers = workers
+        self.max_queued = max_queued
+        self.debounce = debounce
+        self.max_wait = max_wait
+        self.max_burst = max_burst
+        self._queues: Dict[str, Deque[Job]] = {}
+        # Telefones na fila de prontos ou em um worker
+        self._active: Set[str] = set()
+        self._timers: Dict[str, asyncio.TimerHandle] = {}
+        self._ready: "asyncio.Queue[str]" = asyncio.Queue()
+        self._tasks: List[asyncio.Task] = []
+        self._queued = 0
+        self._in_flight = 0
+        self._waits = LatencyWindow()
+        self.stats_counters = {
+            "accepted": 0, "processed": 0, "failed": 0, "rejected": 0,
+            "turns": 0, "coalesced": 0,
+        }
+
+    def start(self):
+        """Inicia os workers"""
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    def submit(self, phone: str, message: str, immediate: bool = False) -> asyncio.Future:
+        """Enfileira uma mensagem; o future resolve com o resultado do handler"""
+        if self._queued >= self.max_queued:
+            self.stats_counters["rejected"] += 1
+            raise QueueFullError(f"{self._queued} mensagens na fila")
+
+        future = asyncio.get_running_loop().create_future()
+        queue = self._queues.setdefault(phone, deque())
+        queue.append(Job(phone, message, future, immediate))
+        self._queued += 1
+        self.stats_counters["accepted"] += 1
+        if phone not in self._active:
+            # Telefone ocioso: (re)arma a janela da rajada, ou libera na hora se
+            # alguém espera a resposta
+            self._schedule(phone, immediate)
+        return future
+
+    def _schedule(self, phone: str, immediate: bool = False):
+        timer = self._timers.pop(phone, None)
+        if timer is not None:
+            timer.cancel()
+
+        if immediate or self.debounce <= 0:
+            self._release(phone)
+            return
+
+        queue = self._queues[phone]
+        due = min(queue[-1].enqueued_at + self.debounce, queue[0].enqueued_at + self.max_wait)
+        delay = max(0.0, due - time.monotonic())
+        self._timers[phone] = asyncio.get_running_loop().call_later(delay, self._release, phone)
+
+    def _release(self, phone: str):
+        self._timers.pop(phone, None)
+        self._active.add(phone)
+        self._ready.put_nowait(phone)
+
+    async def _worker(self):
+        while True:
+            phone = await self._ready.get()
+            queue = self._queues[phone]
+            jobs = [queue.popleft() for _ in range(min(len(queue), self.max_burst))]
+            self._queued -= len(jobs)
+            self._in_flight += 1
+            now = time.monotonic()
+            self._waits.extend(now - job.enqueued_at for job in jobs)
+            message = "\n".join(job.message for job in jobs)
+
+            try:
+                result = await self.handler(phone, message)
+            except Exception as e:
+                print(f"Erro ao processar mensagem de {phone}: {e}")
+                self.stats_counters["failed"] += len(jobs)
+                for job in jobs:
+                    if not job.future.done():
+                        job.future.set_exception(e)
+                        # Ninguém espera o resultado no modo fast-ack
+                        job.future.exception()
+            else:
+                self.stats_counters["processed"] += len(jobs)
+                for job in jobs:
+                    if not job.future.done():
+                        job.future.set_result(result)
+            finally:
+                self.stats_counters["turns"] += 1
+                self.stats_counters["coalesced"] += len(jobs) - 1
+                self._in_flight -= 1
+                self._active.discard(phone)
+                if queue:
+                    self._schedule(phone, any(job.immediate for job in queue))
+                else:
+                    del self._queues[phone]
+                self._ready.task_done()
+
+    async def drain(self):
+        """Espera todas as mensagens enfileiradas terminarem"""
+        while self._queued or self._in_flight:
+            # Rajadas ainda na janela de espera são liberadas na hora
+            for phone in list(self._timers):
+                self._timers[phone].cancel()
+                self._release(phone)
+            await self._ready.join()
+
+    async def close(self, timeout: float = 30):
+        """Drena a fila (até timeout segundos) e encerra os workers"""
+        try:
+            await asyncio.wait_for(self.drain(), timeout)
+        except asyncio.TimeoutError:
+            print(f"⚠️ Encerrando com {self._queued} mensagens na fila")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def stats(self) -> Dict[str, Any]:
+        """Profundidade da fila e tempo de espera (ms)"""
+        return {
+            "workers": self.workers,
+            "queued": self._queued,
+            "in_flight": self._in_flight,
+            "phones_waiting": len(self._queues),
+            **self._waits.summary_ms("wait_ms"),
+            **self.stats_counters,
+        }
@@ -0,0 +1,180 @@
+"""
+Fernanda IA - Cliente Evolution API
+Conexão keep-alive compartilhada, fila de envio com rate limit por instância e retries
+"""
+
+import os
+import time
+import random
+import asyncio
+from typing import Dict, Any, List, Optional, Tuple
+
+import httpx
+
+from fernanda_metrics import LatencyWindow
+
+try:
+    import h2  # noqa: F401  (habilita HTTP/2 no httpx)
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+EVOLUTION_RATE = float(os.getenv("EVOLUTION_RATE", "5"))        # mensagens/s por instância
+EVOLUTION_BURST = int(os.getenv("EVOLUTION_BURST", "10"))
+EVOLUTION_SENDERS = int(os.getenv("EVOLUTION_SENDERS", "4"))
+EVOLUTION_MAX_RETRIES = int(os.getenv("EVOLUTION_MAX_RETRIES", "3"))
+EVOLUTION_BACKOFF = float(os.getenv("EVOLUTION_BACKOFF", "0.5"))  # s, dobra a cada tentativa
+EVOLUTION_TIMEOUT = float(os.getenv("EVOLUTION_TIMEOUT", "15"))
+
+
+class TokenBucket:
+    """Rate limit clássico: `rate` fichas por segundo, até `capacity` acumuladas"""
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class EvolutionClient:
+    """
+    Envio de mensagens pela Evolution API.
+
+    Um único httpx.AsyncClient (keep-alive, HTTP/2 quando o pacote h2 está
+    instalado e o servidor negocia) atende todos os envios. As mensagens
+    passam por uma fila consumida por EVOLUTION_SENDERS tarefas; cada envio
+    pega uma ficha do token bucket da instância e, em erro de rede, 429 ou
+    5xx, tenta de novo com backoff exponencial.
+    """
+
+    def __init__(self, base_url: str, api_key: str, instance: str,
+                 rate: float = EVOLUTION_RATE, burst: int = EVOLUTION_BURST,
+                 senders: int = EVOLUTION_SENDERS, max_retries: int = EVOLUTION_MAX_RETRIES,
+                 backoff: float = EVOLUTION_BACKOFF, timeout: float = EVOLUTION_TIMEOUT):
+        self.base_url = base_url.rstrip("/")
+        self.api_key = api_key
+        self.instance = instance
+        self.rate = rate
+        self.burst = burst
+        self.senders = senders
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self._client: Optional[httpx.AsyncClient] = None
+        self._queue: "asyncio.Queue[Tuple[str, str, str, float, asyncio.Future]]" = asyncio.Queue()
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._tasks: List[asyncio.Task] = []
+        self._latencies = LatencyWindow()
+        self.counters = {"sent": 0, "failed": 0, "retries": 0}
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                timeout=self.timeout,
+                http2=HTTP2_AVAILABLE,
+                limits=httpx.Limits(max_connections=self.senders * 2,
+                                    max_keepalive_connections=self.senders),
+                headers={"apikey": self.api_key, "Content-Type": "application/json"},
+            )
+        return self._client
+
+    def _bucket(self, instance: str) -> TokenBucket:
+        bucket = self._buckets.get(instance)
+        if bucket is None:
+            bucket = self._buckets[instance] = TokenBucket(self.rate, self.burst)
+        return bucket
+
+    def start(self):
+        """Inicia as tarefas de envio"""
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._sender()) for _ in range(self.senders)]
+
+    async def send_text(self, phone: str, text: str, instance: Optional[str] = None) -> bool:
+        """Enfileira uma mensagem e espera a entrega (True se a Evolution aceitou)"""
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((instance or self.instance, phone, text, time.monotonic(), future))
+        return await future
+
+    async def _sender(self):
+        while True:
+            instance, phone, text, enqueued_at, future = await self._queue.get()
+            try:
+                try:
+                    ok = await self._deliver(instance, phone, text)
+                except Exception as e:
+                    print(f"Erro inesperado ao enviar WhatsApp: {e}")
+                    ok = False
+                if ok:
+                    self.counters["sent"] += 1
+                    self._latencies.add(time.monotonic() - enqueued_at)
+                else:
+                    self.counters["failed"] += 1
+                if not future.done():
+                    future.set_result(ok)
+            finally:
+                self._queue.task_done()
+
+    async def _deliver(self, instance: str, phone: str, text: str) -> bool:
+        url = f"{self.base_url}/message/sendText/{instance}"
+        payload = {"number": phone, "text": text}
+
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                self.counters["retries"] += 1
+                delay = self.backoff * (2 ** (attempt - 1))
+                await asyncio.sleep(delay + random.uniform(0, delay / 2))
+
+            await self._bucket(instance).acquire()
+            try:
+                response = await self.client.post(url, json=payload)
+            except httpx.HTTPError as e:
+                print(f"Erro ao enviar WhatsApp (tentativa {attempt + 1}): {e}")
+                continue
+
+            if response.status_code == 429 or response.status_code >= 500:
+                print(f"Evolution respondeu {response.status_code} (tentativa {attempt + 1})")
+                continue
+            if response.status_code >= 400:
+                # Erro do nosso lado (número inválido, instância errada): não adianta repetir
+                print(f"Evolution recusou a mensagem: {response.status_code} {response.text[:200]}")
+                return False
+            return True
+
+        return False
+
+    async def close(self, timeout: float = 30):
+        """Espera a fila esvaziar e fecha a conexão"""
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            print(f"⚠️ Encerrando com {self._queue.qsize()} mensagens não enviadas")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def stats(self) -> Dict[str, Any]:
+        """Contadores de entrega e latência fila→aceite (ms)"""
+        return {
+            "queued": self._queue.qsize(),
+            "http2": HTTP2_AVAILABLE,
+            **self._latencies.summary_ms("latency_ms"),
+            **self.counters,
+        }
@@ -0,0 +1,163 @@
+"""
+Fernanda IA - Paginação e Exportação
+Cursores de paginação (keyset) e exportação em NDJSON/CSV lida do banco em lotes
+"""
+
+import os
+import io
+import csv
+import json
+import base64
+import asyncio
+from typing import Dict, Any, List, Callable, Optional, AsyncIterator
+
+from fernanda_db import Database, Cursor
+
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "1000"))
+EXPORT_MAX_CONCURRENT = int(os.getenv("EXPORT_MAX_CONCURRENT", "2"))
+
+EXPORT_FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+}
+
+
+class ExportBusyError(Exception):
+    """Já há EXPORT_MAX_CONCURRENT exportações em andamento"""
+
+
+def encode_cursor(row: Dict[str, Any]) -> str:
+    """Cursor opaco apontando para depois de `row` (created_at, id)"""
+    raw = f"{row['created_at']}|{row['id']}".encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Cursor:
+    """(created_at, id) do cursor; ValueError se inválido"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode("utf-8")
+        created_at, row_id = raw.rsplit("|", 1)
+        return created_at, int(row_id)
+    except (ValueError, UnicodeDecodeError) as e:
+        raise ValueError(f"Cursor inválido: {cursor}") from e
+
+
+def next_cursor(rows: List[Dict[str, Any]], limit: int) -> Optional[str]:
+    """Cursor da próxima página, ou None se esta foi a última"""
+    return encode_cursor(rows[-1]) if len(rows) == limit else None
+
+
+def _ndjson(rows: List[Dict[str, Any]], fields: List[str]) -> str:
+    return "".join(json.dumps(row, ensure_ascii=False) + "\n" for row in rows)
+
+
+def _csv(rows: List[Dict[str, Any]], fields: List[str]) -> str:
+    buffer = io.StringIO()
+    csv.DictWriter(buffer, fieldnames=fields, lineterminator="\n").writerows(rows)
+    return buffer.getvalue()
+
+
+def _read_batch(conn, fetch_page: Callable, limit: int, after: Optional[Cursor], filters: Dict[str, Any],
+                encode: Callable, fields: List[str]):
+    """Lê e já converte um lote na thread de leitura, fora do event loop: (texto, linhas, cursor)"""
+    rows = fetch_page(conn, limit, after, filters, True)
+    if not rows:
+        return "", 0, after
+    return encode(rows, fields), len(rows), (rows[-1]["created_at"], rows[-1]["id"])
+
+
+class ExportStream:
+    """
+    Exportação com a vaga já reservada.
+
+    A vaga volta quando o stream termina, falha ou é fechado com aclose(),
+    mesmo que nunca tenha sido iterado (um gerador não iniciado não roda o finally).
+    """
+
+    def __init__(self, generator: AsyncIterator[str], release: Callable[[], None]):
+        self._generator = generator
+        self._release = release
+
+    def __aiter__(self) -> "ExportStream":
+        return self
+
+    async def __anext__(self) -> str:
+        return await self._generator.__anext__()
+
+    async def aclose(self):
+        try:
+            await self._generator.aclose()
+        finally:
+            self._release()
+
+
+class Exporter:
+    """
+    Exportações em streaming.
+
+    Cada lote de `batch_size` linhas é uma leitura curta no pool de leitura
+    (continuando do último (created_at, id) pelo índice), convertida na
+    mesma thread e enviada antes de buscar o próximo: a memória fica em um lote por
+    exportação e nenhuma transação fica aberta enquanto o cliente baixa.
+    No máximo `max_concurrent` exportações rodam juntas, para sobrar
+    conexões de leitura ao atendimento; a vaga é reservada já em open().
+    """
+
+    def __init__(self, db: Database, batch_size: int = EXPORT_BATCH_SIZE,
+                 max_concurrent: int = EXPORT_MAX_CONCURRENT):
+        self.db = db
+        self.batch_size = batch_size
+        self.max_concurrent = max_concurrent
+        self._running = 0
+        self.counters = {"exports": 0, "rows": 0, "rejected": 0, "aborted": 0}
+
+    def open(self, fetch_page: Callable, fields: List[str], filters: Dict[str, Any],
+             fmt: str) -> ExportStream:
+        """Reserva uma vaga e devolve o stream; ExportBusyError se não houver vaga"""
+        if fmt not in EXPORT_FORMATS:
+            raise ValueError(f"Formato desconhecido: {fmt} (opções: {', '.join(EXPORT_FORMATS)})")
+        if self._running >= self.max_concurrent:
+            self.counters["rejected"] += 1
+            raise ExportBusyError("Exportações demais em andamento")
+        self._running += 1
+        self.counters["exports"] += 1
+        released = False
+
+        def release():
+            nonlocal released
+            if not released:
+                released = True
+                self._running -= 1
+
+        return ExportStream(self._stream(fetch_page, fields, filters, fmt, release), release)
+
+    async def _stream(self, fetch_page: Callable, fields: List[str], filters: Dict[str, Any],
+                      fmt: str, release: Callable[[], None]) -> AsyncIterator[str]:
+        encode = _csv if fmt == "csv" else _ndjson
+        after: Optional[Cursor] = None
+        try:
+            if fmt == "csv":
+                yield ",".join(fields) + "\n"
+            while True:
+                text, count, after = await self.db.read(_read_batch, fetch_page, self.batch_size,
+                                                        after, filters, encode, fields)
+                if not count:
+                    break
+                self.counters["rows"] += count
+                yield text
+                if count < self.batch_size:
+                    break
+        except (asyncio.CancelledError, GeneratorExit):
+            # Cliente desconectou no meio
+            self.counters["aborted"] += 1
+            raise
+        finally:
+            release()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "running": self._running,
+            "max_concurrent": self.max_concurrent,
+            "batch_size": self.batch_size,
+            **self.counters,
+        }
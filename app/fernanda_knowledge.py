@@ -0,0 +1,75 @@
+"""
+Fernanda IA - Base de Conhecimento
+Serviços em registros compactos (slots) com índices por nome e especialidade
+"""
+
+import csv
+import re
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, Any, Iterator, List, Tuple
+
+# Colunas do knowledge_base.csv, na ordem da tabela do prompt
+COLUMNS = ("servico", "especialidade", "palavras_chave", "urgencia", "duracao_min")
+
+
+@dataclass(frozen=True, slots=True)
+class Service:
+    name: str
+    specialty: str
+    keywords_raw: str
+    urgency: str
+    duration_min: int
+
+    @property
+    def keywords(self) -> List[str]:
+        """Palavras-chave separadas (o CSV aceita ';' ou ',')"""
+        return [kw.strip() for kw in re.split(r"[;,]", self.keywords_raw) if kw.strip()]
+
+    def as_row(self) -> Tuple[str, str, str, str, str]:
+        return (self.name, self.specialty, self.keywords_raw, self.urgency, str(self.duration_min))
+
+
+class KnowledgeBase:
+    """Catálogo imutável de serviços, indexado por nome e por especialidade"""
+
+    __slots__ = ("services", "by_name", "by_specialty")
+
+    def __init__(self, rows: List[Dict[str, Any]]):
+        self.services: Tuple[Service, ...] = tuple(
+            Service(
+                name=str(row["servico"]).strip(),
+                specialty=str(row["especialidade"]).strip(),
+                keywords_raw=str(row.get("palavras_chave") or ""),
+                urgency=str(row.get("urgencia") or ""),
+                duration_min=int(row.get("duracao_min") or 0),
+            )
+            for row in rows
+        )
+        self.by_name: Dict[str, Service] = {}
+        self.by_specialty: Dict[str, Tuple[Service, ...]] = {}
+        grouped: Dict[str, List[Service]] = {}
+        for service in self.services:
+            self.by_name.setdefault(service.name, service)
+            grouped.setdefault(service.specialty, []).append(service)
+        self.by_specialty = {name: tuple(items) for name, items in grouped.items()}
+
+    @classmethod
+    def from_csv(cls, path: Path) -> "KnowledgeBase":
+        with open(path, encoding="utf-8", newline="") as f:
+            return cls(list(csv.DictReader(f)))
+
+    def __len__(self) -> int:
+        return len(self.services)
+
+    def __iter__(self) -> Iterator[Service]:
+        return iter(self.services)
+
+    def table_lines(self) -> List[str]:
+        """Tabela alinhada em texto (cabeçalho + uma linha por serviço) para o prompt"""
+        rows = [COLUMNS] + [service.as_row() for service in self.services]
+        widths = [max(len(row[i]) for row in rows) for i in range(len(COLUMNS))]
+        return [
+            "  ".join(value.ljust(width) for value, width in zip(row, widths)).rstrip()
+            for row in rows
+        ]
@@ -0,0 +1,351 @@
+"""
+Fernanda IA - Governador de Chamadas ao Gemini
+Prazo por chamada, limite de concorrência, circuit breaker, requisição de reserva (hedge) e streaming
+"""
+
+import os
+import re
+import time
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, Optional, List, Callable, Awaitable, Tuple
+
+from fernanda_metrics import LatencyWindow
+
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "10"))                  # s, inclui espera por vaga
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "16"))
+LLM_BREAKER_THRESHOLD = int(os.getenv("LLM_BREAKER_THRESHOLD", "5"))  # falhas seguidas
+LLM_BREAKER_COOLDOWN = float(os.getenv("LLM_BREAKER_COOLDOWN", "30"))  # s aberto antes de testar
+LLM_HEDGE = os.getenv("LLM_HEDGE", "1") == "1"
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20"))
+
+
+# Fim de frase: pontuação seguida de espaço, exceto depois de abreviações ("Av. Central")
+SENTENCE_END = re.compile(r'[.!?…]+["\')\]]*\s+')
+ABBREVIATIONS = {"av", "dr", "dra", "sr", "sra", "prof", "n", "nº", "r", "tel", "obs"}
+
+
+class SentenceSplitter:
+    """Junta os trechos do stream e devolve as frases à medida que terminam"""
+
+    def __init__(self):
+        self._buffer = ""
+
+    def feed(self, text: str) -> List[str]:
+        self._buffer += text
+        sentences = []
+        start = 0
+        for match in SENTENCE_END.finditer(self._buffer):
+            words = self._buffer[start:match.start()].split()
+            if words and words[-1].lower() in ABBREVIATIONS:
+                continue
+            sentence = self._buffer[start:match.end()].strip()
+            if sentence:
+                sentences.append(sentence)
+            start = match.end()
+        self._buffer = self._buffer[start:]
+        return sentences
+
+    def flush(self) -> Optional[str]:
+        """Resto do texto (última frase sem espaço depois da pontuação)"""
+        rest, self._buffer = self._buffer.strip(), ""
+        return rest or None
+
+
+def _call_soon(loop: asyncio.AbstractEventLoop, callback: Callable, *args):
+    """call_soon_threadsafe que ignora loop já fechado (thread terminando após o desligamento)"""
+    try:
+        loop.call_soon_threadsafe(callback, *args)
+    except RuntimeError:
+        pass
+
+
+class CircuitOpenError(Exception):
+    """O Gemini falhou seguidamente e as chamadas estão suspensas"""
+
+
+class CircuitBreaker:
+    """
+    Abre após `threshold` falhas seguidas e recusa chamadas por `cooldown`
+    segundos; depois deixa passar uma única chamada de teste (meio-aberto)
+    que fecha o circuito se der certo ou o reabre se falhar.
+    """
+
+    def __init__(self, threshold: int = LLM_BREAKER_THRESHOLD, cooldown: float = LLM_BREAKER_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.state = "closed"
+        self.failures = 0
+        self.opened = 0
+        self._opened_at = 0.0
+        self._probing = False
+
+    def allow(self) -> bool:
+        if self.state == "closed":
+            return True
+        if self.state == "open":
+            if time.monotonic() - self._opened_at < self.cooldown:
+                return False
+            self.state = "half_open"
+        if self._probing:
+            return False
+        self._probing = True
+        return True
+
+    def success(self):
+        self.state = "closed"
+        self.failures = 0
+        self._probing = False
+
+    def abandon(self):
+        """A chamada de teste foi cancelada sem resultado: a próxima pode testar"""
+        self._probing = False
+
+    def failure(self):
+        self.failures += 1
+        self._probing = False
+        if self.state == "half_open" or self.failures >= self.threshold:
+            if self.state != "open":
+                self.opened += 1
+            self.state = "open"
+            self._opened_at = time.monotonic()
+
+
+class LLMGovernor:
+    """
+    Todas as chamadas a `model.generate_content` passam por aqui.
+
+    As chamadas rodam num pool de threads próprio, com no máximo
+    `max_concurrency` em andamento (a vaga só é liberada quando a thread
+    termina, mesmo que a chamada já tenha estourado o prazo), então uma
+    lentidão do Gemini não esgota o pool padrão do asyncio. Cada chamada tem
+    `timeout` segundos, contando a espera por vaga. Com `hedge`, se a
+    resposta demorar mais que o p95 recente, uma segunda requisição é feita
+    (se houver vaga) e vale a que chegar primeiro. stream() consome a
+    resposta em trechos e permite interromper a geração no meio; ali o hedge
+    vale para o primeiro trecho (p95 do tempo até ele), e o stream que
+    entregar primeiro segue enquanto o outro é interrompido.
+    """
+
+    def __init__(self, model, timeout: float = LLM_TIMEOUT, max_concurrency: int = LLM_MAX_CONCURRENCY,
+                 breaker: Optional[CircuitBreaker] = None, hedge: bool = LLM_HEDGE,
+                 hedge_min_samples: int = LLM_HEDGE_MIN_SAMPLES):
+        self.model = model
+        self.timeout = timeout
+        self.max_concurrency = max_concurrency
+        self.breaker = breaker or CircuitBreaker()
+        self.hedge = hedge
+        self.hedge_min_samples = hedge_min_samples
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="gemini")
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._in_flight = 0
+        self._latencies = LatencyWindow()       # todas as chamadas (relatório)
+        self._full_latencies = LatencyWindow()  # generate(): base do hedge
+        self._first_chunk = LatencyWindow()     # stream(): base do hedge do primeiro trecho
+        self.counters = {"calls": 0, "ok": 0, "timeouts": 0, "errors": 0, "rejected": 0,
+                         "hedged": 0, "hedge_wins": 0, "streamed": 0, "stopped_early": 0}
+
+    def _semaphore(self) -> asyncio.Semaphore:
+        # Criado no loop em uso (o módulo é importado antes do loop existir)
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_concurrency)
+        return self._slots
+
+    def _start(self, fn: Callable, *args, **kwargs) -> asyncio.Future:
+        """Dispara `fn` numa thread; a vaga (já adquirida) volta quando ela termina"""
+        loop = asyncio.get_running_loop()
+        slots = self._semaphore()
+        self._in_flight += 1
+
+        def release(_):
+            self._in_flight -= 1
+            slots.release()
+
+        work = self._executor.submit(fn, *args, **kwargs)
+        work.add_done_callback(lambda f: _call_soon(loop, release, f))
+        future = asyncio.wrap_future(work)
+        # A requisição perdedora do hedge não é aguardada por ninguém
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        return future
+
+    def hedge_delay(self, window: Optional[LatencyWindow] = None) -> Optional[float]:
+        """Espera antes da requisição de reserva (p95 recente), ou None se desativado"""
+        if window is None:
+            window = self._full_latencies
+        if not self.hedge or len(window) < self.hedge_min_samples:
+            return None
+        return window.percentile(95)
+
+    async def _race(self, prompt: str, kwargs: Dict[str, Any]):
+        await self._semaphore().acquire()
+        primary = self._start(self.model.generate_content, prompt, **kwargs)
+
+        delay = self.hedge_delay()
+        if delay is None:
+            return await primary
+        done, _ = await asyncio.wait({primary}, timeout=delay)
+        if done or self._semaphore().locked():
+            return await primary
+
+        await self._semaphore().acquire()
+        backup = self._start(self.model.generate_content, prompt, **kwargs)
+        self.counters["hedged"] += 1
+
+        pending = {primary, backup}
+        error: Optional[BaseException] = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is backup:
+                        self.counters["hedge_wins"] += 1
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    async def _stream(self, prompt: str, on_text: Callable[[str], Awaitable[bool]], kwargs: Dict[str, Any]):
+        loop = asyncio.get_running_loop()
+        chunks: "asyncio.Queue[Tuple[int, Optional[str]]]" = asyncio.Queue()
+        stops: List[threading.Event] = []
+        works: List[asyncio.Future] = []
+        started = time.monotonic()
+
+        def consume(attempt: int, stop: threading.Event):
+            try:
+                response = self.model.generate_content(prompt, stream=True, **kwargs)
+                for chunk in response:
+                    if stop.is_set():
+                        break
+                    _call_soon(loop, chunks.put_nowait, (attempt, chunk.text))
+                if stop.is_set():
+                    # Fecha o stream gRPC para o modelo parar de gerar
+                    cancel = getattr(getattr(response, "_iterator", None), "cancel", None)
+                    if cancel:
+                        cancel()
+            finally:
+                _call_soon(loop, chunks.put_nowait, (attempt, None))
+
+        def launch():
+            stops.append(threading.Event())
+            works.append(self._start(consume, len(works), stops[-1]))
+
+        await self._semaphore().acquire()
+        launch()
+        delay = self.hedge_delay(self._first_chunk)
+        winner: Optional[int] = None
+        ended = 0
+        try:
+            while True:
+                wait = None
+                if winner is None and delay is not None:
+                    wait = max(0.0, started + delay - time.monotonic())
+                try:
+                    attempt, text = await asyncio.wait_for(chunks.get(), wait)
+                except asyncio.TimeoutError:
+                    # Primeiro trecho atrasado: um segundo stream, se houver vaga
+                    delay = None
+                    if not self._semaphore().locked():
+                        await self._semaphore().acquire()
+                        launch()
+                        self.counters["hedged"] += 1
+                    continue
+
+                if winner is None:
+                    if text is None:
+                        # Terminou (ou falhou) sem trecho nenhum
+                        ended += 1
+                        if ended < len(works):
+                            continue
+                        delay = None
+                        break
+                    winner = attempt
+                    delay = None
+                    self._first_chunk.add(time.monotonic() - started)
+                    if attempt:
+                        self.counters["hedge_wins"] += 1
+                    for other, stop in enumerate(stops):
+                        if other != winner:
+                            stop.set()
+                if attempt != winner:
+                    continue
+                if text is None:
+                    break
+                if not await on_text(text):
+                    stops[winner].set()
+                    self.counters["stopped_early"] += 1
+                    self._latencies.add(time.monotonic() - started)
+                    return
+            if winner is not None:
+                await works[winner]
+            else:
+                # Nenhum trecho: propaga o erro (de qualquer tentativa que falhou)
+                for work in works:
+                    await work
+            self._latencies.add(time.monotonic() - started)
+        finally:
+            for stop in stops:
+                stop.set()
+
+    async def _governed(self, call: Callable[[], Awaitable], record_latency: bool = True):
+        # Fora do estado fechado, a chamada liberada é a de teste (meio-aberto)
+        probe = self.breaker.state != "closed"
+        if not self.breaker.allow():
+            self.counters["rejected"] += 1
+            raise CircuitOpenError("Gemini indisponível (circuit breaker aberto)")
+
+        self.counters["calls"] += 1
+        started = time.monotonic()
+        try:
+            response = await asyncio.wait_for(call(), self.timeout)
+        except asyncio.TimeoutError:
+            self.counters["timeouts"] += 1
+            self.breaker.failure()
+            raise
+        except Exception:
+            self.counters["errors"] += 1
+            self.breaker.failure()
+            raise
+        except BaseException:
+            # Cancelada (cliente desistiu, turno abortado): sem isso o teste
+            # ficaria pendurado e o breaker recusaria tudo até reiniciar
+            if probe:
+                self.breaker.abandon()
+            raise
+
+        self.counters["ok"] += 1
+        self.breaker.success()
+        if record_latency:
+            # Streams registram o próprio tempo (e o do primeiro trecho) em _stream
+            elapsed = time.monotonic() - started
+            self._latencies.add(elapsed)
+            self._full_latencies.add(elapsed)
+        return response
+
+    async def generate(self, prompt: str, **kwargs):
+        """Resposta do modelo; CircuitOpenError, asyncio.TimeoutError ou o erro do Gemini"""
+        return await self._governed(lambda: self._race(prompt, kwargs))
+
+    async def stream(self, prompt: str, on_text: Callable[[str], Awaitable[bool]], **kwargs):
+        """
+        Gera com stream=True entregando cada trecho a `on_text`; quando ela
+        retorna False a geração é interrompida. Mesmos prazos e erros de generate().
+        """
+        self.counters["streamed"] += 1
+        await self._governed(lambda: self._stream(prompt, on_text, kwargs), record_latency=False)
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "breaker": self.breaker.state,
+            "breaker_opened": self.breaker.opened,
+            "in_flight": self._in_flight,
+            "max_concurrency": self.max_concurrency,
+            "hedge_after_ms": round((self.hedge_delay() or 0) * 1000, 1),
+            "stream_hedge_after_ms": round((self.hedge_delay(self._first_chunk) or 0) * 1000, 1),
+            **self._latencies.summary_ms("latency_ms"),
+            **self._first_chunk.summary_ms("first_chunk_ms"),
+            **self.counters,
+        }
@@ -0,0 +1,166 @@
+"""
+Fernanda IA - Casamento de Palavras-chave
+Autômato Aho-Corasick montado uma vez, com normalização sem acentos
+"""
+
+import re
+import unicodedata
+from typing import Dict, Any, List, Optional, Tuple, Iterable
+
+# Vocabulário fixo da extração (a ordem das datas define a prioridade)
+URGENCY_KEYWORDS = {
+    10: ['insuportável', 'não aguento', 'emergência'],
+    8: ['muita dor', 'bastante dor', 'doendo muito'],
+    6: ['dor', 'doendo', 'incômodo'],
+    3: ['desconforto', 'sensível'],
+}
+BOOKING_KEYWORDS = ['agendar', 'marcar', 'consulta', 'avaliacao', 'avaliação', 'operar', 'cirurgia']
+DATE_KEYWORDS = [('hoje', 'hoje'), ('amanhã', 'amanhã'), ('semana', 'esta semana')]
+# Perguntas frequentes (a ordem define a prioridade quando há mais de uma)
+FAQ_KEYWORDS = [
+    ('endereco', ['endereço', 'onde fica', 'onde vocês ficam', 'localização', 'como chego', 'qual a rua']),
+    ('horario', ['horário de funcionamento', 'horário de atendimento', 'que horas abre', 'que horas fecha',
+                 'abre que horas', 'fecha que horas', 'abre sábado', 'abrem sábado', 'abre domingo',
+                 'abrem domingo', 'funcionam', 'quais os horários']),
+    ('servicos', ['vocês fazem', 'vcs fazem', 'fazem clareamento', 'quais serviços', 'quais especialidades',
+                  'trabalham com', 'atendem convênio', 'aceitam convênio', 'quanto custa', 'qual o valor',
+                  'qual o preço']),
+]
+
+
+def _build_accent_table() -> Dict[int, str]:
+    table = {}
+    for code in range(0x00C0, 0x0250):
+        base = unicodedata.normalize("NFKD", chr(code))[0]
+        if base.isascii() and base != chr(code):
+            table[code] = base.lower()
+    return table
+
+
+_ACCENT_TABLE = _build_accent_table()
+
+
+def normalize(text: str) -> str:
+    """Minúsculas e sem acentos ("Não aguento" -> "nao aguento")"""
+    return text.lower().translate(_ACCENT_TABLE)
+
+
+_NON_WORD = re.compile(r"[^\w]+")
+
+
+def normalize_question(text: str) -> str:
+    """Forma canônica da mensagem: sem acentos, pontuação, emojis ou espaços extras"""
+    return _NON_WORD.sub(" ", normalize(text)).strip()
+
+
+class AhoCorasick:
+    """
+    Busca simultânea de muitas palavras-chave em uma passada pelo texto.
+
+    O custo da busca depende do tamanho da mensagem, não do número de
+    palavras-chave; casamentos sobrepostos são todos reportados.
+    """
+
+    def __init__(self, entries: Iterable[Tuple[str, Any]]):
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._out: List[List[Any]] = [[]]
+
+        for keyword, payload in entries:
+            state = 0
+            for ch in keyword:
+                nxt = self._goto[state].get(ch)
+                if nxt is None:
+                    nxt = len(self._goto)
+                    self._goto[state][ch] = nxt
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append([])
+                state = nxt
+            self._out[state].append(payload)
+
+        # Links de falha em largura; as saídas herdam as do estado de falha
+        queue = list(self._goto[0].values())
+        for state in queue:
+            for ch, nxt in self._goto[state].items():
+                queue.append(nxt)
+                fail = self._fail[state]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[nxt] = self._goto[fail].get(ch, 0)
+                self._out[nxt] = self._out[nxt] + self._out[self._fail[nxt]]
+
+    def find_all(self, text: str) -> List[Any]:
+        """Payloads de todas as palavras-chave que aparecem no texto"""
+        goto, fail, out = self._goto, self._fail, self._out
+        hits: List[Any] = []
+        state = 0
+        for ch in text:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if out[state]:
+                hits.extend(out[state])
+        return hits
+
+
+class MessageMatcher:
+    """
+    Extrai serviço, especialidade, urgência, datas, intenção de agendar e
+    perguntas frequentes de uma mensagem em uma única passada do autômato.
+
+    `services` é a lista (serviço, especialidade, palavras-chave) na ordem
+    da base de conhecimento; em empate vale o primeiro serviço da lista,
+    como na varredura linha a linha que este matcher substitui.
+    """
+
+    def __init__(self, services: List[Tuple[str, str, List[str]]]):
+        self.services = services
+        entries: List[Tuple[str, Any]] = []
+        for level, keywords in URGENCY_KEYWORDS.items():
+            entries += [(normalize(kw), ("urgency", level)) for kw in keywords]
+        for index, (_, _, keywords) in enumerate(services):
+            entries += [(normalize(kw), ("service", index)) for kw in keywords if kw.strip()]
+        entries += [(normalize(kw), ("booking", None)) for kw in BOOKING_KEYWORDS]
+        entries += [(normalize(kw), ("date", priority)) for priority, (kw, _) in enumerate(DATE_KEYWORDS)]
+        for priority, (_, keywords) in enumerate(FAQ_KEYWORDS):
+            entries += [(normalize(kw), ("faq", priority)) for kw in keywords]
+        self._automaton = AhoCorasick(entries)
+
+    def scan(self, message: str) -> Dict[str, Any]:
+        """Casamentos da mensagem, já resolvidos pelas regras de prioridade"""
+        urgency: Optional[int] = None
+        service: Optional[int] = None
+        date: Optional[int] = None
+        faq: Optional[int] = None
+        booking = False
+        service_rows = set()
+
+        for kind, value in self._automaton.find_all(normalize(message)):
+            if kind == "urgency":
+                urgency = value if urgency is None else max(urgency, value)
+            elif kind == "service":
+                service_rows.add(value)
+                service = value if service is None else min(service, value)
+            elif kind == "date":
+                date = value if date is None else min(date, value)
+            elif kind == "faq":
+                faq = value if faq is None else min(faq, value)
+            else:
+                booking = True
+
+        result: Dict[str, Any] = {"booking": booking, "service_rows": sorted(service_rows)}
+        if urgency is not None:
+            result["urgency"] = urgency
+        if service is not None:
+            result["service"] = self.services[service][0]
+            result["specialty"] = self.services[service][1]
+        if date is not None:
+            result["date_preference"] = DATE_KEYWORDS[date][1]
+        if faq is not None:
+            result["faq"] = FAQ_KEYWORDS[faq][0]
+        return result
+
+    def service_rows(self, message: str) -> List[int]:
+        """Índices dos serviços cujas palavras-chave aparecem na mensagem"""
+        return self.scan(message)["service_rows"]
@@ -0,0 +1,275 @@
+"""
+Fernanda IA - Métricas
+Janelas de amostras (latência, tokens) para os contadores expostos na API,
+histogramas e contadores no formato do Prometheus (/metrics) e spans por turno
+"""
+
+import os
+import json
+import time
+import asyncio
+from bisect import bisect_left
+from collections import deque
+from typing import Any, Callable, Deque, Dict, Iterable, List, Tuple
+
+# "json": uma linha JSON por turno no stdout; "off": sem log de turnos
+TURN_LOG = os.getenv("TURN_LOG", "json").lower()
+
+# Faixas dos histogramas de latência (segundos)
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class SampleWindow:
+    """Últimas `size` amostras numéricas com percentis sob demanda"""
+
+    def __init__(self, size: int = 1000):
+        self._samples: Deque[float] = deque(maxlen=size)
+
+    def add(self, value: float):
+        self._samples.append(value)
+
+    def extend(self, values: Iterable[float]):
+        self._samples.extend(values)
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    def percentile(self, pct: float) -> float:
+        if not self._samples:
+            return 0.0
+        ordered = sorted(self._samples)
+        index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+        return ordered[index]
+
+    def max(self) -> float:
+        return max(self._samples, default=0.0)
+
+    def mean(self) -> float:
+        return sum(self._samples) / len(self._samples) if self._samples else 0.0
+
+    def summary(self, prefix: str, scale: float = 1.0) -> dict:
+        """p50/p95/max (multiplicados por `scale`), com as chaves prefixadas"""
+        return {
+            f"{prefix}_p50": round(self.percentile(50) * scale, 1),
+            f"{prefix}_p95": round(self.percentile(95) * scale, 1),
+            f"{prefix}_max": round(self.max() * scale, 1),
+        }
+
+
+class LatencyWindow(SampleWindow):
+    """Amostras em segundos, resumidas em milissegundos"""
+
+    def summary_ms(self, prefix: str) -> dict:
+        return self.summary(prefix, scale=1000)
+
+
+class RouteStats:
+    """Quantas mensagens seguiram cada caminho (template, cache, modelo) e em quanto tempo"""
+
+    def __init__(self):
+        self.counts: Dict[str, int] = {}
+        self.latency: Dict[str, LatencyWindow] = {}
+
+    def record(self, route: str, seconds: float):
+        self.counts[route] = self.counts.get(route, 0) + 1
+        self.latency.setdefault(route, LatencyWindow()).add(seconds)
+
+    def report(self) -> dict:
+        total = sum(self.counts.values())
+        return {
+            route: {
+                "count": count,
+                "share": round(count / total, 3),
+                **self.latency[route].summary_ms("latency_ms"),
+            }
+            for route, count in sorted(self.counts.items())
+        }
+
+
+class LoopLagMonitor:
+    """
+    Atraso do event loop: acorda a cada `interval` segundos e mede quanto
+    passou do previsto (tempo em que algo segurou o loop sem await).
+    """
+
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self.lag = LatencyWindow()
+
+    async def run(self):
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(self.interval)
+            self.lag.add(max(0.0, time.monotonic() - started - self.interval))
+
+    def stats(self) -> dict:
+        return self.lag.summary_ms("lag_ms")
+
+
+class Histogram:
+    """Contagem por faixa, cumulativa na exportação (como o Prometheus): custo fixo por amostra"""
+
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # a última faixa é +Inf
+        self.total = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.total += value
+
+    @property
+    def count(self) -> int:
+        return sum(self.counts)
+
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+
+def _label_key(labels: Dict[str, str]) -> LabelKey:
+    items = tuple(labels.items())
+    return items if len(items) < 2 else tuple(sorted(items))
+
+
+def _labels(key: LabelKey) -> str:
+    if not key:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in key) + "}"
+
+
+def _number(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class MetricsRegistry:
+    """
+    Contadores e histogramas com rótulos, exportados no formato texto do Prometheus.
+
+    Tudo roda no event loop (sem travas); `collect` publica como gauges os
+    números que os componentes já mantêm em stats(), lidos só na exportação.
+    """
+
+    def __init__(self, namespace: str = "fernanda"):
+        self.namespace = namespace
+        self._meta: Dict[str, Tuple[str, str]] = {}
+        self._counters: Dict[str, Dict[LabelKey, float]] = {}
+        self._histograms: Dict[str, Dict[LabelKey, Histogram]] = {}
+        self._buckets: Dict[str, Tuple[float, ...]] = {}
+        self._collectors: List[Tuple[str, str, Callable[[], Dict[str, Any]]]] = []
+
+    def counter(self, name: str, help: str):
+        self._meta[name] = ("counter", help)
+        self._counters[name] = {}
+
+    def histogram(self, name: str, help: str, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self._meta[name] = ("histogram", help)
+        self._histograms[name] = {}
+        self._buckets[name] = buckets
+
+    def collect(self, name: str, help: str, stats: Callable[[], Dict[str, Any]]):
+        """Publica os valores numéricos de `stats()` como gauges `<name>_<chave>`"""
+        self._collectors.append((name, help, stats))
+
+    def inc(self, name: str, value: float = 1, **labels: str):
+        series = self._counters[name]
+        key = _label_key(labels)
+        series[key] = series.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels: str):
+        series = self._histograms[name]
+        key = _label_key(labels)
+        histogram = series.get(key)
+        if histogram is None:
+            histogram = series[key] = Histogram(self._buckets[name])
+        histogram.observe(value)
+
+    def render(self) -> str:
+        lines: List[str] = []
+        prefix = self.namespace
+        for name, series in self._counters.items():
+            lines.append(f"# HELP {prefix}_{name} {self._meta[name][1]}")
+            lines.append(f"# TYPE {prefix}_{name} counter")
+            for key, value in series.items():
+                lines.append(f"{prefix}_{name}{_labels(key)} {_number(value)}")
+        for name, series in self._histograms.items():
+            lines.append(f"# HELP {prefix}_{name} {self._meta[name][1]}")
+            lines.append(f"# TYPE {prefix}_{name} histogram")
+            for key, histogram in series.items():
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    lines.append(f"{prefix}_{name}_bucket{_labels(key + (('le', str(bound)),))} {cumulative}")
+                cumulative += histogram.counts[-1]
+                lines.append(f"{prefix}_{name}_bucket{_labels(key + (('le', '+Inf'),))} {cumulative}")
+                lines.append(f"{prefix}_{name}_sum{_labels(key)} {_number(histogram.total)}")
+                lines.append(f"{prefix}_{name}_count{_labels(key)} {cumulative}")
+        for name, help, stats in self._collectors:
+            for key, value in stats().items():
+                if isinstance(value, bool):
+                    value = int(value)
+                if not isinstance(value, (int, float)):
+                    continue
+                metric = f"{prefix}_{name}_{key}"
+                lines.append(f"# HELP {metric} {help}")
+                lines.append(f"# TYPE {metric} gauge")
+                lines.append(f"{metric} {_number(value)}")
+        return "\n".join(lines) + "\n"
+
+
+class _Span:
+    """Context manager de uma etapa (classe em vez de @contextmanager: metade do custo)"""
+
+    __slots__ = ("trace", "stage", "started")
+
+    def __init__(self, trace: "TurnTrace", stage: str):
+        self.trace = trace
+        self.stage = stage
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+
+    def __exit__(self, *exc) -> bool:
+        self.trace.add(self.stage, time.perf_counter() - self.started)
+        return False
+
+
+class TurnTrace:
+    """
+    Spans de um turno: quanto tempo cada etapa levou.
+
+    `span` soma o tempo da etapa (uma etapa pode se repetir no turno);
+    `finish` publica os histogramas e escreve uma linha de log.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages: Dict[str, float] = {}
+        self.fields: Dict[str, Any] = {}
+
+    def span(self, stage: str) -> _Span:
+        return _Span(self, stage)
+
+    def add(self, stage: str, seconds: float):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def tag(self, **fields: Any):
+        self.fields.update(fields)
+
+    def finish(self, registry: MetricsRegistry, stage_metric: str = "stage_seconds",
+               turn_metric: str = "turn_seconds") -> float:
+        """Publica as etapas e o total (por estado e caminho); retorna o total em segundos"""
+        elapsed = time.perf_counter() - self.started
+        for stage, seconds in self.stages.items():
+            registry.observe(stage_metric, seconds, stage=stage)
+        registry.observe(turn_metric, elapsed, state=str(self.fields.get("state", "")),
+                         route=str(self.fields.get("route", "")))
+        if TURN_LOG == "json":
+            log_event("turn", total_ms=round(elapsed * 1000, 2), **self.fields,
+                      stages_ms={stage: round(seconds * 1000, 2) for stage, seconds in self.stages.items()})
+        return elapsed
+
+
+def log_event(event: str, **fields: Any):
+    """Log estruturado: uma linha JSON por evento"""
+    record = {"ts": round(time.time(), 3), "event": event, **fields}
+    print(json.dumps(record, ensure_ascii=False, default=str))
@@ -0,0 +1,231 @@
+"""
+Fernanda IA - Montagem do Prompt
+Orçamento de tokens por seção e contabilidade de tokens por chamada
+"""
+
+import os
+import json
+from typing import Dict, Any, List, Optional, Tuple, Callable
+
+from fernanda_metrics import SampleWindow
+
+# Estimativa sem tokenizer: ~4 caracteres por token em português
+CHARS_PER_TOKEN = 4
+
+DEFAULT_BUDGETS = {
+    "persona": 2000,
+    "clinic": 500,
+    "knowledge": 800,
+    "history": 500,
+    "message": 400,
+}
+
+
+def load_budgets() -> Dict[str, int]:
+    """Orçamentos padrão, sobrescritos por PROMPT_BUDGETS="history=300,knowledge=600" """
+    budgets = dict(DEFAULT_BUDGETS)
+    for item in os.getenv("PROMPT_BUDGETS", "").split(","):
+        if "=" in item:
+            name, value = item.split("=", 1)
+            budgets[name.strip()] = int(value)
+    return budgets
+
+
+def estimate_tokens(text: Optional[str]) -> int:
+    """Estimativa barata de tokens para um texto"""
+    if not text:
+        return 0
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def truncate_to_tokens(text: str, budget: int) -> str:
+    """Corta o texto para caber no orçamento, preferindo fim de linha"""
+    limit = budget * CHARS_PER_TOKEN
+    if len(text) <= limit:
+        return text
+    cut = text.rfind("\n", 0, limit)
+    if cut < limit // 2:
+        cut = limit - 1
+    return text[:cut].rstrip() + "…"
+
+
+class PromptBuilder:
+    """
+    Monta o prompt da Fernanda respeitando um orçamento de tokens por seção.
+
+    Persona e dados da clínica são cortados uma única vez na construção.
+    A tabela de serviços entra inteira no prefixo fixo se couber no
+    orçamento; senão, a cada mensagem entram primeiro as linhas indicadas
+    por `row_matcher` (serviços citados na mensagem) e depois as demais,
+    até o limite.
+    O histórico mantém as interações mais recentes que couberem.
+    """
+
+    def __init__(self, persona: str, clinic_config: Dict[str, Any], kb_header: str,
+                 kb_rows: List[str], row_matcher: Optional[Callable[[str], List[int]]] = None,
+                 budgets: Optional[Dict[str, int]] = None):
+        self.budgets = budgets or load_budgets()
+        self.kb_header = kb_header
+        self.kb_rows = kb_rows
+        self.row_matcher = row_matcher
+
+        persona = truncate_to_tokens(persona, self.budgets["persona"])
+        clinic = truncate_to_tokens(
+            json.dumps(clinic_config, ensure_ascii=False, indent=2), self.budgets["clinic"]
+        )
+        head = f"""
+{persona}
+
+=== DADOS DA CLÍNICA ===
+{clinic}
+
+=== BASE DE CONHECIMENTO ===
+Serviços disponíveis:
+"""
+        full_table = "\n".join([kb_header] + kb_rows)
+        self.kb_fits = estimate_tokens(full_table) <= self.budgets["knowledge"]
+        self.static_prefix = head + (full_table + "\n" if self.kb_fits else "")
+        self.static_tokens = {
+            "persona": estimate_tokens(persona),
+            "clinic": estimate_tokens(clinic),
+        }
+        self._full_table_tokens = estimate_tokens(full_table)
+
+    def knowledge_section(self, message: str) -> Tuple[str, int]:
+        """Linhas da tabela de serviços para esta mensagem (vazio se já está no prefixo)"""
+        if self.kb_fits:
+            return "", self._full_table_tokens
+
+        relevant = self.row_matcher(message) if self.row_matcher else []
+        relevant_set = set(relevant)
+        others = [i for i in range(len(self.kb_rows)) if i not in relevant_set]
+
+        used = estimate_tokens(self.kb_header)
+        chosen = []
+        for i in relevant + others:
+            cost = estimate_tokens(self.kb_rows[i]) + 1
+            if used + cost > self.budgets["knowledge"]:
+                break
+            chosen.append(i)
+            used += cost
+
+        lines = [self.kb_header] + [self.kb_rows[i] for i in sorted(chosen)]
+        omitted = len(self.kb_rows) - len(chosen)
+        if omitted:
+            lines.append(f"(+{omitted} serviços omitidos)")
+        text = "\n".join(lines) + "\n"
+        return text, estimate_tokens(text)
+
+    def history_section(self, history: List[Dict[str, Any]], max_turns: int = 3) -> str:
+        """Interações mais recentes que cabem no orçamento, em ordem cronológica"""
+        budget = self.budgets["history"]
+        used = 0
+        lines: List[str] = []
+        for h in reversed(history[-max_turns:]):
+            line = f"Paciente: {h['user']}\nFernanda: {h['bot']}\n"
+            cost = estimate_tokens(line)
+            if used + cost > budget:
+                if not lines:
+                    # Nem a última interação cabe inteira: corta o texto
+                    lines.append(truncate_to_tokens(line, budget) + "\n")
+                break
+            lines.append(line)
+            used += cost
+
+        omitted = min(len(history), max_turns) - len(lines)
+        text = "".join(reversed(lines))
+        if omitted > 0 and text:
+            text = f"(+{omitted} interações anteriores omitidas)\n" + text
+        return text
+
+    def render(self, context: Dict[str, Any], history: List[Dict[str, Any]],
+               user_message: str, missing: List[str]) -> Tuple[str, Dict[str, int]]:
+        """Prompt completo e a estimativa de tokens por seção"""
+        knowledge, knowledge_tokens = self.knowledge_section(user_message)
+        recent_history = self.history_section(history)
+        message = truncate_to_tokens(user_message, self.budgets["message"])
+
+        dynamic = f"""
+=== CONTEXTO DA CONVERSA ===
+Estado: {context['estado_atual']}
+Mensagem número: {context['mensagem_numero']}
+Paciente já conhecido: {'Sim' if context['paciente_conhecido'] else 'Não'}
+
+=== INFORMAÇÕES JÁ COLETADAS ===
+{json.dumps(context['informacoes_coletadas'], ensure_ascii=False, indent=2)}
+"""
+        free_slots = context.get('horarios_livres')
+        if free_slots is not None:
+            listed = "\n".join(f"- {slot}" for slot in free_slots) or \
+                "Nenhum horário livre nos próximos dias: diga que a equipe vai retornar com opções"
+            dynamic += f"""
+=== HORÁRIOS LIVRES (agenda real) ===
+{listed}
+"""
+        instructions = f"""
+=== INSTRUÇÕES CRÍTICAS ===
+1. NUNCA se apresente novamente após a primeira mensagem
+2. Se é urgência (dor), seja empática mas RÁPIDA - sugira o horário livre mais próximo
+3. Use o nome do paciente quando souber
+4. Colete apenas UMA informação faltante por vez
+5. Seja natural e humana, não robótica
+6. Responda em no máximo 2-3 frases
+Se o paciente demonstrou intenção de AGENDAR (ex.: "marcar", "agendar", "consulta", "operar", "cirurgia"), vá DIRETO ao agendamento: sugira 2 opções da lista HORÁRIOS LIVRES (nunca invente horários) e peça só a confirmação.
+8. Não pergunte sobre tipo de dor (ex.: latejante, pontada, constante) nem peça para “classificar a dor”. Isso NÃO é necessário para agendar.
+9. Evite repetir a mesma pergunta em mensagens consecutivas. Se já pediu uma informação nas últimas 2 mensagens, avance com uma sugestão de horário.
+10. Informações faltantes: {', '.join(missing) if missing else 'Todas coletadas - pode confirmar agendamento'}
+IMPORTANTE: Responda EXATAMENTE como a Fernanda responderia - humana, calorosa, eficiente.
+Resposta (máximo 3 frases):"""
+
+        prompt = self.static_prefix + knowledge + f"""{dynamic}
+=== HISTÓRICO RECENTE ===
+{recent_history if recent_history else "Primeira interação com este paciente"}
+
+=== MENSAGEM ATUAL ===
+Paciente: {message}
+{instructions}"""
+
+        sections = {
+            **self.static_tokens,
+            "knowledge": knowledge_tokens,
+            "context": estimate_tokens(dynamic),
+            "history": estimate_tokens(recent_history),
+            "message": estimate_tokens(message),
+            "instructions": estimate_tokens(instructions),
+        }
+        return prompt, sections
+
+
+class TokenStats:
+    """Tokens estimados de entrada/saída por chamada ao modelo"""
+
+    def __init__(self):
+        self.prompt_tokens = SampleWindow()
+        self.output_tokens = SampleWindow()
+        self.sections: Dict[str, SampleWindow] = {}
+        self.calls = 0
+        self.total_input = 0
+        self.total_output = 0
+
+    def record_sections(self, sections: Dict[str, int]):
+        for name, tokens in sections.items():
+            self.sections.setdefault(name, SampleWindow()).add(tokens)
+
+    def record_call(self, input_tokens: int, output_tokens: int):
+        self.calls += 1
+        self.total_input += input_tokens
+        self.total_output += output_tokens
+        self.prompt_tokens.add(input_tokens)
+        self.output_tokens.add(output_tokens)
+
+    def report(self) -> Dict[str, Any]:
+        return {
+            "calls": self.calls,
+            "total_input_tokens": self.total_input,
+            "total_output_tokens": self.total_output,
+            **self.prompt_tokens.summary("prompt_tokens"),
+            **self.output_tokens.summary("output_tokens"),
+            "sections_p95": {
+                name: round(window.percentile(95)) for name, window in self.sections.items()
+            },
+        }
@@ -0,0 +1,237 @@
+"""
+Fernanda IA - Agenda
+Horários livres por especialidade (horário de funcionamento + duração dos serviços + reservas)
+"""
+
+import os
+import re
+from datetime import date, datetime, timedelta
+from typing import Dict, Any, Iterable, List, Optional, Tuple
+
+import pytz
+
+SLOT_UNIT_MIN = 5  # resolução da agenda (minutos); as reservas são gravadas nesta unidade
+SCHEDULE_STEP_MIN = int(os.getenv("SCHEDULE_STEP_MIN", "30"))              # horários oferecidos: de 30 em 30 min
+SCHEDULE_HORIZON_DAYS = int(os.getenv("SCHEDULE_HORIZON_DAYS", "14"))
+SCHEDULE_LEAD_MIN = int(os.getenv("SCHEDULE_LEAD_MIN", "60"))              # antecedência mínima para hoje
+SCHEDULE_DEFAULT_DURATION = int(os.getenv("SCHEDULE_DEFAULT_DURATION", "30"))
+SCHEDULE_REFRESH_INTERVAL = float(os.getenv("SCHEDULE_REFRESH_INTERVAL", "30"))  # s, reservas de outros workers
+# Fuso da clínica: o container roda em UTC, mas "hoje" e o expediente são no horário local
+CLINIC_TZ = pytz.timezone(os.getenv("CLINIC_TZ", "America/Sao_Paulo"))
+
+WEEKDAYS = ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday"]
+WEEKDAY_NAMES = ["segunda", "terça", "quarta", "quinta", "sexta", "sábado", "domingo"]
+WEEKDAY_PATTERN = re.compile(r"\b(segunda|ter[cç]a|quarta|quinta|sexta|s[aá]bado|domingo)\b", re.IGNORECASE)
+DAY_MONTH_PATTERN = re.compile(r"\b(\d{1,2})/(\d{1,2})\b")
+
+Slot = Tuple[str, str]  # (AAAA-MM-DD, HH:MM)
+
+
+def clinic_now() -> datetime:
+    """Agora no fuso da clínica (sem tzinfo, como os horários da agenda)"""
+    return datetime.now(CLINIC_TZ).replace(tzinfo=None)
+
+
+def clinic_today() -> date:
+    return clinic_now().date()
+
+
+def _minutes(hhmm: str) -> int:
+    hours, minutes = hhmm.split(":")
+    return int(hours) * 60 + int(minutes)
+
+
+def _hhmm(minute: int) -> str:
+    return f"{minute // 60:02d}:{minute % 60:02d}"
+
+
+def _units(duration_min: int) -> int:
+    return max(1, -(-duration_min // SLOT_UNIT_MIN))
+
+
+def _range_mask(first: int, last: int) -> int:
+    """Bits [first, last) ligados"""
+    return ((1 << last) - 1) ^ ((1 << first) - 1) if last > first else 0
+
+
+def _run_starts(free: int, units: int) -> int:
+    """Bits i em que `units` unidades seguidas (i .. i+units-1) estão livres"""
+    covered = 1
+    while covered < units:
+        shift = min(covered, units - covered)
+        free &= free >> shift
+        covered += shift
+    return free
+
+
+def resolve_date(message: str, date_preference: Optional[str], today: date) -> Optional[str]:
+    """Data ISO citada na mensagem ("hoje", "amanhã", dia da semana, dd/mm), ou None"""
+    if date_preference == "hoje":
+        return today.isoformat()
+    if date_preference == "amanhã":
+        return (today + timedelta(days=1)).isoformat()
+    match = DAY_MONTH_PATTERN.search(message)
+    if match:
+        day, month = int(match.group(1)), int(match.group(2))
+        try:
+            resolved = date(today.year, month, day)
+        except ValueError:
+            return None
+        if resolved < today:
+            # "10/01" em dezembro é do ano que vem
+            try:
+                resolved = date(today.year + 1, month, day)
+            except ValueError:
+                return None
+        return resolved.isoformat()
+    match = WEEKDAY_PATTERN.search(message)
+    if match:
+        name = match.group(1).lower().replace("ç", "c").replace("á", "a")
+        weekday = [w.replace("ç", "c").replace("á", "a") for w in WEEKDAY_NAMES].index(name)
+        ahead = (weekday - today.weekday()) % 7 or 7
+        return (today + timedelta(days=ahead)).isoformat()
+    return None
+
+
+def describe_day(day: str, today: Optional[date] = None) -> str:
+    """"hoje", "amanhã" ou "quinta, 22/10" para mensagens e prompt"""
+    today = today or clinic_today()
+    parsed = date.fromisoformat(day)
+    if parsed == today:
+        return "hoje"
+    if parsed == today + timedelta(days=1):
+        return "amanhã"
+    return f"{WEEKDAY_NAMES[parsed.weekday()]}, {parsed.day:02d}/{parsed.month:02d}"
+
+
+class ScheduleIndex:
+    """
+    Agenda em bitmaps: para cada (especialidade, dia), um int em que o bit i
+    é a unidade i do dia (SLOT_UNIT_MIN minutos a partir de 00:00) ocupada.
+
+    Livres = expediente do dia da semana & ~ocupados; as posições onde cabe
+    um serviço de k unidades saem de ~log2(k) ANDs com deslocamento, e os
+    primeiros N horários são os bits mais baixos. Tudo em memória: a
+    consulta não toca no banco. As reservas valem no banco (appointment_slots);
+    este índice é recarregado de lá periodicamente e após um conflito.
+    """
+
+    def __init__(self, business_hours: Dict[str, Any], step_min: int = SCHEDULE_STEP_MIN,
+                 horizon_days: int = SCHEDULE_HORIZON_DAYS, lead_min: int = SCHEDULE_LEAD_MIN):
+        self.horizon_days = horizon_days
+        self.lead_min = lead_min
+        # Inícios oferecidos: múltiplos de step_min
+        step = max(1, step_min // SLOT_UNIT_MIN)
+        self._grid = sum(1 << unit for unit in range(0, 24 * 60 // SLOT_UNIT_MIN, step))
+        self._open: List[int] = []
+        self._busy: Dict[Tuple[str, str], int] = {}
+        self.counters = {"queries": 0, "reloads": 0, "reserved": 0, "conflicts": 0, "unavailable": 0}
+        self.set_business_hours(business_hours)
+
+    def set_business_hours(self, business_hours: Dict[str, Any]):
+        """Expediente por dia da semana (formato do clinica_config.json)"""
+        masks = []
+        for weekday in WEEKDAYS:
+            hours = business_hours.get(weekday) or {"closed": True}
+            if hours.get("closed") or not hours.get("open") or not hours.get("close"):
+                masks.append(0)
+                continue
+            masks.append(_range_mask(_minutes(hours["open"]) // SLOT_UNIT_MIN,
+                                     _minutes(hours["close"]) // SLOT_UNIT_MIN))
+        self._open = masks
+
+    # --- Reservas conhecidas ---
+    def load(self, rows: Iterable[Tuple[str, str, int]], days: Optional[Iterable[Tuple[str, str]]] = None):
+        """
+        Substitui os ocupados pelas linhas de appointment_slots. Com `days`,
+        só esses (especialidade, dia) são trocados; senão, o índice inteiro.
+        """
+        busy: Dict[Tuple[str, str], int] = {key: 0 for key in days} if days is not None else {}
+        for specialty, day, minute in rows:
+            key = (specialty, day)
+            busy[key] = busy.get(key, 0) | (1 << (minute // SLOT_UNIT_MIN))
+        if days is None:
+            self._busy = busy
+        else:
+            self._busy.update(busy)
+        self.counters["reloads"] += 1
+
+    def occupy(self, specialty: str, day: str, time_: str, duration_min: int):
+        """Marca um horário recém-reservado (sem esperar a próxima recarga)"""
+        first = _minutes(time_) // SLOT_UNIT_MIN
+        key = (specialty, day)
+        self._busy[key] = self._busy.get(key, 0) | _range_mask(first, first + _units(duration_min))
+        self.counters["reserved"] += 1
+
+    @staticmethod
+    def reservation_minutes(time_: str, duration_min: int) -> List[int]:
+        """Minutos (em unidades da agenda) que uma reserva ocupa, como gravados no banco"""
+        first = _minutes(time_) // SLOT_UNIT_MIN * SLOT_UNIT_MIN
+        return [first + i * SLOT_UNIT_MIN for i in range(_units(duration_min))]
+
+    # --- Consultas ---
+    def _starts(self, specialty: str, day: date, units: int, not_before: int) -> int:
+        free = self._open[day.weekday()] & ~self._busy.get((specialty, day.isoformat()), 0)
+        if not free:
+            return 0
+        starts = _run_starts(free, units) & self._grid
+        if not_before:
+            starts &= ~((1 << not_before) - 1)
+        return starts
+
+    def free_slots(self, specialty: str, duration_min: int, count: int = 2,
+                   now: Optional[datetime] = None, from_day: Optional[str] = None,
+                   from_time: Optional[str] = None) -> List[Slot]:
+        """
+        Próximos `count` horários em que o serviço cabe inteiro, a partir de
+        agora (com SCHEDULE_LEAD_MIN de antecedência) ou de `from_day`/`from_time`.
+        """
+        self.counters["queries"] += 1
+        now = now or clinic_now()
+        today = now.date()
+        units = _units(duration_min)
+        earliest_today = -(-(now.hour * 60 + now.minute + self.lead_min) // SLOT_UNIT_MIN)
+
+        day = today
+        if from_day:
+            requested = date.fromisoformat(from_day)
+            if requested > today:
+                day = requested
+        # O horário pedido vale para os dias seguintes também ("14h" não vira "08:00" de amanhã)
+        preferred = _minutes(from_time) // SLOT_UNIT_MIN if from_time else 0
+
+        slots: List[Slot] = []
+        last_day = today + timedelta(days=self.horizon_days)
+        while day <= last_day and len(slots) < count:
+            not_before = max(preferred, earliest_today) if day == today else preferred
+            starts = self._starts(specialty, day, units, not_before)
+            while starts and len(slots) < count:
+                lowest = starts & -starts
+                slots.append((day.isoformat(), _hhmm((lowest.bit_length() - 1) * SLOT_UNIT_MIN)))
+                starts ^= lowest
+            day += timedelta(days=1)
+        if from_time and len(slots) < count:
+            # Nada depois do horário pedido: completa com os mais cedo
+            extra = self.free_slots(specialty, duration_min, count, now, from_day)
+            slots += [slot for slot in extra if slot not in slots][:count - len(slots)]
+        return slots
+
+    def is_free(self, specialty: str, day: str, time_: str, duration_min: int,
+                now: Optional[datetime] = None) -> bool:
+        """O serviço cabe inteiro a partir de day/time_ (dentro do expediente e no futuro)?"""
+        now = now or clinic_now()
+        try:
+            parsed = date.fromisoformat(day)
+            first = _minutes(time_) // SLOT_UNIT_MIN
+        except ValueError:
+            return False
+        if parsed < now.date() or parsed > now.date() + timedelta(days=self.horizon_days):
+            return False
+        if parsed == now.date() and first * SLOT_UNIT_MIN < now.hour * 60 + now.minute + self.lead_min:
+            return False
+        needed = _range_mask(first, first + _units(duration_min))
+        free = self._open[parsed.weekday()] & ~self._busy.get((specialty, day), 0)
+        return free & needed == needed
+
+    def stats(self) -> Dict[str, Any]:
+        return {"days_indexed": len(self._busy), **self.counters}
@@ -0,0 +1,316 @@
+"""
+Fernanda IA - Estado Compartilhado das Conversas
+Estado serializado num armazenamento comum (SQLite) com trava por telefone entre processos,
+ou só em memória quando há um único worker (o padrão)
+"""
+
+import os
+import json
+import time
+import uuid
+import asyncio
+from abc import ABC, abstractmethod
+from contextlib import asynccontextmanager
+from typing import Dict, Any, Callable, Optional, Tuple
+
+import fernanda_db
+from fernanda_db import Database, ConversationLockLostError
+from fernanda_conversations import ConversationStore, CONVERSATION_TTL
+from fernanda_metrics import LatencyWindow
+
+# Com um worker não há com quem compartilhar: o backend em memória evita as idas
+# ao banco (trava, leitura, renovação e gravação) a cada turno
+UVICORN_WORKERS = int(os.getenv("UVICORN_WORKERS", "1"))
+CONVERSATION_BACKEND = os.getenv("CONVERSATION_BACKEND", "memory" if UVICORN_WORKERS <= 1 else "sqlite")
+CONVERSATION_LOCK_LEASE = float(os.getenv("CONVERSATION_LOCK_LEASE", "60"))      # s
+CONVERSATION_LOCK_TIMEOUT = float(os.getenv("CONVERSATION_LOCK_TIMEOUT", "90"))  # s
+
+
+class LockTimeoutError(Exception):
+    """Outro processo segurou a conversa por mais tempo que o permitido"""
+
+
+class StateBackend(ABC):
+    """
+    Interface de armazenamento do estado das conversas.
+
+    `load` recebe a versão que o processo já tem em cache e devolve None
+    (conversa inexistente), (versão, None) se nada mudou ou (versão, dados).
+    `renew` estende o prazo da trava enquanto o dono ainda a tem. `save`
+    grava e solta a trava do dono na mesma operação, ou levanta
+    ConversationLockLostError se a trava já é de outro. `reset_field` zera
+    um campo do estado gravado e sobe a versão, sem trava.
+    """
+
+    name = "base"
+
+    @abstractmethod
+    async def acquire(self, phone: str, owner: str, lease: float) -> bool:
+        ...
+
+    @abstractmethod
+    async def renew(self, phone: str, owner: str, lease: float) -> bool:
+        ...
+
+    @abstractmethod
+    async def release(self, phone: str, owner: str):
+        ...
+
+    @abstractmethod
+    async def load(self, phone: str, known_version: Optional[int]) -> Optional[Tuple[int, Optional[str]]]:
+        ...
+
+    @abstractmethod
+    async def save(self, phone: str, data: str, owner: str) -> int:
+        ...
+
+    @abstractmethod
+    async def reset_field(self, phone: str, key: str):
+        ...
+
+    @abstractmethod
+    async def delete(self, phone: str):
+        ...
+
+    @abstractmethod
+    async def expire(self, idle: float) -> int:
+        ...
+
+    @abstractmethod
+    async def count(self, idle: float) -> int:
+        ...
+
+
+class SQLiteStateBackend(StateBackend):
+    """Tabelas conversation_state/conversation_locks no mesmo banco da aplicação"""
+
+    name = "sqlite"
+
+    def __init__(self, db: Database):
+        self.db = db
+
+    async def acquire(self, phone, owner, lease):
+        return await self.db.write(fernanda_db.acquire_conversation_lock, phone, owner, time.time(), lease)
+
+    async def renew(self, phone, owner, lease):
+        return await self.db.write(fernanda_db.renew_conversation_lock, phone, owner, time.time(), lease)
+
+    async def release(self, phone, owner):
+        await self.db.write(fernanda_db.release_conversation_lock, phone, owner)
+
+    async def load(self, phone, known_version):
+        return await self.db.read(fernanda_db.fetch_conversation_state, phone, known_version)
+
+    async def save(self, phone, data, owner):
+        return await self.db.write(fernanda_db.save_conversation_state, phone, data, time.time(), owner)
+
+    async def reset_field(self, phone, key):
+        await self.db.write(fernanda_db.reset_conversation_state_field, phone, key)
+
+    async def delete(self, phone):
+        await self.db.write(fernanda_db.delete_conversation_state, phone)
+
+    async def expire(self, idle):
+        return await self.db.write(fernanda_db.delete_idle_conversation_states, time.time() - idle)
+
+    async def count(self, idle):
+        return await self.db.read(fernanda_db.count_active_conversations, time.time() - idle)
+
+
+class MemoryStateBackend(StateBackend):
+    """Estado só neste processo (padrão com um único worker)"""
+
+    name = "memory"
+
+    def __init__(self, db: Optional[Database] = None):
+        self._states: Dict[str, Tuple[int, str, float]] = {}
+        self._locks: Dict[str, Tuple[str, float]] = {}
+
+    async def acquire(self, phone, owner, lease):
+        now = time.time()
+        holder = self._locks.get(phone)
+        if holder and holder[1] >= now:
+            return False
+        self._locks[phone] = (owner, now + lease)
+        return True
+
+    async def renew(self, phone, owner, lease):
+        if self._locks.get(phone, (None,))[0] != owner:
+            return False
+        self._locks[phone] = (owner, time.time() + lease)
+        return True
+
+    async def release(self, phone, owner):
+        if self._locks.get(phone, (None,))[0] == owner:
+            del self._locks[phone]
+
+    async def load(self, phone, known_version):
+        state = self._states.get(phone)
+        if state is None:
+            return None
+        version, data, _ = state
+        return version, (None if version == known_version else data)
+
+    async def save(self, phone, data, owner):
+        if self._locks.get(phone, (None,))[0] != owner:
+            raise ConversationLockLostError(f"Trava da conversa {phone} perdida")
+        version = self._states.get(phone, (0,))[0] + 1
+        self._states[phone] = (version, data, time.time())
+        await self.release(phone, owner)
+        return version
+
+    async def reset_field(self, phone, key):
+        state = self._states.get(phone)
+        if state is not None:
+            version, data, updated = state
+            self._states[phone] = (version + 1, json.dumps({**json.loads(data), key: None}), updated)
+
+    async def delete(self, phone):
+        self._states.pop(phone, None)
+
+    async def expire(self, idle):
+        cutoff = time.time() - idle
+        stale = [phone for phone, (_, _, updated) in self._states.items() if updated < cutoff]
+        for phone in stale:
+            del self._states[phone]
+        return len(stale)
+
+    async def count(self, idle):
+        cutoff = time.time() - idle
+        return sum(1 for _, _, updated in self._states.values() if updated >= cutoff)
+
+
+# Backends disponíveis (CONVERSATION_BACKEND); outros podem ser registrados aqui
+STATE_BACKENDS: Dict[str, Callable[[Database], StateBackend]] = {
+    "sqlite": SQLiteStateBackend,
+    "memory": MemoryStateBackend,
+}
+
+
+def create_state_backend(db: Database, name: str = CONVERSATION_BACKEND) -> StateBackend:
+    if name not in STATE_BACKENDS:
+        raise ValueError(f"CONVERSATION_BACKEND desconhecido: {name} (opções: {', '.join(STATE_BACKENDS)})")
+    return STATE_BACKENDS[name](db)
+
+
+class SharedConversations:
+    """
+    Conversas compartilhadas entre os workers do uvicorn.
+
+    session(phone) trava o telefone no backend (aguardando com backoff se
+    outro processo estiver com ele), carrega o estado e, ao sair sem erro,
+    grava o estado e solta a trava. Enquanto a sessão dura, a trava é
+    renovada a cada terço do `lease`; se mesmo assim ela vencer e outro
+    processo a pegar, a gravação é recusada (ConversationLockLostError) e a
+    cópia local descartada, em vez de sobrescrever o estado do outro.
+
+    O `local` (LRU do processo) guarda os objetos já desserializados: se a
+    versão no backend é a mesma do cache, o JSON nem é lido.
+    """
+
+    def __init__(self, backend: StateBackend, local: ConversationStore,
+                 from_dict: Callable[[Dict[str, Any]], Any], ttl: float = CONVERSATION_TTL,
+                 lease: float = CONVERSATION_LOCK_LEASE, lock_timeout: float = CONVERSATION_LOCK_TIMEOUT):
+        self.backend = backend
+        self.local = local
+        self.from_dict = from_dict
+        self.ttl = ttl
+        self.lease = lease
+        self.lock_timeout = lock_timeout
+        self._lock_waits = LatencyWindow()
+        self.counters = {"sessions": 0, "created": 0, "reloaded": 0, "discarded": 0,
+                         "lock_contended": 0, "lock_timeouts": 0, "lock_renewed": 0, "lock_lost": 0}
+
+    async def _acquire(self, phone: str, owner: str):
+        started = time.monotonic()
+        delay = 0.01
+        contended = False
+        while not await self.backend.acquire(phone, owner, self.lease):
+            if not contended:
+                contended = True
+                self.counters["lock_contended"] += 1
+            if time.monotonic() - started > self.lock_timeout:
+                self.counters["lock_timeouts"] += 1
+                raise LockTimeoutError(f"Conversa {phone} travada há mais de {self.lock_timeout:.0f}s")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.2)
+        self._lock_waits.add(time.monotonic() - started)
+
+    async def _keep_lease(self, phone: str, owner: str):
+        """Renova a trava enquanto a sessão estiver aberta"""
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            if not await self.backend.renew(phone, owner, self.lease):
+                return
+            self.counters["lock_renewed"] += 1
+
+    async def _load(self, phone: str):
+        cached = self.local.get(phone)
+        row = await self.backend.load(phone, cached.version if cached else None)
+        if row is None:
+            # Nova (ou resetada/expirada em outro worker)
+            memory = self.local.factory(phone)
+            self.counters["created"] += 1
+        elif row[1] is None:
+            return cached
+        else:
+            if cached:
+                self.counters["reloaded"] += 1
+            memory = self.from_dict(json.loads(row[1]))
+            memory.version = row[0]
+        self.local.put(phone, memory)
+        return memory
+
+    @asynccontextmanager
+    async def session(self, phone: str):
+        """Conversa travada para este processo durante o bloco"""
+        owner = f"{os.getpid()}:{uuid.uuid4().hex[:12]}"
+        await self._acquire(phone, owner)
+        self.counters["sessions"] += 1
+        keeper = asyncio.create_task(self._keep_lease(phone, owner))
+        try:
+            memory = await self._load(phone)
+            yield memory
+            keeper.cancel()
+            data = json.dumps(memory.to_dict(), ensure_ascii=False)
+            memory.version = await self.backend.save(phone, data, owner)
+        except BaseException as e:
+            # Estado pela metade não é gravado; a cópia local é descartada
+            if isinstance(e, ConversationLockLostError):
+                self.counters["lock_lost"] += 1
+            self.counters["discarded"] += 1
+            self.local.pop(phone)
+            await self.backend.release(phone, owner)
+            raise
+        finally:
+            keeper.cancel()
+
+    async def reset(self, phone: str):
+        self.local.pop(phone)
+        await self.backend.delete(phone)
+
+    async def reset_field(self, phone: str, key: str):
+        """
+        Zera `key` na cópia local e no estado gravado. A versão sobe, então os
+        outros workers recarregam o estado em vez de usar o cache deles.
+        """
+        memory = self.local.peek(phone)
+        if memory is not None:
+            setattr(memory, key, None)
+        await self.backend.reset_field(phone, key)
+
+    async def count(self) -> int:
+        """Conversas com atividade dentro do TTL (em todos os workers)"""
+        return await self.backend.count(self.ttl)
+
+    async def expire(self) -> int:
+        self.local.evict_expired()
+        return await self.backend.expire(self.ttl)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "backend": self.backend.name,
+            "local": self.local.stats(),
+            **self._lock_waits.summary_ms("lock_wait_ms"),
+            **self.counters,
+        }
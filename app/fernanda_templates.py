@@ -0,0 +1,111 @@
+"""
+Fernanda IA - Respostas por Template
+Turnos previsíveis (confirmação, agradecimento) respondidos sem chamar o Gemini
+"""
+
+from typing import Dict, Any, Optional, Tuple, FrozenSet
+
+from fernanda_matcher import normalize, normalize_question
+
+# Palavras que levam CONFIRMING -> COMPLETED em update_conversation_state
+CONFIRM_WORDS = ['sim', 'confirmo', 'pode ser', 'perfeito', 'ok', 'beleza', 'fechado']
+
+# Vocabulário de respostas curtas: mensagens só com estas palavras são previsíveis
+CONFIRM_VOCABULARY = frozenset(normalize(w) for w in [
+    'sim', 's', 'confirmo', 'confirmado', 'confirma', 'confirmar', 'pode', 'ser', 'perfeito',
+    'ok', 'okay', 'okk', 'beleza', 'blz', 'fechado', 'combinado', 'certo', 'isso', 'claro',
+    'ótimo', 'otimo', 'então', 'por', 'favor', 'pfv', 'marcar', 'esse', 'este', 'mesmo',
+])
+THANKS_VOCABULARY = frozenset(normalize(w) for w in [
+    'obrigado', 'obrigada', 'obg', 'brigado', 'brigada', 'valeu', 'vlw', 'muito', 'mt', 'mto',
+    'agradeço', 'gratidão', 'de', 'nada', 'até', 'mais', 'logo', 'tchau', 'então',
+])
+THANKS_WORDS = frozenset(normalize(w) for w in [
+    'obrigado', 'obrigada', 'obg', 'brigado', 'brigada', 'valeu', 'vlw', 'agradeço', 'gratidão',
+])
+MAX_REPLY_WORDS = 6
+
+TEMPLATES = {
+    "confirm_booking": "Perfeito{name}! Seu agendamento{service}{when} está confirmado ✅ "
+                       "Qualquer dúvida é só me chamar por aqui.",
+    "thanks": "Imagina{name}! Estamos te esperando 😊 Qualquer coisa é só chamar.",
+    "ack": "Combinado{name}! Seu agendamento{when} continua confirmado. Até breve 😊",
+    "no_slot": "Obrigada{name}! Não encontrei um horário livre{service} nos próximos dias, "
+               "então nossa equipe vai te retornar por aqui com opções 💬",
+    "no_slot_ack": "Combinado{name}! Assim que a equipe tiver um horário eu te aviso por aqui 😊",
+}
+
+
+def _words(message: str) -> Tuple[str, ...]:
+    return tuple(normalize_question(message).split())
+
+
+def _only(words: Tuple[str, ...], vocabulary: FrozenSet[str]) -> bool:
+    return len(words) <= MAX_REPLY_WORDS and all(w in vocabulary for w in words)
+
+
+def fill_slots(slots: Dict[str, Any]) -> Dict[str, str]:
+    """Trechos opcionais do template (vazios quando a informação não foi coletada)"""
+    name = (slots.get("name") or "").split()
+    date, time_ = slots.get("date"), slots.get("time")
+    when = ""
+    if date and time_:
+        when = f" para {date} às {time_}"
+    elif date:
+        when = f" para {date}"
+    elif time_:
+        when = f" às {time_}"
+    service = slots.get("service")
+    return {
+        "name": f", {name[0].capitalize()}" if name else "",
+        "service": f" de {service}" if service else "",
+        "when": when,
+    }
+
+
+class TemplateEngine:
+    """
+    Escolhe um template pelo estado da conversa e pela forma da mensagem.
+
+    Só responde mensagens curtas feitas inteiramente de palavras conhecidas
+    ("sim, pode ser", "obrigada!"); qualquer outra coisa (pergunta, negação,
+    nova data) retorna None e segue para o Gemini.
+    """
+
+    def __init__(self, templates: Optional[Dict[str, str]] = None):
+        self.templates = templates or TEMPLATES
+
+    def route(self, state: str, message: str) -> Optional[str]:
+        """Nome do template para (estado, mensagem), ou None se precisa do modelo"""
+        if "?" in message:
+            return None
+        words = _words(message)
+
+        if state == "confirming":
+            lowered = message.lower()
+            if words and _only(words, CONFIRM_VOCABULARY) and any(w in lowered for w in CONFIRM_WORDS):
+                return "confirm_booking"
+
+        elif state == "awaiting_slot":
+            # Pedido sem horário livre: nada está confirmado ainda
+            if words and _only(words, THANKS_VOCABULARY | CONFIRM_VOCABULARY):
+                return "no_slot_ack"
+
+        elif state == "completed":
+            if words and _only(words, THANKS_VOCABULARY | CONFIRM_VOCABULARY) and THANKS_WORDS.intersection(words):
+                return "thanks"
+            if _only(words, CONFIRM_VOCABULARY):
+                return "ack"
+
+        return None
+
+    def render(self, state: str, message: str, slots: Dict[str, Any]) -> Optional[Tuple[str, str]]:
+        """(template, resposta) ou None"""
+        name = self.route(state, message)
+        if name is None:
+            return None
+        return name, self.fill(name, slots)
+
+    def fill(self, name: str, slots: Dict[str, Any]) -> str:
+        """Texto do template com as informações coletadas"""
+        return self.templates[name].format(**fill_slots(slots))
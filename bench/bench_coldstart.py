@@ -0,0 +1,56 @@
+"""
+Benchmark: tempo de carga e memória (RSS máximo) da base de conhecimento
+
+Cada cenário roda em um processo Python novo, medindo o tempo de import +
+carga e o pico de RSS do processo. "pandas" reproduz o carregamento antigo
+(import pandas + pd.read_csv); "KnowledgeBase" é o atual.
+
+Uso: python bench/bench_coldstart.py   (o cenário pandas requer requirements-analytics.txt)
+"""
+
+import json
+import subprocess
+import sys
+
+from common import ROOT
+
+SCENARIOS = {
+    "python vazio": "pass",
+    "pandas + read_csv (antes)": "import pandas as pd; kb = pd.read_csv('knowledge_base.csv')",
+    "KnowledgeBase (depois)": (
+        "sys.path.insert(0, 'app'); from fernanda_knowledge import KnowledgeBase; "
+        "kb = KnowledgeBase.from_csv('knowledge_base.csv')"
+    ),
+}
+
+RUNNER = """
+import json, resource, sys, time
+start = time.perf_counter()
+{code}
+elapsed = time.perf_counter() - start
+print(json.dumps({{"ms": elapsed * 1000, "rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}}))
+"""
+
+
+def measure(code: str, runs: int = 5) -> dict:
+    results = []
+    for _ in range(runs):
+        out = subprocess.run([sys.executable, "-c", RUNNER.format(code=code)], cwd=ROOT,
+                             capture_output=True, text=True, check=True)
+        results.append(json.loads(out.stdout))
+    return {"ms": min(r["ms"] for r in results), "rss_mb": min(r["rss_mb"] for r in results)}
+
+
+def main():
+    print(f"{'cenário':>28} | {'carga (ms)':>10} | {'RSS máx (MB)':>12}")
+    for label, code in SCENARIOS.items():
+        try:
+            r = measure(code)
+        except subprocess.CalledProcessError:
+            print(f"{label:>28} | {'indisponível':>10} |")
+            continue
+        print(f"{label:>28} | {r['ms']:10.1f} | {r['rss_mb']:12.1f}")
+
+
+if __name__ == "__main__":
+    main()
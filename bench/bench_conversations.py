@@ -0,0 +1,85 @@
+"""
+Benchmark: memória das conversas ativas sob uma enxurrada de contatos únicos
+
+Compara o dicionário sem limite com ConversationMemory + PatientInfo
+(Pydantic) da versão anterior e o ConversationStore limitado com objetos
+em __slots__. Mede a memória alocada (tracemalloc) após cada lote.
+
+Uso: python bench/bench_conversations.py
+"""
+
+import tracemalloc
+from datetime import datetime
+from typing import Optional, Dict, Any
+
+from pydantic import BaseModel
+
+from common import import_backend
+
+fb = import_backend()
+
+CONTACTS = 100_000
+STEP = 20_000
+MAX_ENTRIES = 10_000
+
+
+class LegacyPatientInfo(BaseModel):
+    phone: str
+    name: Optional[str] = None
+    current_issue: Optional[str] = None
+    urgency_level: int = 0
+    service_needed: Optional[str] = None
+    preferred_date: Optional[str] = None
+    preferred_time: Optional[str] = None
+
+
+class LegacyConversationMemory:
+    def __init__(self, phone: str):
+        self.phone = phone
+        self.patient_id = None
+        self.state = fb.ConversationState.NEW_CONTACT
+        self.patient_info = LegacyPatientInfo(phone=phone)
+        self.context_data: Dict[str, Any] = {}
+        self.message_count = 0
+        self.last_activity = datetime.now()
+
+
+def touch(memory, i: int):
+    """O que process_message grava numa primeira mensagem"""
+    memory.message_count += 1
+    memory.patient_id = i
+    memory.patient_info.current_issue = f"Oi, gostaria de saber o preço da limpeza ({i})"
+
+
+def flood(label: str, get_or_create):
+    tracemalloc.start()
+    sizes = []
+    for i in range(CONTACTS):
+        touch(get_or_create(f"55629{i:08d}"), i)
+        if (i + 1) % STEP == 0:
+            sizes.append(tracemalloc.get_traced_memory()[0])
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    curve = "  ".join(f"{size / 2**20:6.1f}" for size in sizes)
+    print(f"{label:<28} MiB a cada {STEP} contatos: {curve}   pico {peak / 2**20:6.1f} MiB")
+
+
+def main():
+    legacy: Dict[str, LegacyConversationMemory] = {}
+
+    def legacy_get(phone):
+        if phone not in legacy:
+            legacy[phone] = LegacyConversationMemory(phone)
+        return legacy[phone]
+
+    flood("dict + Pydantic (anterior)", legacy_get)
+    print(f"{'':<28} {sum(1 for _ in legacy)} conversas retidas")
+    legacy.clear()
+
+    store = fb.ConversationStore(fb.ConversationMemory, max_entries=MAX_ENTRIES)
+    flood(f"ConversationStore({MAX_ENTRIES})", store.get_or_create)
+    print(f"{'':<28} {store.stats()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+"""
+Benchmark: paginação por cursor vs OFFSET e exportação em streaming (migração 5)
+
+Usa o banco gerado por bench_indexes.py (gera se não existir) e:
+- compara uma página profunda de /api/appointments com OFFSET e com cursor;
+- exporta todos os agendamentos em NDJSON e em CSV medindo linhas/s, e
+  conversas de uma semana e de um mês medindo o pico de memória Python
+  (tracemalloc) do exportador;
+- durante uma exportação de conversas, lê perfis de pacientes a cada 10 ms
+  (como o atendimento faria) e mede essas leituras e o atraso do event loop.
+
+Uso: python bench/bench_export.py [--rows 10000000] [--db /tmp/fernanda_bench.db]
+"""
+
+import argparse
+import asyncio
+import random
+import sqlite3
+import sys
+import time
+import tracemalloc
+
+from common import ROOT
+
+sys.path.insert(0, str(ROOT / "app"))
+
+import fernanda_db  # noqa: E402
+from fernanda_export import Exporter  # noqa: E402
+from bench_indexes import PATIENTS, populate  # noqa: E402
+
+PAGE = 50
+
+
+def offset_page(conn: sqlite3.Connection, offset: int):
+    """Como seria a paginação com LIMIT/OFFSET"""
+    return conn.execute("""
+        SELECT a.id, p.name, p.phone, a.service, a.specialty, a.urgency_level,
+               a.scheduled_date, a.scheduled_time, a.status, a.created_at
+        FROM appointments a JOIN patients p ON a.patient_id = p.id
+        ORDER BY a.created_at DESC, a.id DESC LIMIT ? OFFSET ?
+    """, (PAGE, offset)).fetchall()
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    return (samples[len(samples) // 2] * 1000, samples[int(len(samples) * 0.99)] * 1000, samples[-1] * 1000)
+
+
+async def export_all(exporter: Exporter, fetch_page, fields, fmt: str, filters=None):
+    rows_before = exporter.counters["rows"]
+    size = 0
+    started = time.perf_counter()
+    async for chunk in exporter.open(fetch_page, fields, filters or {}, fmt):
+        size += len(chunk)
+    elapsed = time.perf_counter() - started
+    return exporter.counters["rows"] - rows_before, size, elapsed
+
+
+async def run_exports(db: fernanda_db.Database):
+    exporter = Exporter(db)
+    for fmt in ("ndjson", "csv"):
+        rows, size, elapsed = await export_all(exporter, fernanda_db.fetch_appointments,
+                                               fernanda_db.APPOINTMENT_FIELDS, fmt)
+        print(f"exportação {fmt:<6} {rows:>10,} agendamentos  {size / 2**20:8.1f} MiB  "
+              f"{rows / elapsed:>9,.0f} linhas/s")
+
+    # Pico de memória (tracemalloc deixa tudo bem mais lento, então em períodos menores)
+    for date_to in ("2024-01-07", "2024-01-31"):
+        tracemalloc.start()
+        rows, size, _ = await export_all(exporter, fernanda_db.fetch_conversations,
+                                         fernanda_db.CONVERSATION_FIELDS, "ndjson",
+                                         {"date_from": "2024-01-01", "date_to": date_to})
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"exportação até {date_to}: {rows:>9,} conversas  {size / 2**20:6.1f} MiB  "
+              f"pico de memória {peak / 2**20:.2f} MiB")
+
+    # Leituras do atendimento concorrendo com uma exportação de conversas
+    rnd = random.Random(5)
+
+    async def serve(stop: asyncio.Event, reads, lags):
+        while not stop.is_set():
+            expected = time.perf_counter() + 0.01
+            await asyncio.sleep(0.01)
+            lags.append(max(0.0, time.perf_counter() - expected))
+            started = time.perf_counter()
+            await db.read(fernanda_db.fetch_patient_profile, f"55629{rnd.randrange(PATIENTS):08d}")
+            reads.append(time.perf_counter() - started)
+
+    for label, exporting in (("sem exportação", False), ("com exportação", True)):
+        stop = asyncio.Event()
+        reads, lags = [], []
+        server = asyncio.create_task(serve(stop, reads, lags))
+        if exporting:
+            rows, size, elapsed = await export_all(exporter, fernanda_db.fetch_conversations,
+                                                   fernanda_db.CONVERSATION_FIELDS, "ndjson",
+                                                   {"date_from": "2024-01-01", "date_to": "2024-03-31"})
+            detail = f"  ({rows:,} conversas em {elapsed:.1f} s)"
+        else:
+            await asyncio.sleep(5)
+            detail = ""
+        stop.set()
+        await server
+        read = percentiles(reads)
+        lag = percentiles(lags)
+        print(f"leitura de perfil {label}: p50 {read[0]:.2f} ms  p99 {read[1]:.2f} ms  max {read[2]:.2f} ms; "
+              f"atraso do loop p99 {lag[1]:.2f} ms{detail}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=10_000_000)
+    parser.add_argument("--db", default="/tmp/fernanda_bench.db")
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(args.db)
+    conn.execute("PRAGMA journal_mode=WAL")
+    fernanda_db.migrate(conn, target=1)
+    conn.commit()
+    if conn.execute("SELECT COUNT(*) FROM conversations").fetchone()[0] < args.rows:
+        print(f"Gerando {args.rows:,} conversas...")
+        populate(conn, args.rows)
+    started = time.perf_counter()
+    version = fernanda_db.migrate(conn)
+    conn.commit()
+    print(f"Esquema na versão {version} ({time.perf_counter() - started:.1f} s de migração)\n")
+
+    total = conn.execute("SELECT COUNT(*) FROM appointments").fetchone()[0]
+    for depth in (0, total // 10, total // 2, total - PAGE):
+        started = time.perf_counter()
+        rows = offset_page(conn, depth)
+        by_offset = time.perf_counter() - started
+        # O cursor da mesma página é o (created_at, id) da linha anterior a ela
+        after = None
+        if depth:
+            previous = offset_page(conn, depth - 1)[0]
+            after = (previous[9], previous[0])
+        started = time.perf_counter()
+        keyset = fernanda_db.fetch_appointments(conn, PAGE, after)
+        by_cursor = time.perf_counter() - started
+        assert [row["id"] for row in keyset] == [row[0] for row in rows]
+        print(f"página na posição {depth:>9,}: OFFSET {by_offset * 1000:9.2f} ms   cursor {by_cursor * 1000:6.2f} ms")
+    conn.close()
+    print()
+
+    db = fernanda_db.Database(args.db)
+    try:
+        asyncio.run(run_exports(db))
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
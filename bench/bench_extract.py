@@ -0,0 +1,106 @@
+"""
+Benchmark: extract_info_from_message com catálogo de 1.000 serviços
+
+Compara a versão antiga (KNOWLEDGE_BASE.iterrows() + `kw in msg` por
+palavra-chave) com o autômato Aho-Corasick montado no carregamento da base.
+
+Uso: python bench/bench_extract.py   (requer requirements-analytics.txt)
+"""
+
+import re
+
+import pandas as pd
+
+from common import import_backend, per_call, fmt_us
+
+fb = import_backend()
+
+from fernanda_knowledge import KnowledgeBase  # noqa: E402
+
+MESSAGES = [
+    "Oi, meu nome é Carla Souza, estou com muita dor no dente",
+    "quero marcar uma avaliação para amanhã às 14h",
+    "tô com dor no siso, não aguento mais",
+    "Vocês fazem clareamento? Seria pra semana que vem",
+    "ok, pode ser hoje 16:30",
+    "bom dia",
+]
+
+
+def synthetic_kb(rows: int) -> pd.DataFrame:
+    return pd.DataFrame([
+        {"servico": f"Serviço {i}", "especialidade": f"Especialidade {i % 7}",
+         "palavras_chave": f"termo{i},procedimento{i},variante{i}", "urgencia": "Médio", "duracao_min": 30}
+        for i in range(rows)
+    ])
+
+
+def legacy_extract(message, memory, kb):
+    """Cópia da implementação anterior (linha a linha sobre o DataFrame)"""
+    extracted = {}
+    msg_lower = message.lower()
+    if not memory.patient_info.name:
+        patterns = [
+            r'(?:meu nome é|me chamo|sou o?a?)\s+([A-Z][a-zà-ú]+(?:\s+[A-Z][a-zà-ú]+)*)',
+            r'^([A-Z][a-zà-ú]+(?:\s+[A-Z][a-zà-ú]+)*)[,.\s]',
+        ]
+        for pattern in patterns:
+            match = re.search(pattern, message, re.IGNORECASE)
+            if match:
+                extracted['name'] = match.group(1).strip()
+                break
+    phone_match = re.search(r'(?:\+?55\s?)?(?:\(?\d{2}\)?\s?)?\d{4,5}[-\s]?\d{4}', message)
+    if phone_match:
+        extracted['phone'] = re.sub(r'[^\d]', '', phone_match.group())
+    urgency_keywords = {
+        10: ['insuportável', 'não aguento', 'emergência'],
+        8: ['muita dor', 'bastante dor', 'doendo muito'],
+        6: ['dor', 'doendo', 'incômodo'],
+        3: ['desconforto', 'sensível']
+    }
+    for level, keywords in urgency_keywords.items():
+        if any(kw in msg_lower for kw in keywords):
+            extracted['urgency'] = level
+            break
+    for _, row in kb.iterrows():
+        keywords = row['palavras_chave'].split(',')
+        if any(kw.strip() in msg_lower for kw in keywords):
+            extracted['service'] = row['servico']
+            extracted['specialty'] = row['especialidade']
+            break
+    if 'hoje' in msg_lower:
+        extracted['date_preference'] = 'hoje'
+    elif 'amanhã' in msg_lower:
+        extracted['date_preference'] = 'amanhã'
+    elif 'semana' in msg_lower:
+        extracted['date_preference'] = 'esta semana'
+    time_match = re.search(r'(\d{1,2})[h:](\d{2})?', message)
+    if time_match:
+        extracted['time_preference'] = f"{time_match.group(1)}:{time_match.group(2) or '00'}"
+    if any(k in msg_lower for k in ['agendar', 'marcar', 'consulta', 'avaliacao', 'avaliação', 'operar', 'cirurgia']):
+        extracted.setdefault('service', 'Consulta')
+    return extracted
+
+
+def main():
+    kb = synthetic_kb(1000)
+    fb.KNOWLEDGE_BASE = KnowledgeBase(kb.to_dict("records"))
+    fb.MESSAGE_MATCHER = fb.build_message_matcher()
+    memory = fb.ConversationMemory("5500000000000")
+
+    # Mensagens que citam serviços no fim do catálogo (pior caso da varredura)
+    messages = MESSAGES + ["preciso do procedimento999 com urgência", "fazer o termo500 amanhã"]
+
+    mismatches = [m for m in messages if legacy_extract(m, memory, kb) != fb.extract_info_from_message(m, memory)]
+    print(f"mensagens divergentes: {len(mismatches)} de {len(messages)}")
+
+    before = per_call(lambda: [legacy_extract(m, memory, kb) for m in messages], number=5, repeat=3)
+    after = per_call(lambda: [fb.extract_info_from_message(m, memory) for m in messages], number=200)
+    n = len(messages)
+    print(f"iterrows (antes):   {fmt_us(before / n)} por mensagem")
+    print(f"Aho-Corasick:       {fmt_us(after / n)} por mensagem")
+    print(f"ganho:              {before / after:10.0f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""
+Benchmark: histórico do prompt lido do banco a cada turno x buffer na conversa
+
+Gera --rows conversas para --patients pacientes (índices da migração 2) e
+mede, por turno, a leitura do histórico pelo banco (consulta + junção com
+os turnos pendentes) contra o buffer em memória da conversa. Mede também
+quanto o buffer acrescenta à gravação do estado (JSON) a cada turno.
+
+Uso: python bench/bench_history.py [--rows 1000000] [--patients 50000]
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import time
+from collections import deque
+
+from common import import_backend, fmt_us, per_call
+
+fb = import_backend()
+
+
+def populate(rows: int, patients: int):
+    def fill(conn):
+        conn.executemany("INSERT INTO patients (phone, name) VALUES (?, ?)",
+                         ((f"55629{i:08d}", f"Paciente {i}") for i in range(patients)))
+        rnd = random.Random(7)
+        conn.executemany(
+            "INSERT INTO conversations (patient_id, user_message, bot_response, state, created_at) "
+            "VALUES (?, ?, ?, ?, datetime('2026-01-01', ?))",
+            ((rnd.randint(1, patients), "quero marcar uma limpeza na semana que vem",
+              "Claro! Tenho quinta às 09:00 ou às 09:30. Qual prefere?", "scheduling", f"+{i} seconds")
+             for i in range(rows)))
+    fb.db.write_sync(fb.fernanda_db.migrate)
+    fb.db.write_sync(fill)
+
+
+async def per_turn(fn, turns: int) -> float:
+    started = time.perf_counter()
+    for _ in range(turns):
+        await fn()
+    return (time.perf_counter() - started) / turns
+
+
+async def run(patients: int, turns: int):
+    phones = [f"55629{random.randrange(patients):08d}" for _ in range(turns)]
+    memories = {phone: fb.ConversationMemory(phone) for phone in phones}
+    it = iter(phones * 2)
+
+    async def from_db():
+        await fb.get_patient_history(next(it))
+
+    before = await per_turn(from_db, turns)
+    it = iter(phones)
+    seeded = await per_turn(lambda: fb.conversation_history(memories[next(it)]), turns)
+    it = iter(phones)
+    after = await per_turn(lambda: fb.conversation_history(memories[next(it)]), turns)
+    return before, seeded, after, memories[phones[0]]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--patients", type=int, default=50_000)
+    parser.add_argument("--turns", type=int, default=2000)
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    populate(args.rows, args.patients)
+    print(f"banco: {args.rows:,} conversas, {args.patients:,} pacientes ({time.perf_counter() - started:.0f} s)")
+
+    before, seeded, after, memory = asyncio.run(run(args.patients, args.turns))
+    print(f"banco a cada turno (antes):  {fmt_us(before)} por turno")
+    print(f"primeiro turno (carga):      {fmt_us(seeded)} por turno")
+    print(f"buffer na conversa:          {fmt_us(after)} por turno")
+
+    empty = fb.ConversationMemory(memory.phone)
+    empty.history = deque(maxlen=fb.HISTORY_TURNS)
+    full = fb.ConversationMemory(memory.phone)
+    full.history = deque(({"user": "quero marcar uma limpeza na semana que vem" * 3,
+                           "bot": "Claro! Tenho quinta às 09:00 ou às 09:30. Qual prefere?" * 3,
+                           "timestamp": "2026-01-01 00:00:00", "state": "scheduling"}
+                          for _ in range(fb.HISTORY_TURNS)), maxlen=fb.HISTORY_TURNS)
+    for label, item in (("estado sem histórico", empty), (f"estado com {fb.HISTORY_TURNS} turnos", full)):
+        data = json.dumps(item.to_dict(), ensure_ascii=False)
+        cost = per_call(lambda: json.dumps(item.to_dict(), ensure_ascii=False))
+        print(f"{label:<28} {len(data):6,} bytes, json {fmt_us(cost)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+"""
+Benchmark: planos de consulta e latências antes e depois dos índices (migração 2)
+
+Gera um banco com --rows conversas (padrão 10 milhões), --rows/5
+agendamentos e 100 mil pacientes, mede as consultas do caminho quente só
+com as tabelas (migração 1) e depois de aplicar os índices.
+
+Uso: python bench/bench_indexes.py [--rows 10000000] [--db /tmp/fernanda_bench.db]
+(o banco gerado é reaproveitado se já existir com o mesmo número de linhas)
+"""
+
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import time
+from datetime import datetime, timedelta
+
+from common import ROOT
+
+sys.path.insert(0, str(ROOT / "app"))
+
+import fernanda_db  # noqa: E402
+
+PATIENTS = 100_000
+SPECIALTIES = ["Endodontia", "Ortodontia", "Clínica Geral", "Periodontia", "Estética"]
+STATUSES = ["confirmed"] * 8 + ["pending", "cancelled"]
+
+
+def populate(conn: sqlite3.Connection, rows: int):
+    rnd = random.Random(7)
+    start = datetime(2024, 1, 1)
+    step = (365 * 24 * 3600) / rows
+
+    def stamp(i: int) -> str:
+        return (start + timedelta(seconds=i * step)).strftime("%Y-%m-%d %H:%M:%S")
+
+    conn.executemany("INSERT INTO patients (phone, name) VALUES (?, ?)",
+                     ((f"55629{i:08d}", f"Paciente {i}") for i in range(PATIENTS)))
+    batch = 500_000
+    for offset in range(0, rows, batch):
+        conn.executemany(
+            "INSERT INTO conversations (patient_id, user_message, bot_response, state, created_at) "
+            "VALUES (?, ?, ?, ?, ?)",
+            ((rnd.randint(1, PATIENTS), "quero marcar uma limpeza", "Claro! Qual o melhor horário?",
+              "scheduling", stamp(i)) for i in range(offset, min(rows, offset + batch))))
+        print(f"  conversas: {min(rows, offset + batch):,}", flush=True)
+    appointments = rows // 5
+    conn.executemany(
+        "INSERT INTO appointments (patient_id, service, specialty, urgency_level, status, created_at) "
+        "VALUES (?, ?, ?, ?, ?, ?)",
+        ((rnd.randint(1, PATIENTS), "Consulta", rnd.choice(SPECIALTIES), rnd.randint(0, 10),
+          rnd.choice(STATUSES), stamp(i * 5)) for i in range(appointments)))
+    conn.commit()
+
+
+# Consultas da versão 2, substituídas depois por agregados (migração 3) e perfis (migração 4)
+def legacy_system_counts(conn: sqlite3.Connection):
+    cursor = conn.cursor()
+    return (
+        cursor.execute("SELECT COUNT(*) FROM patients").fetchone()[0],
+        cursor.execute("SELECT COUNT(*) FROM appointments WHERE status = 'confirmed'").fetchone()[0],
+        cursor.execute("SELECT COUNT(*) FROM conversations").fetchone()[0],
+    )
+
+
+def legacy_analytics(conn: sqlite3.Connection):
+    cursor = conn.cursor()
+    return (
+        cursor.execute("SELECT COUNT(*) FROM patients").fetchone()[0],
+        cursor.execute("SELECT COUNT(*) FROM appointments").fetchone()[0],
+        cursor.execute("SELECT COUNT(*) FROM appointments WHERE status = 'confirmed'").fetchone()[0],
+        cursor.execute("SELECT specialty, COUNT(*) as count FROM appointments "
+                       "GROUP BY specialty ORDER BY count DESC").fetchall(),
+        cursor.execute("SELECT urgency_level, COUNT(*) as count FROM appointments "
+                       "GROUP BY urgency_level ORDER BY urgency_level DESC").fetchall(),
+    )
+
+
+def legacy_patient_summary(conn: sqlite3.Connection, phone: str):
+    return conn.execute("""
+        SELECT p.id, p.name, p.created_at,
+               COUNT(DISTINCT a.id) as total_appointments,
+               COUNT(DISTINCT c.id) as total_messages
+        FROM patients p
+        LEFT JOIN appointments a ON p.id = a.patient_id
+        LEFT JOIN conversations c ON p.id = c.patient_id
+        WHERE p.phone = ?
+        GROUP BY p.id
+    """, (phone,)).fetchone()
+
+
+QUERIES = {
+    "histórico do paciente": (fernanda_db.fetch_patient_history, lambda rnd: (f"55629{rnd.randrange(PATIENTS):08d}",)),
+    "/api/appointments": (fernanda_db.fetch_appointments, lambda rnd: (50,)),
+    "resumo do paciente": (legacy_patient_summary, lambda rnd: (f"55629{rnd.randrange(PATIENTS):08d}",)),
+    "contagens /api/status": (legacy_system_counts, lambda rnd: ()),
+}
+
+
+class PlanRecorder:
+    """Conexão que guarda o EXPLAIN QUERY PLAN da primeira consulta executada"""
+
+    def __init__(self, conn: sqlite3.Connection):
+        self.conn = conn
+        self.plans = []
+
+    def execute(self, sql, params=()):
+        self.plans.append([row[3] for row in self.conn.execute("EXPLAIN QUERY PLAN " + sql, params)])
+        self._last = self.conn.execute(sql, params)
+        return self._last
+
+    def cursor(self):
+        return self
+
+    def fetchone(self):
+        return self._last.fetchone()
+
+    def fetchall(self):
+        return self._last.fetchall()
+
+
+def measure(conn: sqlite3.Connection, label: str, repeat: int):
+    print(f"\n== {label} ==")
+    for name, (query, make_args) in QUERIES.items():
+        rnd = random.Random(1)
+        recorder = PlanRecorder(conn)
+        query(recorder, *make_args(rnd))
+        timings = []
+        for _ in range(repeat):
+            args = make_args(rnd)
+            started = time.perf_counter()
+            query(conn, *args)
+            timings.append(time.perf_counter() - started)
+        timings.sort()
+        print(f"{name:<24} p50 {timings[len(timings) // 2] * 1000:10.2f} ms   "
+              f"max {timings[-1] * 1000:10.2f} ms")
+        for plan in recorder.plans:
+            print(f"{'':<26}plano: {' | '.join(plan)}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=10_000_000)
+    parser.add_argument("--db", default="/tmp/fernanda_bench.db")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(args.db)
+    conn.execute("PRAGMA journal_mode=WAL")
+    fernanda_db.migrate(conn, target=1)
+    conn.commit()
+    count = conn.execute("SELECT COUNT(*) FROM conversations").fetchone()[0]
+    if count != args.rows:
+        conn.close()
+        os.remove(args.db)
+        conn = sqlite3.connect(args.db)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=OFF")
+        fernanda_db.migrate(conn, target=1)
+        print(f"Gerando {args.rows:,} conversas...")
+        populate(conn, args.rows)
+
+    # Volta para a versão 1 se uma rodada anterior deixou os índices
+    for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND name LIKE 'idx_%'").fetchall():
+        conn.execute(f"DROP INDEX {name}")
+    conn.execute("DELETE FROM schema_migrations WHERE version > 1")
+    conn.commit()
+
+    measure(conn, "versão 1 (sem índices)", args.repeat)
+
+    started = time.perf_counter()
+    fernanda_db.migrate(conn, target=2)
+    conn.commit()
+    print(f"\nMigração 2 (criação dos índices): {time.perf_counter() - started:.1f} s")
+
+    measure(conn, f"versão {fernanda_db.fetch_schema_version(conn)} (com índices)", args.repeat * 20)
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""
+Benchmark: governador de chamadas ao Gemini contra um modelo falso
+
+Cenários: modelo saudável, cauda lenta (4% das chamadas levam 4 s) com e
+sem hedge, e queda total (todas as chamadas falham) para ver o circuit
+breaker respondendo na hora.
+
+Uso: python bench/bench_llm.py
+"""
+
+import asyncio
+import sys
+import time
+
+from common import ROOT
+from fake_gemini import FakeGeminiModel
+
+sys.path.insert(0, str(ROOT / "app"))
+
+from fernanda_llm import LLMGovernor, CircuitBreaker, CircuitOpenError  # noqa: E402
+from fernanda_metrics import LatencyWindow  # noqa: E402
+
+REQUESTS = 200
+CONCURRENCY = 20
+
+
+async def run(name: str, model: FakeGeminiModel, **options):
+    governor = LLMGovernor(model, **options)
+    latencies = LatencyWindow(REQUESTS)
+    outcomes = {"ok": 0, "timeout": 0, "error": 0, "rejected": 0}
+    queue = list(range(REQUESTS))
+
+    async def client():
+        while queue:
+            queue.pop()
+            started = time.monotonic()
+            try:
+                await governor.generate("prompt")
+                outcomes["ok"] += 1
+            except CircuitOpenError:
+                outcomes["rejected"] += 1
+            except asyncio.TimeoutError:
+                outcomes["timeout"] += 1
+            except Exception:
+                outcomes["error"] += 1
+            latencies.add(time.monotonic() - started)
+
+    started = time.monotonic()
+    await asyncio.gather(*(client() for _ in range(CONCURRENCY)))
+    elapsed = time.monotonic() - started
+    stats = governor.stats()
+    governor.close()
+
+    summary = latencies.summary_ms("ms")
+    print(f"{name:<28} {elapsed:6.1f}s  p50 {summary['ms_p50']:7.1f}  p95 {summary['ms_p95']:7.1f}  "
+          f"p99 {latencies.percentile(99) * 1000:7.1f}  max {summary['ms_max']:7.1f}  "
+          f"model calls {model.calls:4d}  hedged {stats['hedged']:3d}/{stats['hedge_wins']:3d} won  {outcomes}")
+
+
+async def main():
+    print(f"{REQUESTS} chamadas, {CONCURRENCY} clientes concorrentes (latências em ms)")
+    await run("saudável", FakeGeminiModel(latency=0.2, jitter=0.05), hedge=False)
+    # Vagas sobrando: o hedge só dispara quando há folga de concorrência
+    for hedge in (False, True):
+        await run(f"cauda lenta, {'com' if hedge else 'sem'} hedge",
+                  FakeGeminiModel(latency=0.2, jitter=0.05, slow_ratio=0.04, slow_latency=4),
+                  hedge=hedge, timeout=6, max_concurrency=2 * CONCURRENCY)
+    await run("lentidão > prazo", FakeGeminiModel(latency=3, jitter=0), hedge=False, timeout=1,
+              breaker=CircuitBreaker(threshold=5, cooldown=60))
+    await run("queda total", FakeGeminiModel(latency=0.5, error_ratio=1.0), hedge=False,
+              breaker=CircuitBreaker(threshold=5, cooldown=60))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,79 @@
+"""
+Benchmark: custo da instrumentação por turno (spans, histogramas e log)
+
+Simula o que um turno publica (10 etapas, histograma do turno por estado e
+caminho, contador do cache) e mede o custo por turno sem log e com a linha
+JSON (escrita em /dev/null), além do tempo de gerar o /metrics com todas as
+séries preenchidas.
+
+Uso: python bench/bench_metrics.py [--turns 100000]
+"""
+
+import argparse
+import contextlib
+import os
+import sys
+import time
+
+from common import ROOT
+
+sys.path.insert(0, str(ROOT / "app"))
+
+import fernanda_metrics  # noqa: E402
+from fernanda_metrics import MetricsRegistry, TurnTrace  # noqa: E402
+
+STAGES = ["session", "patient", "route", "history", "extract", "prompt", "llm", "state", "db_write", "send"]
+STATES = ["new_contact", "identifying", "collecting_info", "scheduling", "confirming", "completed"]
+ROUTES = ["llm", "cache", "fallback", "template:confirm_booking", "template:thanks"]
+
+
+def registry() -> MetricsRegistry:
+    metrics = MetricsRegistry()
+    metrics.histogram("stage_seconds", "Tempo de cada etapa do turno")
+    metrics.histogram("turn_seconds", "Tempo do turno inteiro")
+    metrics.counter("cache_lookups_total", "Consultas ao cache")
+    return metrics
+
+
+def run_turns(metrics: MetricsRegistry, turns: int) -> float:
+    started = time.perf_counter()
+    for i in range(turns):
+        trace = TurnTrace()
+        trace.tag(state=STATES[i % len(STATES)])
+        for stage in STAGES:
+            with trace.span(stage):
+                pass
+        trace.tag(route=ROUTES[i % len(ROUTES)], new_state=STATES[(i + 1) % len(STATES)], phone="*********1234")
+        metrics.inc("cache_lookups_total", result="hit" if i % 3 else "miss")
+        trace.finish(metrics)
+    return (time.perf_counter() - started) / turns
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--turns", type=int, default=100_000)
+    args = parser.parse_args()
+
+    fernanda_metrics.TURN_LOG = "off"
+    empty = time.perf_counter()
+    for _ in range(args.turns):
+        pass
+    loop = (time.perf_counter() - empty) / args.turns
+
+    metrics = registry()
+    per_turn = run_turns(metrics, args.turns)
+    print(f"spans + histogramas:          {(per_turn - loop) * 1e6:6.1f} µs/turno")
+
+    fernanda_metrics.TURN_LOG = "json"
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        per_turn = run_turns(registry(), args.turns)
+    print(f"spans + histogramas + log:    {(per_turn - loop) * 1e6:6.1f} µs/turno")
+
+    started = time.perf_counter()
+    text = metrics.render()
+    print(f"/metrics: {text.count(chr(10)):,} linhas, {len(text) / 1024:.0f} KiB em "
+          f"{(time.perf_counter() - started) * 1000:.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
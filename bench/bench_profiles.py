@@ -0,0 +1,104 @@
+"""
+Benchmark: /api/patient/{phone} com LEFT JOIN + COUNT(DISTINCT) vs perfil mantido (migração 4)
+
+Usa o banco gerado por bench_indexes.py (gera se não existir). Mede, para
+pacientes sorteados e para um paciente com histórico longo, o resumo antigo
+mais a consulta de histórico e depois a leitura única de patient_profiles.
+
+Uso: python bench/bench_profiles.py [--rows 10000000] [--db /tmp/fernanda_bench.db]
+"""
+
+import argparse
+import random
+import sqlite3
+import sys
+import time
+
+from common import ROOT
+
+sys.path.insert(0, str(ROOT / "app"))
+
+import fernanda_db  # noqa: E402
+from bench_indexes import PATIENTS, populate, legacy_patient_summary  # noqa: E402
+from bench_rollups import report, insert_turns  # noqa: E402
+
+LONG_HISTORY = 50_000
+
+
+def legacy_lookup(conn: sqlite3.Connection, phone: str):
+    """get_patient_info antes da migração 4: resumo + histórico"""
+    return legacy_patient_summary(conn, phone), fernanda_db.fetch_patient_history(conn, phone)
+
+
+def random_phone(rnd: random.Random) -> str:
+    return f"55629{rnd.randrange(PATIENTS):08d}"
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=10_000_000)
+    parser.add_argument("--db", default="/tmp/fernanda_bench.db")
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(args.db)
+    conn.execute("PRAGMA journal_mode=WAL")
+    fernanda_db.migrate(conn, target=1)
+    conn.commit()
+    if conn.execute("SELECT COUNT(*) FROM conversations").fetchone()[0] < args.rows:
+        print(f"Gerando {args.rows:,} conversas...")
+        populate(conn, args.rows)
+
+    # Volta para a versão 3 e limpa as linhas de rodadas anteriores
+    for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type = 'trigger' "
+                                "AND name LIKE 'profile_%'").fetchall():
+        conn.execute(f"DROP TRIGGER {name}")
+    conn.execute("DROP TABLE IF EXISTS patient_profiles")
+    conn.execute("DELETE FROM conversations WHERE id > ?", (args.rows,))
+    conn.execute("DELETE FROM schema_migrations WHERE version > 3")
+    conn.commit()
+    fernanda_db.migrate(conn, target=3)
+    conn.commit()
+
+    # Um paciente antigo com muitas mensagens e agendamentos (o pior caso do JOIN)
+    heavy = "55629" + "9" * 8
+    patient_id = fernanda_db.upsert_patient(conn, heavy, "Paciente Antigo")
+    conn.executemany(
+        "INSERT INTO conversations (patient_id, user_message, bot_response, state) VALUES (?, ?, ?, ?)",
+        ((patient_id, "oi", "olá", "greeting") for _ in range(LONG_HISTORY)))
+    conn.executemany(
+        "INSERT INTO appointments (patient_id, service, status) VALUES (?, ?, ?)",
+        ((patient_id, "Consulta", "confirmed") for _ in range(200)))
+    conn.commit()
+
+    rnd = random.Random(3)
+    print("\n== versão 3 (COUNT(DISTINCT) + histórico) ==")
+    report("paciente sorteado", lambda: legacy_lookup(conn, random_phone(rnd)), args.repeat)
+    report(f"paciente com {LONG_HISTORY:,} mensagens", lambda: legacy_lookup(conn, heavy), 5)
+    per_row_plain = insert_turns(conn, 20_000)
+
+    started = time.perf_counter()
+    fernanda_db.migrate(conn, target=4)
+    conn.commit()
+    print(f"\nMigração 4 (perfis + carga inicial): {time.perf_counter() - started:.1f} s")
+
+    print("\n== versão 4 (patient_profiles) ==")
+    report("paciente sorteado", lambda: fernanda_db.fetch_patient_profile(conn, random_phone(rnd)), args.repeat * 10)
+    report(f"paciente com {LONG_HISTORY:,} mensagens",
+           lambda: fernanda_db.fetch_patient_profile(conn, heavy), args.repeat * 10)
+    per_row_trigger = insert_turns(conn, 20_000)
+    print(f"\nGravação de turnos: {per_row_plain * 1e6:.1f} µs/linha sem o trigger do perfil, "
+          f"{per_row_trigger * 1e6:.1f} µs/linha com")
+
+    # O perfil precisa bater com a consulta antiga
+    for phone in [heavy, "55629" + "0" * 8] + [random_phone(rnd) for _ in range(20)]:
+        summary, history = legacy_lookup(conn, phone)
+        profile = fernanda_db.fetch_patient_profile(conn, phone)
+        assert (profile["total_appointments"], profile["total_messages"]) == summary[3:5], phone
+        assert profile["history"] == history, phone
+    print("Perfis conferidos com a consulta antiga: ok")
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
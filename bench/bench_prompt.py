@@ -0,0 +1,52 @@
+"""
+Benchmark: custo de CPU da parte estática do prompt por mensagem
+
+Compara a renderização antiga (json.dumps + DataFrame.to_string a cada
+mensagem) com o prefixo pré-montado, para a base real e uma sintética.
+
+Uso: python bench/bench_prompt.py   (requer requirements-analytics.txt)
+"""
+
+import json
+
+import pandas as pd
+
+from common import ROOT, import_backend, per_call, fmt_us
+
+fb = import_backend()
+
+
+def legacy_static(config, kb) -> str:
+    return f"""
+{fb.FERNANDA_PROMPT}
+
+=== DADOS DA CLÍNICA ===
+{json.dumps(config, ensure_ascii=False, indent=2)}
+
+=== BASE DE CONHECIMENTO ===
+Serviços disponíveis:
+{kb.to_string(index=False)}
+"""
+
+
+def synthetic_kb(rows: int) -> pd.DataFrame:
+    return pd.DataFrame([
+        {"servico": f"Serviço {i}", "especialidade": f"Especialidade {i % 7}",
+         "palavras_chave": f"termo{i};variação{i}", "urgencia": "Médio", "duracao_min": 30}
+        for i in range(rows)
+    ])
+
+
+def main():
+    print(f"{'base':>12} | {'por mensagem (antes)':>20} | {'prefixo cacheado':>18}")
+    # A base real carregada como antes (pd.read_csv)
+    for label, kb in [("real", pd.read_csv(ROOT / "knowledge_base.csv")), ("50 serviços", synthetic_kb(50)),
+                      ("200 serviços", synthetic_kb(200))]:
+        before = per_call(lambda: legacy_static(fb.CLINIC_CONFIG, kb), number=200)
+        prefix = legacy_static(fb.CLINIC_CONFIG, kb)
+        after = per_call(lambda: prefix + "contexto dinâmico", number=200)
+        print(f"{label:>12} | {fmt_us(before):>20} | {fmt_us(after):>18}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""
+Benchmark: /api/status e /api/analytics com COUNT(*)/GROUP BY vs agregados (migração 3)
+
+Usa o banco gerado por bench_indexes.py (gera se não existir), mede as
+consultas antigas, aplica a migração 3 (tabela stats_rollup, triggers e
+carga inicial), mede as leituras dos agregados, o custo dos triggers nas
+gravações e uma conferência completa (reconcile).
+
+Uso: python bench/bench_rollups.py [--rows 10000000] [--db /tmp/fernanda_bench.db]
+"""
+
+import argparse
+import os
+import sqlite3
+import sys
+import time
+
+from common import ROOT
+
+sys.path.insert(0, str(ROOT / "app"))
+
+import fernanda_db  # noqa: E402
+from bench_indexes import populate, legacy_system_counts, legacy_analytics  # noqa: E402
+
+
+def timed(fn, repeat: int):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - started)
+    timings.sort()
+    return timings[len(timings) // 2], timings[-1]
+
+
+def report(name: str, fn, repeat: int):
+    p50, worst = timed(fn, repeat)
+    print(f"{name:<34} p50 {p50 * 1000:10.3f} ms   max {worst * 1000:10.3f} ms")
+
+
+def insert_turns(conn: sqlite3.Connection, count: int) -> float:
+    """Tempo por linha gravando turnos em lotes de 100 (como a fila de gravação)"""
+    started = time.perf_counter()
+    for offset in range(0, count, 100):
+        conn.executemany(
+            "INSERT INTO conversations (patient_id, user_message, bot_response, state) VALUES (?, ?, ?, ?)",
+            ((1, "oi", "olá", "greeting") for _ in range(100)))
+        conn.commit()
+    return (time.perf_counter() - started) / count
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=10_000_000)
+    parser.add_argument("--db", default="/tmp/fernanda_bench.db")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(args.db)
+    conn.execute("PRAGMA journal_mode=WAL")
+    fernanda_db.migrate(conn, target=1)
+    conn.commit()
+    if conn.execute("SELECT COUNT(*) FROM conversations").fetchone()[0] < args.rows:
+        conn.close()
+        os.remove(args.db)
+        conn = sqlite3.connect(args.db)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=OFF")
+        fernanda_db.migrate(conn, target=1)
+        print(f"Gerando {args.rows:,} conversas...")
+        populate(conn, args.rows)
+
+    # Volta para a versão 2 (rodadas anteriores deixam os agregados e as linhas de teste)
+    for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type = 'trigger'").fetchall():
+        conn.execute(f"DROP TRIGGER {name}")
+    conn.execute("DROP TABLE IF EXISTS stats_rollup")
+    conn.execute("DROP TABLE IF EXISTS patient_profiles")
+    conn.execute("DELETE FROM conversations WHERE id > ?", (args.rows,))
+    conn.execute("DELETE FROM schema_migrations WHERE version > 2")
+    conn.commit()
+    fernanda_db.migrate(conn, target=2)
+    conn.commit()
+
+    print("\n== versão 2 (COUNT/GROUP BY a cada requisição) ==")
+    report("contagens /api/status", lambda: legacy_system_counts(conn), args.repeat)
+    report("/api/analytics", lambda: legacy_analytics(conn), args.repeat)
+    per_row_plain = insert_turns(conn, 20_000)
+
+    started = time.perf_counter()
+    fernanda_db.migrate(conn, target=3)
+    conn.commit()
+    print(f"\nMigração 3 (triggers + carga inicial): {time.perf_counter() - started:.1f} s")
+
+    print("\n== versão 3 (agregados) ==")
+    report("contagens /api/status", lambda: fernanda_db.fetch_system_counts(conn), args.repeat * 200)
+    report("/api/analytics", lambda: fernanda_db.fetch_analytics(conn), args.repeat * 200)
+    report("série diária (30 dias)", lambda: fernanda_db.fetch_daily_rollups(conn, 30), args.repeat * 200)
+    per_row_trigger = insert_turns(conn, 20_000)
+    print(f"\nGravação de turnos: {per_row_plain * 1e6:.1f} µs/linha sem trigger, "
+          f"{per_row_trigger * 1e6:.1f} µs/linha com trigger")
+
+    # Os agregados precisam bater com a contagem direta
+    assert fernanda_db.fetch_system_counts(conn) == dict(zip(
+        ("total_patients", "confirmed_appointments", "total_messages"), legacy_system_counts(conn)))
+
+    started = time.perf_counter()
+    snapshot, max_ids = fernanda_db.fetch_rollup_snapshot(conn)
+    scanned = time.perf_counter() - started
+    drift = fernanda_db.reconcile_rollups(conn, snapshot, max_ids)
+    conn.commit()
+    print(f"Conferência: {scanned:.1f} s de varredura (conexão de leitura), "
+          f"{(time.perf_counter() - started - scanned) * 1000:.1f} ms na escritora, {drift} divergência(s)")
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+"""
+Benchmark: agenda em bitmaps (consulta de horários livres e reservas concorrentes)
+
+Ocupa --occupancy da agenda de 5 especialidades por 14 dias e mede
+free_slots/is_free no índice em memória contra a mesma busca feita com
+uma consulta a appointment_slots por pedido. Depois, dois "workers" (dois
+Database no mesmo arquivo, cada um com seu índice desatualizado) disputam
+os mesmos horários: cada horário tem que ficar com exatamente um deles.
+
+Por fim, com a agenda inteira ocupada (e o índice desatualizado, como num
+worker que ainda não recarregou), uma conversa de agendamento passa pelo
+process_turn: o pedido tem que ficar 'pending' sem data e a resposta não
+pode confirmar horário nenhum.
+
+Uso: python bench/bench_schedule.py [--occupancy 0.6] [--races 200]
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+from datetime import date, datetime, timedelta
+
+from common import ROOT, fmt_us, import_backend, per_call
+from fake_gemini import FakeGeminiModel
+
+sys.path.insert(0, str(ROOT / "app"))
+# Antes de importar fernanda_db: o cenário da agenda lotada não pode tocar no banco real
+os.environ.setdefault("DATABASE_PATH", os.path.join(tempfile.mkdtemp(), "bench.db"))
+
+import fernanda_db  # noqa: E402
+from fernanda_db import Database, SlotTakenError  # noqa: E402
+from fernanda_schedule import ScheduleIndex, SLOT_UNIT_MIN, clinic_today  # noqa: E402
+
+SPECIALTIES = ["Endodontia", "Ortodontia", "Clínica Geral", "Periodontia", "Estética"]
+BUSINESS_HOURS = {
+    **{day: {"open": "08:00", "close": "18:00"} for day in
+       ("monday", "tuesday", "wednesday", "thursday", "friday")},
+    "saturday": {"open": "08:00", "close": "12:00"},
+    "sunday": {"closed": True},
+}
+NOW = datetime(2026, 10, 19, 9, 0)
+
+
+def occupied_rows(occupancy: float):
+    """Blocos de 30 min ocupados ao acaso, no formato de appointment_slots"""
+    rnd = random.Random(7)
+    rows = []
+    for specialty in SPECIALTIES:
+        for offset in range(14):
+            day = (NOW.date() + timedelta(days=offset)).isoformat()
+            for start in range(8 * 60, 18 * 60, 30):
+                if rnd.random() < occupancy:
+                    rows += [(specialty, day, start + i * SLOT_UNIT_MIN) for i in range(30 // SLOT_UNIT_MIN)]
+    return rows
+
+
+def sql_free_slots(conn, specialty: str, duration_min: int, count: int = 2):
+    """Mesma busca sem índice: lê os ocupados do banco e testa horário por horário"""
+    slots = []
+    index = ScheduleIndex(BUSINESS_HOURS)
+    for offset in range(15):
+        day = (NOW.date() + timedelta(days=offset)).isoformat()
+        taken = {minute for (minute,) in conn.execute(
+            "SELECT minute FROM appointment_slots WHERE specialty = ? AND day = ?", (specialty, day))}
+        for start in range(0, 24 * 60, 30):
+            minutes = index.reservation_minutes(f"{start // 60:02d}:{start % 60:02d}", duration_min)
+            if not taken.intersection(minutes) and index.is_free(
+                    specialty, day, f"{start // 60:02d}:{start % 60:02d}", duration_min, NOW):
+                slots.append((day, f"{start // 60:02d}:{start % 60:02d}"))
+                if len(slots) == count:
+                    return slots
+    return slots
+
+
+async def race(path: str, races: int):
+    workers = [Database(path, readers=1), Database(path, readers=1)]
+    patient_id = await workers[0].write(fernanda_db.upsert_patient, "5562900000000", "Bench")
+    day = date(2026, 10, 20)
+    won, lost = [0, 0], [0, 0]
+    for i in range(races):
+        slot_day = (day + timedelta(days=i // 20)).isoformat()
+        time_ = f"{8 + (i % 20) // 2:02d}:{(i % 2) * 30:02d}"
+        appointment = (patient_id, "Implante", "Implantodontia", "normal", slot_day, time_, "confirmed", "bench")
+        minutes = ScheduleIndex.reservation_minutes(time_, 30)
+        results = await asyncio.gather(
+            *(worker.write(fernanda_db.reserve_appointment, appointment, minutes) for worker in workers),
+            return_exceptions=True)
+        for n, result in enumerate(results):
+            if isinstance(result, SlotTakenError):
+                lost[n] += 1
+            elif isinstance(result, Exception):
+                raise result
+            else:
+                won[n] += 1
+    rows = await workers[0].read(fernanda_db.fetch_reserved_slots, day.isoformat(), "Implantodontia")
+    appointments = await workers[0].read(
+        lambda conn: conn.execute("SELECT COUNT(*) FROM appointments WHERE notes = 'bench'").fetchone()[0])
+    write_ms = [worker.stats().get("write_ms_p50") for worker in workers]
+    for worker in workers:
+        worker.close()
+    return won, lost, len(rows), appointments, write_ms
+
+
+async def fully_booked(fb) -> None:
+    """Agenda lotada: nada de agendamento 'confirmed' num horário já reservado"""
+    fb.LLM_GOVERNOR.model = FakeGeminiModel(latency=0, jitter=0)
+    fb.write_queue.start()
+    today = clinic_today()
+    specialties = {service.specialty for service in fb.KNOWLEDGE_BASE} | {"Clínica Geral"}
+    rows = [(specialty, (today + timedelta(days=offset)).isoformat(), minute)
+            for specialty in specialties for offset in range(fb.SCHEDULE.horizon_days + 1)
+            for minute in range(0, 24 * 60, SLOT_UNIT_MIN)]
+    await fb.db.write(lambda conn: conn.executemany(
+        "INSERT INTO appointment_slots (specialty, day, minute, appointment_id) VALUES (?, ?, ?, 0)", rows))
+
+    for label, refresh in (("índice desatualizado", False), ("índice recarregado", True)):
+        fb.SCHEDULE.load([])
+        if refresh:
+            await fb.refresh_schedule()
+        memory = fb.ConversationMemory(f"55629{int(refresh):08d}")
+        for message in ("Oi, meu nome é Ana, quero agendar uma avaliação", "amanhã às 10h", "sim, confirmo"):
+            result = await fb.process_turn(memory, message)
+        thanks = await fb.process_turn(memory, "obrigada!")
+        await fb.write_queue.flush()
+        appointments = await fb.db.read(lambda conn: conn.execute(
+            "SELECT status, scheduled_date, scheduled_time FROM appointments WHERE patient_id = ?",
+            (memory.patient_id,)).fetchall())
+        print(f"agenda lotada ({label}): {appointments}, conflitos {fb.SCHEDULE.counters['conflicts']}")
+        print(f"  resposta: {result['response']}")
+        assert appointments == [("pending", None, None)], "agendamento sem horário reservado"
+        assert refresh or fb.SCHEDULE.counters["conflicts"] >= 1, "o conflito no banco não foi exercitado"
+        assert "confirmado" not in result["response"] and "confirmado" not in thanks["response"]
+    await fb.write_queue.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--occupancy", type=float, default=0.6)
+    parser.add_argument("--races", type=int, default=200)
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), "schedule.db")
+    db = Database(path)
+    db.write_sync(fernanda_db.migrate)
+    rows = occupied_rows(args.occupancy)
+    db.write_sync(lambda conn: conn.executemany(
+        "INSERT INTO appointment_slots (specialty, day, minute, appointment_id) VALUES (?, ?, ?, 0)", rows))
+
+    index = ScheduleIndex(BUSINESS_HOURS)
+    index.load(rows)
+    print(f"agenda: {len(rows):,} minutos ocupados ({args.occupancy:.0%}), {index.stats()['days_indexed']} dias")
+    print(f"índice: free_slots 30 min     {fmt_us(per_call(lambda: index.free_slots('Endodontia', 30, 2, NOW)))}")
+    print(f"índice: free_slots 90 min     {fmt_us(per_call(lambda: index.free_slots('Endodontia', 90, 2, NOW)))}")
+    print(f"índice: free_slots às 14h     "
+          f"{fmt_us(per_call(lambda: index.free_slots('Endodontia', 30, 2, NOW, from_time='14:00')))}")
+    print(f"índice: is_free               "
+          f"{fmt_us(per_call(lambda: index.is_free('Endodontia', '2026-10-21', '10:00', 30, NOW)))}")
+    conn = fernanda_db._connect(path)
+    print(f"SQL por pedido: 90 min        {fmt_us(per_call(lambda: sql_free_slots(conn, 'Endodontia', 90), number=200))}")
+    assert sql_free_slots(conn, "Endodontia", 90) == index.free_slots("Endodontia", 90, 2, NOW)
+    conn.close()
+    print(f"recarga completa              {fmt_us(per_call(lambda: ScheduleIndex(BUSINESS_HOURS).load(rows), number=50))}")
+    db.close()
+
+    won, lost, reserved, appointments, write_ms = asyncio.run(race(path, args.races))
+    print(f"disputas: {args.races}, vencidas por worker {won}, SlotTakenError {lost}")
+    print(f"minutos reservados {reserved}, agendamentos gravados {appointments}, "
+          f"escrita p50 {write_ms} ms")
+    assert sum(won) == args.races and sum(lost) == args.races, "horário reservado duas vezes"
+    assert appointments == args.races, "agendamento órfão após conflito"
+    assert reserved == args.races * 30 // SLOT_UNIT_MIN
+
+    asyncio.run(fully_booked(import_backend()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+"""
+Benchmark: tempo até a primeira mensagem, com e sem streaming
+
+Usa get_ai_response do backend com um modelo falso que gera uma resposta
+de 6 frases em ~2 s (0,4 s até o primeiro trecho). Sem streaming o paciente espera a resposta inteira;
+com streaming a primeira frase é entregue assim que termina e a geração é
+interrompida na terceira frase.
+
+Uso: python bench/bench_stream.py
+"""
+
+import asyncio
+import time
+
+from common import import_backend
+from fake_gemini import FakeGeminiModel
+
+fb = import_backend()
+
+from fernanda_llm import SentenceSplitter  # noqa: E402
+
+REPLY = ("Oi, Ana! Que bom falar com você. Temos horário hoje às 14:30 ou às 16:00, "
+         "qual fica melhor? A avaliação leva uns 40 minutos. Fica na Av. Central, 123. "
+         "Qualquer dúvida é só me chamar por aqui.")
+RUNS = 10
+
+
+async def measure(streaming: bool):
+    model = FakeGeminiModel(latency=2.0, jitter=0, reply=REPLY, chunk_chars=12, chunk_delay=0.1)
+    fb.LLM_GOVERNOR.model = model
+    first, total = [], []
+    for _ in range(RUNS):
+        started = time.monotonic()
+        seen = []
+
+        async def on_first_sentence(sentence):
+            seen.append(time.monotonic() - started)
+
+        text = await fb.get_ai_response("prompt", on_first_sentence=on_first_sentence if streaming else None)
+        total.append(time.monotonic() - started)
+        first.append(seen[0] if seen else total[-1])
+
+    label = "streaming" if streaming else "resposta inteira"
+    print(f"{label:<18} 1ª mensagem {sum(first) / RUNS * 1000:7.0f} ms   "
+          f"total {sum(total) / RUNS * 1000:7.0f} ms   "
+          f"caracteres gerados/resposta {model.chars_generated // RUNS:4d}   "
+          f"frases enviadas {len(SentenceSplitter().feed(text + ' '))}")
+
+
+async def main():
+    await measure(streaming=False)
+    await measure(streaming=True)
+    fb.LLM_GOVERNOR.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,38 @@
+"""
+Utilidades compartilhadas pelos benchmarks
+Importa o backend com chave fictícia e banco temporário, e mede tempos de CPU
+"""
+
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def import_backend():
+    """Importa app/fernanda_backend.py sem tocar no banco real nem na API do Gemini"""
+    os.chdir(ROOT)
+    os.environ.setdefault("GOOGLE_API_KEY", "bench")
+    os.environ.setdefault("DATABASE_PATH", os.path.join(tempfile.mkdtemp(), "bench.db"))
+    sys.path.insert(0, str(ROOT / "app"))
+    import fernanda_backend
+    return fernanda_backend
+
+
+def per_call(fn: Callable, number: int = 1000, repeat: int = 5) -> float:
+    """Melhor tempo médio por chamada (segundos) entre `repeat` rodadas"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        best = min(best, (time.perf_counter() - start) / number)
+    return best
+
+
+def fmt_us(seconds: float) -> str:
+    return f"{seconds * 1e6:10.1f} µs"
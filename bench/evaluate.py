@@ -0,0 +1,453 @@
+"""
+Avaliação offline: reexecuta conversas roteirizadas pelo pipeline de verdade
+
+Cada conversa do corpus passa turno a turno por process_turn (templates,
+cache, extração, prompt, modelo, máquina de estados e reserva de horário),
+com o modelo trocado por um substituto: por padrão o "recorded", que
+responde o texto gravado para aquele turno. As conversas são distribuídas
+por um pool de processos; cada processo tem seu próprio banco temporário e
+cada conversa começa isolada (sem histórico, cache de respostas nem
+reservas das anteriores), então o resultado não depende de quantos
+processos rodaram nem da ordem.
+
+Mede:
+- transições de estado (de -> para) e estado final de cada conversa;
+- taxa de agendamento concluído e turnos até o agendamento;
+- concordância com os estados gravados no corpus (quando houver);
+- expectativas do corpus que falharam;
+- CPU e tempo por turno (e por etapa, dos spans do turno).
+
+O resultado vai para bench/results/eval-<label>-<data>.json; --baseline
+compara com uma rodada anterior (métricas e, conversa a conversa, onde a
+sequência de estados mudou). Com --strict, sai com erro se alguma conversa
+deixou de agendar ou passou a falhar uma expectativa.
+
+Uso:
+  python bench/evaluate.py [--corpus bench/fixtures/conversations.jsonl] [--synthetic 1000]
+                           [--workers 4] [--model recorded|gemini] [--persona outro_prompt.md]
+                           [--label nome] [--baseline bench/results/eval-base-....json] [--strict]
+                           [--save-corpus gravado.jsonl]
+
+Formatos do corpus (JSONL, detectado linha a linha):
+- roteiro: {"id", "phone", "turns": ["texto" | {"user", "bot", "state"}],
+            "expect": {"state", "booked", "max_turns"}}
+  ("bot" é a resposta gravada do modelo e "state" o estado esperado após o turno);
+- exportação da tabela conversations (/api/export/conversations?format=ndjson):
+  uma interação por linha, agrupadas por patient_phone em ordem de created_at;
+- uma mensagem por linha, como no loadtest: {"from" | "phone", "text"}.
+--model gemini chama o Gemini de verdade (GOOGLE_API_KEY); com --save-corpus
+as respostas obtidas viram um corpus de roteiros para rodar offline depois.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from common import ROOT
+from fake_gemini import FakeResponse
+
+RESULTS_DIR = ROOT / "bench" / "results"
+DEFAULT_CORPUS = ROOT / "bench" / "fixtures" / "conversations.jsonl"
+DEFAULT_REPLY = "Claro! Posso te ajudar com isso. Qual o melhor horário para você?"
+
+Conversation = Dict[str, Any]
+WARMUP: Conversation = {"id": "warmup", "phone": "5562000000000", "expect": {},
+                        "turns": [{"user": "Oi, meu nome é Ana, quero agendar uma limpeza"},
+                                  {"user": "amanhã às 10h"}, {"user": "sim"}]}
+
+
+# === Corpus ===
+def load_corpus(path: str) -> List[Conversation]:
+    """Conversas do arquivo (roteiros, exportação ou mensagens soltas)"""
+    conversations: List[Conversation] = []
+    exported: Dict[str, List[Dict[str, Any]]] = {}
+    messages: Dict[str, List[Dict[str, Any]]] = {}
+    with open(path, encoding="utf-8") as f:
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            if "turns" in item:
+                turns = [{"user": t} if isinstance(t, str) else t for t in item["turns"]]
+                conversations.append({
+                    "id": str(item.get("id") or f"{Path(path).stem}:{number}"),
+                    "phone": str(item.get("phone") or f"55620{number:08d}"),
+                    "turns": turns,
+                    "expect": item.get("expect") or {},
+                })
+            elif "user_message" in item:
+                exported.setdefault(str(item["patient_phone"]), []).append(item)
+            elif "text" in item:
+                phone = str(item.get("from") or item.get("phone"))
+                messages.setdefault(phone, []).append({"user": item["text"]})
+
+    for phone, rows in exported.items():
+        rows.sort(key=lambda row: (row["created_at"] or "", row["id"]))
+        conversations.append({
+            "id": f"export:{phone}",
+            "phone": phone,
+            "turns": [{"user": row["user_message"], "bot": row["bot_response"], "state": row["state"]}
+                      for row in rows],
+            "expect": {},
+        })
+    for phone, turns in messages.items():
+        conversations.append({"id": f"messages:{phone}", "phone": phone, "turns": turns, "expect": {}})
+    return conversations
+
+
+def synthetic_corpus(count: int, seed: int) -> List[Conversation]:
+    """Conversas de agendamento do loadtest (devem terminar agendadas)"""
+    from loadtest import synthesize
+    return [{"id": f"synthetic:{i}", "phone": phone, "turns": [{"user": text} for text in script],
+             "expect": {"booked": True}}
+            for i, (phone, script) in enumerate(synthesize(count, seed))]
+
+
+# === Modelos ===
+class RecordedModel:
+    """Responde o texto gravado para o turno atual (ou uma resposta neutra)"""
+
+    def __init__(self, default_reply: str = DEFAULT_REPLY):
+        self.default_reply = default_reply
+        self.reply: Optional[str] = None
+        self.calls = 0
+
+    def generate_content(self, prompt, generation_config=None, stream=False, **kwargs):
+        self.calls += 1
+        response = FakeResponse(self.reply or self.default_reply)
+        return iter([response]) if stream else response
+
+
+def gemini_model(fb):
+    return fb.GEMINI_MODEL
+
+
+MODELS = {
+    "recorded": lambda fb: RecordedModel(),
+    "gemini": gemini_model,
+}
+
+
+# === Processo do pool ===
+fb = None
+loop: Optional[asyncio.AbstractEventLoop] = None
+model = None
+
+
+def init_worker(workdir: str, model_name: str, persona: Optional[str]):
+    """Importa o backend neste processo, com banco próprio e sem efeitos externos"""
+    global fb, loop, model
+    os.environ["DATABASE_PATH"] = os.path.join(workdir, f"eval-{os.getpid()}.db")
+    os.environ["ADMIN_WHATSAPP"] = ""
+    os.environ["TURN_LOG"] = "off"
+    # Os prints do backend (tokens, migrações) não interessam aqui
+    sys.stdout = open(os.devnull, "w")
+    from common import import_backend
+    fb = import_backend()
+    if persona:
+        fb.FERNANDA_PROMPT = Path(persona).read_text(encoding="utf-8")
+        fb.PROMPT_BUILDER = fb.build_prompt_builder()
+    model = MODELS[model_name](fb)
+    fb.LLM_GOVERNOR.model = model
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(start_backend())
+    # Aquecimento: a primeira conversa do processo paga importações e caches frios
+    loop.run_until_complete(run_conversation(WARMUP))
+
+
+async def start_backend():
+    fb.write_queue.start()
+
+
+async def isolate():
+    """Cada conversa começa sem o que as anteriores deixaram neste processo"""
+    fb.RESPONSE_CACHE = fb.ResponseCache(fb.CONFIG_VERSIONS)
+    await fb.write_queue.flush()
+    await fb.db.write(lambda conn: conn.execute("DELETE FROM appointment_slots"))
+    fb.SCHEDULE.load([])
+
+
+async def run_conversation(conversation: Conversation) -> Dict[str, Any]:
+    await isolate()
+    memory = fb.ConversationMemory(conversation["phone"])
+    memory.history = deque(maxlen=fb.HISTORY_TURNS)
+    states, routes, replies, cpu_ms, wall_ms = [], [], [], [], []
+    stages: Counter = Counter()
+    agree = recorded = 0
+    turns_to_booking = None
+    calls_before = getattr(model, "calls", 0)
+
+    for number, turn in enumerate(conversation["turns"], 1):
+        if isinstance(model, RecordedModel):
+            model.reply = turn.get("bot")
+        trace = fb.TurnTrace()
+        cpu, wall = time.process_time(), time.perf_counter()
+        result = await fb.process_turn(memory, turn["user"], trace=trace)
+        cpu_ms.append((time.process_time() - cpu) * 1000)
+        wall_ms.append((time.perf_counter() - wall) * 1000)
+        stages.update({stage: seconds * 1000 for stage, seconds in trace.stages.items()})
+
+        states.append(result["state"])
+        routes.append(trace.fields.get("route", ""))
+        replies.append(result["response"])
+        if turn.get("state"):
+            recorded += 1
+            agree += turn["state"] == result["state"]
+        if turns_to_booking is None and result["appointment_id"]:
+            turns_to_booking = number
+
+    booked = turns_to_booking is not None
+    expect = conversation["expect"]
+    failures = []
+    if "state" in expect and states and states[-1] != expect["state"]:
+        failures.append(f"estado final {states[-1]} (esperado {expect['state']})")
+    if "booked" in expect and booked != expect["booked"]:
+        failures.append("agendou" if booked else "não agendou")
+    if expect.get("max_turns") and booked and turns_to_booking > expect["max_turns"]:
+        failures.append(f"agendou em {turns_to_booking} turnos (máximo {expect['max_turns']})")
+
+    return {
+        "id": conversation["id"],
+        "turns": len(conversation["turns"]),
+        "states": states,
+        "routes": routes,
+        "replies": replies,
+        "final_state": states[-1] if states else fb.ConversationState.NEW_CONTACT.value,
+        "booked": booked,
+        "turns_to_booking": turns_to_booking,
+        "slot": [memory.patient_info.preferred_date, memory.patient_info.preferred_time] if booked else None,
+        "recorded_states": recorded,
+        "recorded_agree": agree,
+        "failures": failures,
+        "model_calls": getattr(model, "calls", 0) - calls_before,
+        "cpu_ms": [round(value, 3) for value in cpu_ms],
+        "wall_ms": [round(value, 3) for value in wall_ms],
+        "stage_ms": {stage: round(value, 3) for stage, value in stages.items()},
+    }
+
+
+def evaluate_batch(batch: List[Conversation]) -> List[Dict[str, Any]]:
+    return [loop.run_until_complete(run_conversation(conversation)) for conversation in batch]
+
+
+# === Relatório ===
+def percentiles(samples: List[float]) -> Dict[str, float]:
+    if not samples:
+        return {"mean": 0.0, "p50": 0.0, "p95": 0.0, "p99": 0.0}
+    ordered = sorted(samples)
+
+    def pick(pct: float) -> float:
+        return round(ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))], 3)
+
+    return {"mean": round(sum(ordered) / len(ordered), 3), "p50": pick(50), "p95": pick(95), "p99": pick(99)}
+
+
+def summarize(conversations: List[Dict[str, Any]], elapsed: float) -> Dict[str, Any]:
+    turns = sum(c["turns"] for c in conversations)
+    transitions: Counter = Counter()
+    routes: Counter = Counter()
+    stages: Counter = Counter()
+    for c in conversations:
+        previous = "new_contact"
+        for state in c["states"]:
+            transitions[f"{previous} -> {state}"] += 1
+            previous = state
+        routes.update(route.split(":")[0] for route in c["routes"])
+        stages.update(c["stage_ms"])
+    booked = [c for c in conversations if c["booked"]]
+    recorded = sum(c["recorded_states"] for c in conversations)
+    failed = [c for c in conversations if c["failures"]]
+    cpu = [value for c in conversations for value in c["cpu_ms"]]
+    wall = [value for c in conversations for value in c["wall_ms"]]
+    return {
+        "elapsed_s": round(elapsed, 2),
+        "turns_per_s": round(turns / elapsed, 1) if elapsed else 0.0,
+        "conversations": len(conversations),
+        "turns": turns,
+        "booking_rate": round(len(booked) / len(conversations), 4) if conversations else 0.0,
+        "turns_to_booking": percentiles([c["turns_to_booking"] for c in booked]),
+        "final_states": dict(Counter(c["final_state"] for c in conversations).most_common()),
+        "transitions": dict(transitions.most_common()),
+        "routes": {route: round(count / turns, 4) for route, count in routes.most_common()} if turns else {},
+        "recorded_agreement": round(sum(c["recorded_agree"] for c in conversations) / recorded, 4)
+        if recorded else None,
+        "expectations_failed": len(failed),
+        "model_calls": sum(c["model_calls"] for c in conversations),
+        "cpu_ms_per_turn": percentiles(cpu),
+        "wall_ms_per_turn": percentiles(wall),
+        "stage_ms_per_turn": {stage: round(total / turns, 3) for stage, total in stages.most_common()}
+        if turns else {},
+    }
+
+
+def print_summary(run: Dict[str, Any]):
+    r = run["results"]
+    print(f"\n== {run['label']} ({r['conversations']:,} conversas, {r['turns']:,} turnos em "
+          f"{r['elapsed_s']} s, {run['workers']} processos, modelo {run['model']}) ==")
+    print(f"agendamento concluído: {r['booking_rate']:.1%}   turnos até agendar: "
+          f"média {r['turns_to_booking']['mean']}  p50 {r['turns_to_booking']['p50']}  "
+          f"p95 {r['turns_to_booking']['p95']}")
+    print(f"estados finais: {r['final_states']}")
+    print(f"caminhos: {r['routes']}   chamadas ao modelo: {r['model_calls']}")
+    if r["recorded_agreement"] is not None:
+        print(f"concordância com os estados gravados: {r['recorded_agreement']:.1%}")
+    print(f"expectativas falhando: {r['expectations_failed']}")
+    print(f"CPU por turno: média {r['cpu_ms_per_turn']['mean']} ms   p50 {r['cpu_ms_per_turn']['p50']} ms   "
+          f"p95 {r['cpu_ms_per_turn']['p95']} ms   (tempo: p50 {r['wall_ms_per_turn']['p50']} ms)")
+    print(f"etapas (ms/turno): {r['stage_ms_per_turn']}")
+    print("transições:")
+    for transition, count in r["transitions"].items():
+        print(f"  {transition:<40}{count:>8}")
+
+
+COMPARED = [
+    ("booking_rate", True), ("turns_to_booking.mean", False), ("turns_to_booking.p95", False),
+    ("recorded_agreement", True), ("expectations_failed", False), ("model_calls", False),
+    ("cpu_ms_per_turn.mean", False), ("cpu_ms_per_turn.p95", False), ("wall_ms_per_turn.p50", False),
+]
+
+
+def lookup(results: Dict[str, Any], path: str) -> Optional[float]:
+    value: Any = results
+    for key in path.split("."):
+        if not isinstance(value, dict) or key not in value:
+            return None
+        value = value[key]
+    return value
+
+
+def compare(baseline: Dict[str, Any], current: Dict[str, Any], show: int = 20) -> int:
+    """Mostra as diferenças para a rodada anterior; retorna quantas conversas pioraram"""
+    print(f"\n{'métrica':<28}{baseline['label']:>14}{current['label']:>14}   variação")
+    for path, higher_is_better in COMPARED:
+        old, new = lookup(baseline["results"], path), lookup(current["results"], path)
+        if old is None or new is None:
+            continue
+        change = ""
+        if old:
+            pct = (new - old) / old * 100
+            better = pct > 0 if higher_is_better else pct < 0
+            change = f"{pct:+8.1f}% {'melhor' if better and abs(pct) >= 1 else 'pior' if abs(pct) >= 1 else ''}"
+        print(f"{path:<28}{old:>14}{new:>14}   {change}")
+
+    if baseline.get("workers") != current.get("workers"):
+        print(f"(CPU e tempo por turno com {baseline.get('workers')} x {current.get('workers')} processos: "
+              f"só são comparáveis com o mesmo --workers)")
+
+    old_transitions, new_transitions = baseline["results"]["transitions"], current["results"]["transitions"]
+    changed = [(t, old_transitions.get(t, 0), new_transitions.get(t, 0))
+               for t in sorted(set(old_transitions) | set(new_transitions))
+               if old_transitions.get(t, 0) != new_transitions.get(t, 0)]
+    if changed:
+        print("\ntransições que mudaram:")
+        for transition, old, new in changed:
+            print(f"  {transition:<40}{old:>8}{new:>8}")
+
+    before = {c["id"]: c for c in baseline["conversations"]}
+    diverged, regressions = [], []
+    for c in current["conversations"]:
+        old = before.get(c["id"])
+        if old is None or old["states"] == c["states"]:
+            continue
+        turn = next((i for i, (a, b) in enumerate(zip(old["states"], c["states"])) if a != b),
+                    min(len(old["states"]), len(c["states"])))
+        worse = (old["booked"] and not c["booked"]) or (len(c["failures"]) > len(old["failures"]))
+        (regressions if worse else diverged).append((c, old, turn))
+    missing = len(set(before) - {c["id"] for c in current["conversations"]})
+    print(f"\nconversas com outra sequência de estados: {len(diverged) + len(regressions)} "
+          f"(pioraram: {len(regressions)})" + (f"; {missing} do baseline não rodaram" if missing else ""))
+    for c, old, turn in (regressions + diverged)[:show]:
+        user = c["turn_texts"][turn] if turn < len(c.get("turn_texts", [])) else ""
+        print(f"  {c['id']}: turno {turn + 1} {user!r}: "
+              f"{old['states'][turn] if turn < len(old['states']) else '-'} -> "
+              f"{c['states'][turn] if turn < len(c['states']) else '-'}"
+              f"   agendou {old['booked']} -> {c['booked']}" +
+              (f"   {'; '.join(c['failures'])}" if c["failures"] else ""))
+    return len(regressions)
+
+
+def save_corpus(path: str, conversations: List[Conversation], results: List[Dict[str, Any]]):
+    """Roteiros com as respostas obtidas nesta rodada (para repetir offline com --model recorded)"""
+    with open(path, "w", encoding="utf-8") as f:
+        for conversation, result in zip(conversations, results):
+            turns = [{"user": turn["user"], "bot": reply, "state": state}
+                     for turn, reply, state in zip(conversation["turns"], result["replies"], result["states"])]
+            f.write(json.dumps({"id": conversation["id"], "phone": conversation["phone"], "turns": turns,
+                                "expect": conversation["expect"]}, ensure_ascii=False) + "\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--corpus", action="append", help="JSONL de conversas (pode repetir)")
+    parser.add_argument("--synthetic", type=int, default=0, help="conversas de agendamento geradas")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="processos do pool")
+    parser.add_argument("--batch", type=int, default=25, help="conversas por tarefa do pool")
+    parser.add_argument("--model", choices=sorted(MODELS), default="recorded")
+    parser.add_argument("--persona", help="prompt da Fernanda alternativo (no lugar de prompt_fernanda.md)")
+    parser.add_argument("--label", default="eval")
+    parser.add_argument("--output", help="arquivo do resultado (padrão: bench/results/eval-<label>-<data>.json)")
+    parser.add_argument("--baseline", help="resultado anterior para comparar")
+    parser.add_argument("--strict", action="store_true",
+                        help="sai com erro se alguma conversa piorou em relação ao baseline")
+    parser.add_argument("--save-corpus", help="grava os roteiros com as respostas desta rodada")
+    args = parser.parse_args()
+
+    conversations: List[Conversation] = []
+    for path in args.corpus or ([] if args.synthetic else [str(DEFAULT_CORPUS)]):
+        conversations += load_corpus(path)
+    if args.synthetic:
+        conversations += synthetic_corpus(args.synthetic, args.seed)
+    if not conversations:
+        parser.error("corpus vazio")
+
+    batches = [conversations[i:i + args.batch] for i in range(0, len(conversations), args.batch)]
+    started = time.perf_counter()
+    with tempfile.TemporaryDirectory() as workdir, \
+            ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker,
+                                initargs=(workdir, args.model, args.persona)) as pool:
+        results = [result for batch in pool.map(evaluate_batch, batches) for result in batch]
+    elapsed = time.perf_counter() - started
+    for conversation, result in zip(conversations, results):
+        result["turn_texts"] = [turn["user"] for turn in conversation["turns"]]
+
+    run = {
+        "label": args.label,
+        "started_at": datetime.now().isoformat(timespec="seconds"),
+        "model": args.model,
+        "persona": args.persona,
+        "workers": args.workers,
+        "results": summarize(results, elapsed),
+        "conversations": results,
+    }
+    print_summary(run)
+    failed = [c for c in results if c["failures"]]
+    for c in failed[:20]:
+        print(f"  ✗ {c['id']}: {'; '.join(c['failures'])}")
+
+    output = Path(args.output) if args.output else \
+        RESULTS_DIR / f"eval-{args.label}-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(run, ensure_ascii=False, indent=1), encoding="utf-8")
+    print(f"\nResultado salvo em {output}")
+    if args.save_corpus:
+        save_corpus(args.save_corpus, conversations, results)
+        print(f"Roteiros gravados em {args.save_corpus}")
+
+    if args.baseline:
+        regressions = compare(json.loads(Path(args.baseline).read_text(encoding="utf-8")), run)
+        if args.strict and regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
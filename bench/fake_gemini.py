@@ -0,0 +1,69 @@
+"""
+Modelo Gemini falso para benchmarks e testes de carga
+Mesma interface de generate_content, com latência, cauda lenta e erros configuráveis
+"""
+
+import random
+import time
+
+
+class FakeResponse:
+    def __init__(self, text: str):
+        self.text = text
+
+
+class FakeGeminiModel:
+    """
+    Substituto de genai.GenerativeModel.
+
+    Cada chamada dorme `latency` segundos (±`jitter`); com probabilidade
+    `slow_ratio` dorme `slow_latency` (a cauda lenta de uma degradação) e
+    com probabilidade `error_ratio` levanta RuntimeError. Com stream=True o
+    tempo total é o mesmo, mas a resposta sai em trechos de `chunk_chars`
+    caracteres a cada `chunk_delay`; `chars_generated` conta o que foi de
+    fato gerado (o stream pode ser abandonado no meio).
+    """
+
+    def __init__(self, latency: float = 0.8, jitter: float = 0.2, slow_ratio: float = 0.0,
+                 slow_latency: float = 5.0, error_ratio: float = 0.0,
+                 reply: str = "Claro! Posso te ajudar com isso. Qual o melhor horário para você?",
+                 chunk_chars: int = 24, chunk_delay: float = 0.05, seed: int = 42):
+        self.latency = latency
+        self.jitter = jitter
+        self.slow_ratio = slow_ratio
+        self.slow_latency = slow_latency
+        self.error_ratio = error_ratio
+        self.reply = reply
+        self.chunk_chars = chunk_chars
+        self.chunk_delay = chunk_delay
+        self.calls = 0
+        self.chars_generated = 0
+        self._random = random.Random(seed)
+
+    def _delay(self) -> float:
+        if self._random.random() < self.slow_ratio:
+            return self.slow_latency
+        return max(0.0, self.latency + self._random.uniform(-self.jitter, self.jitter))
+
+    def generate_content(self, prompt, generation_config=None, stream=False, **kwargs):
+        self.calls += 1
+        delay = self._delay()
+        failed = self._random.random() < self.error_ratio
+        if stream:
+            return self._stream(delay, failed)
+        time.sleep(delay)
+        if failed:
+            raise RuntimeError("503 The model is overloaded")
+        self.chars_generated += len(self.reply)
+        return FakeResponse(self.reply)
+
+    def _stream(self, delay: float, failed: bool):
+        # O tempo até o primeiro trecho é o total menos o de geração dos trechos
+        time.sleep(max(0.0, delay - self.chunk_delay * len(self.reply) / self.chunk_chars))
+        if failed:
+            raise RuntimeError("503 The model is overloaded")
+        for start in range(0, len(self.reply), self.chunk_chars):
+            time.sleep(self.chunk_delay)
+            chunk = self.reply[start:start + self.chunk_chars]
+            self.chars_generated += len(chunk)
+            yield FakeResponse(chunk)
@@ -0,0 +1,417 @@
+"""
+Teste de carga: milhares de conversas simultâneas contra o backend de verdade
+
+Sobe o backend no uvicorn (bench/stub_app.py: Gemini falso com latência
+configurável), uma Evolution API falsa no próprio processo
+(bench/stub_evolution.py) e conversa pelo /webhook como o WhatsApp faria,
+alternando o formato simples ({"from", "text"}) e o da Evolution
+({"data": {"message": ...}}). Cada conversa manda uma mensagem, espera a
+primeira resposta chegar na Evolution falsa, "pensa" um pouco e manda a
+próxima.
+
+Mede:
+- webhook: requisições/s e latência até o "queued" (p50/p95/p99);
+- turno: da mensagem até a primeira resposta chegar no WhatsApp (p50/p95/p99);
+- banco: tempo de SQLite por turno e p95 de leitura/escrita (de /api/status);
+- atraso do event loop do backend e do próprio teste (se o teste saturar, o
+  número não vale);
+- com --redeliver, quantas reentregas foram reconhecidas como duplicadas
+  (as respostas recebidas devem continuar uma por mensagem original).
+
+O resultado vai para um JSON (bench/results/ por padrão) e --compare mostra
+a diferença para uma rodada anterior. Com --workers > 1, o /api/status
+reflete só o worker que atendeu a consulta.
+
+Uso:
+  python bench/loadtest.py [--conversations 1000] [--concurrency 1000] [--workers 1]
+                           [--latency 0.8] [--think 1.0] [--label nome]
+                           [--replay conversas.jsonl] [--compare bench/results/anterior.json]
+
+--replay lê um JSONL com uma mensagem por linha, no formato simples
+({"from", "text"}), no da Evolution ({"data": ...}) ou {"phone", "text"};
+as mensagens de cada telefone são enviadas na ordem do arquivo.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+import uvicorn
+
+from common import ROOT
+from stub_evolution import StubEvolution
+
+RESULTS_DIR = ROOT / "bench" / "results"
+
+SYLLABLES = ["ma", "ri", "na", "jo", "lu", "ca", "be", "ta", "so", "fe", "li", "ra", "do", "vi"]
+SERVICES = ["limpeza", "clareamento", "canal", "avaliação", "aparelho"]
+DAYS = ["hoje", "amanhã", "segunda", "terça", "quarta", "sexta"]
+QUESTIONS = ["qual o endereço?", "vocês atendem convênio?", "qual o horário de funcionamento?"]
+
+
+def synthesize(count: int, seed: int = 1) -> List[Tuple[str, List[str]]]:
+    """Conversas de agendamento (nome, serviço, horário, confirmação, agradecimento)"""
+    rnd = random.Random(seed)
+    conversations = []
+    for i in range(count):
+        # Nome só com letras (o extrator de nomes ignora dígitos)
+        name = "".join(rnd.choice(SYLLABLES) for _ in range(3)).capitalize()
+        script = [
+            f"Oi, meu nome é {name}, quero agendar {rnd.choice(SERVICES)}",
+            f"{rnd.choice(DAYS)} às {rnd.randint(8, 18)}h",
+            "sim, confirmo",
+            "obrigada!",
+        ]
+        if rnd.random() < 0.3:
+            script.insert(1, rnd.choice(QUESTIONS))
+        conversations.append((f"5562{9_000_000_00 + i:09d}", script))
+    return conversations
+
+
+def phone_of(payload: Dict[str, Any]) -> Optional[str]:
+    if "from" in payload:
+        return str(payload["from"])
+    if "phone" in payload:
+        return str(payload["phone"])
+    jid = payload.get("data", {}).get("message", {}).get("key", {}).get("remoteJid", "")
+    return jid.split("@")[0] or None
+
+
+def load_replay(path: str) -> List[Tuple[str, List[Dict[str, Any]]]]:
+    """Payloads do arquivo agrupados por telefone, na ordem em que aparecem"""
+    by_phone: Dict[str, List[Dict[str, Any]]] = {}
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            payload = json.loads(line)
+            phone = phone_of(payload)
+            if not phone:
+                continue
+            if "phone" in payload:
+                payload = {"from": phone, "text": payload["text"]}
+            by_phone.setdefault(phone, []).append(payload)
+    return list(by_phone.items())
+
+
+def evolution_payload(phone: str, text: str, message_id: str) -> Dict[str, Any]:
+    return {
+        "event": "messages.upsert",
+        "data": {"message": {
+            "key": {"remoteJid": f"{phone}@s.whatsapp.net", "fromMe": False, "id": message_id},
+            "message": {"conversation": text},
+        }},
+    }
+
+
+def percentiles(samples: List[float]) -> Dict[str, float]:
+    if not samples:
+        return {"p50": 0.0, "p95": 0.0, "p99": 0.0, "max": 0.0}
+    ordered = sorted(samples)
+
+    def pick(pct: float) -> float:
+        return round(ordered[min(len(ordered) - 1, int(pct / 100 * len(ordered)))] * 1000, 2)
+
+    return {"p50": pick(50), "p95": pick(95), "p99": pick(99), "max": round(ordered[-1] * 1000, 2)}
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class LoadTest:
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.replies: Dict[str, "asyncio.Queue[float]"] = {}
+        self.ack_latency: List[float] = []
+        self.turn_latency: List[float] = []
+        self.client_lag: List[float] = []
+        self.counters = {"webhooks": 0, "webhook_errors": 0, "busy": 0, "turns": 0,
+                         "turn_timeouts": 0, "replies": 0, "redelivered": 0, "duplicates": 0}
+
+    def on_reply(self, phone: str, text: str, received_at: float):
+        self.counters["replies"] += 1
+        queue = self.replies.get(phone)
+        if queue is not None:
+            queue.put_nowait(received_at)
+
+    async def wait_reply(self, phone: str, sent_at: float) -> Optional[float]:
+        """Primeira resposta depois de `sent_at` (descarta o resto do turno anterior)"""
+        queue = self.replies[phone]
+        deadline = sent_at + self.args.turn_timeout
+        while True:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                return None
+            try:
+                received_at = await asyncio.wait_for(queue.get(), remaining)
+            except asyncio.TimeoutError:
+                return None
+            if received_at >= sent_at:
+                return received_at
+
+    async def converse(self, client: httpx.AsyncClient, phone: str, messages: List[Any], index: int):
+        self.replies[phone] = asyncio.Queue()
+        rnd = random.Random(index)
+        for turn, message in enumerate(messages):
+            if isinstance(message, dict):
+                payload = message
+            elif index % 2:
+                payload = evolution_payload(phone, message, f"LT{index:06d}{turn:02d}")
+            else:
+                payload = {"from": phone, "text": message}
+
+            sent_at = time.perf_counter()
+            try:
+                response = await client.post("/webhook", json=payload)
+            except httpx.HTTPError:
+                self.counters["webhook_errors"] += 1
+                continue
+            self.ack_latency.append(time.perf_counter() - sent_at)
+            self.counters["webhooks"] += 1
+            if response.status_code == 503:
+                self.counters["busy"] += 1
+                continue
+            if response.status_code != 200 or response.json().get("status") != "queued":
+                self.counters["webhook_errors"] += 1
+                continue
+            if self.args.redeliver and rnd.random() < self.args.redeliver:
+                # Reentrega como a Evolution faz após um timeout: não pode gerar outra resposta
+                self.counters["redelivered"] += 1
+                retry = await client.post("/webhook", json=payload)
+                if retry.status_code == 200 and retry.json().get("status") == "duplicate":
+                    self.counters["duplicates"] += 1
+
+            received_at = await self.wait_reply(phone, sent_at)
+            if received_at is None:
+                self.counters["turn_timeouts"] += 1
+            else:
+                self.counters["turns"] += 1
+                self.turn_latency.append(received_at - sent_at)
+            if self.args.think:
+                await asyncio.sleep(self.args.think * rnd.uniform(0.5, 1.5))
+        self.replies.pop(phone, None)
+
+    async def watch_lag(self):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(0.05)
+            self.client_lag.append(max(0.0, time.perf_counter() - started - 0.05))
+
+    async def run(self, base_url: str, conversations: List[Tuple[str, List[Any]]]) -> Dict[str, Any]:
+        limits = httpx.Limits(max_connections=self.args.connections, max_keepalive_connections=self.args.connections)
+        async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60) as client:
+            before = (await client.get("/api/status")).json()
+            slots = asyncio.Semaphore(self.args.concurrency)
+
+            async def limited(phone, messages, index):
+                async with slots:
+                    await self.converse(client, phone, messages, index)
+
+            lag = asyncio.create_task(self.watch_lag())
+            started = time.perf_counter()
+            await asyncio.gather(*(limited(phone, messages, i) for i, (phone, messages) in enumerate(conversations)))
+            elapsed = time.perf_counter() - started
+            lag.cancel()
+            await asyncio.sleep(1)  # turnos restantes chegam ao banco
+            after = (await client.get("/api/status")).json()
+        return self.report(elapsed, before, after)
+
+    def report(self, elapsed: float, before: Dict[str, Any], after: Dict[str, Any]) -> Dict[str, Any]:
+        db_before, db_after = before["database"], after["database"]
+        db_busy = (db_after["read_busy_s"] - db_before["read_busy_s"]) + \
+                  (db_after["write_busy_s"] - db_before["write_busy_s"])
+        turns = max(1, self.counters["turns"])
+        return {
+            "elapsed_s": round(elapsed, 2),
+            "webhook_rps": round(self.counters["webhooks"] / elapsed, 1),
+            "turns_per_s": round(self.counters["turns"] / elapsed, 1),
+            "webhook_ms": percentiles(self.ack_latency),
+            "turn_ms": percentiles(self.turn_latency),
+            "db": {
+                "busy_s": round(db_busy, 3),
+                "ms_per_turn": round(db_busy / turns * 1000, 3),
+                "reads": db_after["reads"] - db_before["reads"],
+                "writes": db_after["writes"] - db_before["writes"],
+                "read_ms_p95": db_after["read_ms_p95"],
+                "write_ms_p95": db_after["write_ms_p95"],
+            },
+            "server_loop_lag_ms": after["event_loop"],
+            "client_loop_lag_ms": percentiles(self.client_lag),
+            "counters": self.counters,
+            "server": {key: after[key] for key in ("queue", "whatsapp", "routes", "llm", "first_message")},
+        }
+
+
+def start_backend(args: argparse.Namespace, port: int, evolution_port: int, workdir: str) -> subprocess.Popen:
+    env = {
+        **os.environ,
+        "RUN_MODE": "prod",
+        "GOOGLE_API_KEY": "loadtest",
+        "WEBHOOK_TOKEN": "",
+        "EVOLUTION_BASE_URL": f"http://127.0.0.1:{evolution_port}",
+        "EVOLUTION_API_KEY": "loadtest",
+        # O limite real da Evolution mediria a fila de envio, não o backend
+        "EVOLUTION_RATE": str(args.evolution_rate),
+        "EVOLUTION_BURST": str(args.evolution_rate),
+        "DATABASE_PATH": os.path.join(workdir, "loadtest.db"),
+        "STUB_LATENCY": str(args.latency),
+        "STUB_JITTER": str(args.jitter),
+    }
+    log = open(os.path.join(workdir, "backend.log"), "w")
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "stub_app:app", "--app-dir", "bench", "--host", "127.0.0.1",
+         "--port", str(port), "--workers", str(args.workers), "--log-level", "warning", "--no-access-log"],
+        cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+
+async def wait_ready(base_url: str, backend: subprocess.Popen, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient(base_url=base_url) as client:
+        while time.monotonic() < deadline:
+            if backend.poll() is not None:
+                raise RuntimeError("O backend terminou durante a inicialização (veja backend.log)")
+            try:
+                if (await client.get("/")).status_code == 200:
+                    return
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError("O backend não respondeu a tempo")
+
+
+async def main_async(args: argparse.Namespace) -> Dict[str, Any]:
+    if args.replay:
+        conversations = load_replay(args.replay)
+    else:
+        conversations = synthesize(args.conversations, args.seed)
+
+    test = LoadTest(args)
+    stub = StubEvolution(latency=args.evolution_latency, error_ratio=args.evolution_errors, on_message=test.on_reply)
+    evolution_port, port = free_port(), free_port()
+    evolution = uvicorn.Server(uvicorn.Config(stub.app, host="127.0.0.1", port=evolution_port,
+                                              log_level="warning", access_log=False))
+    evolution_task = asyncio.create_task(evolution.serve())
+
+    workdir = tempfile.mkdtemp(prefix="fernanda-loadtest-")
+    backend = start_backend(args, port, evolution_port, workdir)
+    try:
+        base_url = f"http://127.0.0.1:{port}"
+        await wait_ready(base_url, backend)
+        print(f"Backend pronto ({args.workers} worker(s)); {len(conversations):,} conversas, "
+              f"{sum(len(m) for _, m in conversations):,} mensagens...")
+        results = await test.run(base_url, conversations)
+    finally:
+        backend.terminate()
+        backend.wait(timeout=30)
+        evolution.should_exit = True
+        await evolution_task
+
+    results["evolution"] = dict(stub.counters)
+    return {
+        "label": args.label,
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "config": {key: value for key, value in vars(args).items() if key not in ("compare", "output")},
+        "messages": sum(len(m) for _, m in conversations),
+        "results": results,
+        "workdir": workdir,
+    }
+
+
+# Métricas comparadas com --compare: (caminho, maior é melhor)
+COMPARED = [
+    ("webhook_rps", True), ("turns_per_s", True),
+    ("webhook_ms.p50", False), ("webhook_ms.p95", False), ("webhook_ms.p99", False),
+    ("turn_ms.p50", False), ("turn_ms.p95", False), ("turn_ms.p99", False),
+    ("db.ms_per_turn", False), ("db.read_ms_p95", False), ("db.write_ms_p95", False),
+    ("server_loop_lag_ms.lag_ms_p95", False), ("server_loop_lag_ms.lag_ms_max", False),
+    ("counters.turn_timeouts", False), ("counters.busy", False),
+]
+
+
+def lookup(results: Dict[str, Any], path: str) -> Optional[float]:
+    value: Any = results
+    for key in path.split("."):
+        if not isinstance(value, dict) or key not in value:
+            return None
+        value = value[key]
+    return value
+
+
+def compare(baseline: Dict[str, Any], current: Dict[str, Any]):
+    print(f"\n{'métrica':<32}{baseline['label']:>14}{current['label']:>14}   variação")
+    for path, higher_is_better in COMPARED:
+        old, new = lookup(baseline["results"], path), lookup(current["results"], path)
+        if old is None or new is None:
+            continue
+        change = ""
+        if old:
+            pct = (new - old) / old * 100
+            better = pct > 0 if higher_is_better else pct < 0
+            change = f"{pct:+8.1f}% {'melhor' if better and abs(pct) >= 1 else 'pior' if abs(pct) >= 1 else ''}"
+        print(f"{path:<32}{old:>14}{new:>14}   {change}")
+
+
+def print_summary(run: Dict[str, Any]):
+    r = run["results"]
+    print(f"\n== {run['label']} ({run['messages']:,} mensagens em {r['elapsed_s']} s) ==")
+    print(f"webhook: {r['webhook_rps']} req/s   p50 {r['webhook_ms']['p50']} ms   "
+          f"p95 {r['webhook_ms']['p95']} ms   p99 {r['webhook_ms']['p99']} ms")
+    print(f"turno até a 1ª resposta: {r['turns_per_s']} turnos/s   p50 {r['turn_ms']['p50']} ms   "
+          f"p95 {r['turn_ms']['p95']} ms   p99 {r['turn_ms']['p99']} ms")
+    print(f"banco: {r['db']['ms_per_turn']} ms/turno   leitura p95 {r['db']['read_ms_p95']} ms   "
+          f"escrita p95 {r['db']['write_ms_p95']} ms")
+    print(f"event loop do backend: {r['server_loop_lag_ms']}   do teste: p99 {r['client_loop_lag_ms']['p99']} ms")
+    print(f"contadores: {r['counters']}   evolution: {r['evolution']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--conversations", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=1000, help="conversas em andamento ao mesmo tempo")
+    parser.add_argument("--connections", type=int, default=200, help="conexões HTTP com o backend")
+    parser.add_argument("--workers", type=int, default=1, help="workers do uvicorn")
+    parser.add_argument("--latency", type=float, default=0.8, help="latência do Gemini falso (s)")
+    parser.add_argument("--jitter", type=float, default=0.2)
+    parser.add_argument("--think", type=float, default=1.0, help="pausa média entre mensagens (s)")
+    parser.add_argument("--turn-timeout", type=float, default=60)
+    parser.add_argument("--evolution-latency", type=float, default=0.0)
+    parser.add_argument("--evolution-errors", type=float, default=0.0)
+    parser.add_argument("--evolution-rate", type=float, default=100000)
+    parser.add_argument("--redeliver", type=float, default=0.0,
+                        help="fração das mensagens reenviadas logo após o aceite (reentrega da Evolution)")
+    parser.add_argument("--replay", help="JSONL com as mensagens a reenviar")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--label", default="loadtest")
+    parser.add_argument("--output", help="arquivo do resultado (padrão: bench/results/<label>-<data>.json)")
+    parser.add_argument("--compare", help="resultado anterior para comparar")
+    args = parser.parse_args()
+
+    run = asyncio.run(main_async(args))
+    print_summary(run)
+
+    output = Path(args.output) if args.output else \
+        RESULTS_DIR / f"{args.label}-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(run, ensure_ascii=False, indent=2), encoding="utf-8")
+    print(f"\nResultado salvo em {output}")
+
+    if args.compare:
+        compare(json.loads(Path(args.compare).read_text(encoding="utf-8")), run)
+
+
+if __name__ == "__main__":
+    main()
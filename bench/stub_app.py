@@ -0,0 +1,30 @@
+"""
+Backend com Gemini falso, para rodar no uvicorn em benchmarks e testes de carga
+
+Uso: uvicorn stub_app:app --app-dir bench --workers N
+(STUB_LATENCY e STUB_JITTER ajustam a latência do modelo falso, em segundos)
+"""
+
+import os
+import sys
+
+from common import ROOT
+from fake_gemini import FakeGeminiModel
+
+import google.generativeai as genai
+
+os.chdir(ROOT)
+os.environ.setdefault("GOOGLE_API_KEY", "stub")
+sys.path.insert(0, str(ROOT / "app"))
+
+STUB_LATENCY = float(os.getenv("STUB_LATENCY", "0.8"))
+STUB_JITTER = float(os.getenv("STUB_JITTER", "0.2"))
+
+
+def _fake_model(*args, **kwargs):
+    return FakeGeminiModel(latency=STUB_LATENCY, jitter=STUB_JITTER, seed=os.getpid())
+
+
+genai.GenerativeModel = _fake_model
+
+from fernanda_backend import app  # noqa: E402,F401
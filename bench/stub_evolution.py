@@ -0,0 +1,56 @@
+"""
+Evolution API falsa para testes de carga
+Aceita POST /message/sendText/{instance} como a real, com latência e erros configuráveis
+
+Uso isolado: uvicorn stub_evolution:app --app-dir bench --port 8081
+(STUB_EVOLUTION_LATENCY e STUB_EVOLUTION_ERROR_RATIO ajustam o comportamento)
+"""
+
+import asyncio
+import os
+import random
+import time
+from typing import Callable, Dict, Optional
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+
+class StubEvolution:
+    """
+    Recebe os envios do backend e avisa `on_message(phone, text, received_at)`
+    (o teste de carga usa isso para saber quando cada turno foi respondido).
+    `error_ratio` das requisições recebe 503, para exercitar os retries.
+    """
+
+    def __init__(self, latency: float = 0.0, error_ratio: float = 0.0,
+                 on_message: Optional[Callable[[str, str, float], None]] = None, seed: int = 11):
+        self.latency = latency
+        self.error_ratio = error_ratio
+        self.on_message = on_message
+        self.counters = {"received": 0, "failed": 0}
+        self._random = random.Random(seed)
+        self.app = FastAPI()
+        self.app.post("/message/sendText/{instance}")(self.send_text)
+        self.app.get("/stats")(self.stats)
+
+    async def send_text(self, instance: str, request: Request):
+        payload = await request.json()
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self._random.random() < self.error_ratio:
+            self.counters["failed"] += 1
+            return JSONResponse({"error": "unavailable"}, status_code=503)
+        self.counters["received"] += 1
+        if self.on_message:
+            self.on_message(str(payload.get("number")), payload.get("text", ""), time.perf_counter())
+        return {"key": {"id": f"stub-{self.counters['received']}"}, "status": "PENDING"}
+
+    async def stats(self) -> Dict[str, int]:
+        return self.counters
+
+
+app = StubEvolution(
+    latency=float(os.getenv("STUB_EVOLUTION_LATENCY", "0")),
+    error_ratio=float(os.getenv("STUB_EVOLUTION_ERROR_RATIO", "0")),
+).app